@@ -7,6 +7,7 @@ import atoms_and_modules.registration_functions as rf
 from pyminc.volumes.factory import volumeFromFile
 from collections import namedtuple
 from operator import mul
+from functools import partial
 from os.path import abspath, basename, splitext
 from os import curdir
 import pydpiper.file_handling as fh
@@ -95,10 +96,12 @@ class mincANTS(CmdStage):
         self.finalizeCommand()
         self.setName()
         self.colour = "red"
+        self.idempotent = True
+        # (ITK multithreads the registration, so it can make use of idle processors)
+        self.setProcsRange(1, 8)
         # defer calculation of memory use until the actual file to be used
         # is available (since the input file may be, e.g., much larger)
-        self.runnable_hooks.append(
-            lambda : self.setMemory(inSource, memoryCoeffs))
+        self.runnable_hooks.append(partial(self.setMemory, inSource, memoryCoeffs))
         
     def setMemory(self, inSource, memoryCoeffs):
         iterationElements = self.iterations.split("x")
@@ -260,11 +263,12 @@ class minctracc(CmdStage):
         self.setTransform()
         self.setName()
         self.colour = "red"
+        self.idempotent = True
         if memory is not None:
             self.mem = memory
         else:
             self.runnable_hooks.append(
-                lambda : self.setMemory(self.source, minctracc_default_mem_cfg))
+                partial(self.setMemory, self.source, minctracc_default_mem_cfg))
 
     def setMemory(self, source, cfg):
         voxels = reduce(mul, volumeFromFile(source).getSizes())
@@ -423,8 +427,7 @@ class blur(CmdStage):
             # must do this now due to inFile mutation (ugh)
             # otherwise we'll get filename of a future file
             vol = inFile.getLastBasevol()
-        self.runnable_hooks.append(
-            lambda : self.setMemory(vol, mincblur_mem_cfg))
+        self.runnable_hooks.append(partial(self.setMemory, vol, mincblur_mem_cfg))
 
     def setMemory(self, volname, mem_cfg):
         voxels = reduce(mul, volumeFromFile(volname).getSizes())
@@ -814,6 +817,9 @@ class mincAverage(CmdStage):
         self.addDefaults(copyHeaderInfo)
         self.finalizeCommand()
         self.setName()
+        # reading all its inputs loads the file system, so (with --resource-pools)
+        # only so many averages should run at once
+        self.setResource("io_tokens", 1)
         
     def addDefaults(self, copyHeaderInfo=False):
         for i in range(len(self.filesToAvg)):
@@ -15,6 +15,7 @@ import pydpiper.file_handling as fh
 from pyminc.volumes.factory import volumeFromFile
 import sys
 from os.path import splitext
+from functools import partial
 
 class SetResolution:
     def __init__(self, filesToResample, resolution):
@@ -522,13 +523,8 @@ class createQualityControlImages(object):
             message_to_print += "files %s. " % self.message
             message_to_print += "\n%s\n" % (montageOutPut)
             message_to_print += "* * * * * * *\n"
-            # the hook needs a return. Given that "print" does not return
-            # anything, we need to encapsulate the print statement in a 
-            # function (which in this case will return None, but that's fine)
-            def printMessageForMontage():
-                print(message_to_print)
-            montage.finished_hooks.append(
-                lambda : printMessageForMontage())
+            # (a partial rather than a closure so the stage can be saved in a compiled plan)
+            montage.finished_hooks.append(partial(print, message_to_print))
             self.p.addStage(montage)
 
             
@@ -1,2 +1,2 @@
-__all__ = ["pipeline", "pipeline_executor", "queueing", "file_handling", "application"]
+__all__ = ["pipeline", "pipeline_executor", "queueing", "file_handling", "application", "estimates", "result_cache", "autoscaling", "direct_submission", "local_engine", "fair_share", "speculation", "memory_limits", "cpu_affinity", "resources", "events"]
 
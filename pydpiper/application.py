@@ -1,14 +1,17 @@
 from __future__ import print_function
 from configargparse import ArgParser
 from pydpiper.pipeline import Pipeline, pipelineDaemon
-from pydpiper.queueing import runOnQueueingSystem
-from pydpiper.file_handling import makedirsIgnoreExisting
+from pydpiper.queueing import queueBackend
+from pydpiper.file_handling import makedirsIgnoreExisting, statFiles
 from pydpiper.pipeline_executor import addExecutorArgumentGroup, noExecSpecified
 from datetime import datetime
 import time # TODO why both datetime and time?
+import hashlib
+import glob
 from pkg_resources import get_distribution
 import logging
 import networkx as nx
+import Pyro4
 import sys
 import os
 
@@ -22,6 +25,26 @@ def addApplicationArgumentGroup(parser):
                                help="Restart pipeline using backup files. [default = %(default)s]")
     group.add_argument("--no-restart", dest="restart", 
                                action="store_false", help="Opposite of --restart")
+    group.add_argument("--restart-check", dest="restart_check",
+                               type=str, default="journal", choices=["journal", "mtime", "digest"],
+                               help="How to decide which stages can be skipped on restart: "
+                                    "'journal' skips stages recorded in the finished stages log; "
+                                    "'mtime' skips stages whose outputs exist and are newer than their inputs "
+                                    "(as in make); 'digest' additionally skips stages whose newer inputs "
+                                    "have the same contents as when the stage last ran. [default = %(default)s]")
+    group.add_argument("--stat-threads", dest="stat_threads",
+                               type=int, default=32,
+                               help="Number of threads used to examine files for --restart-check. [default = %(default)s]")
+    group.add_argument("--use-compiled-plan", dest="use_compiled_plan",
+                               action="store_true", default=False,
+                               help="Save the constructed pipeline and, if the options and input files are "
+                                    "unchanged, load it on subsequent invocations rather than constructing "
+                                    "it again. [default = %(default)s]")
+    group.add_argument("--targets", dest="targets",
+                               type=str, default=None,
+                               help="Comma-separated list of output files and/or stage names (which may be "
+                                    "shell-style globs, e.g. '*nlin-3.mnc'); run only the stages needed "
+                                    "to produce these. [default = all stages]")
     # TODO instead of prefixing all subdirectories (logs, backups, processed, ...)
     # with the pipeline name/date, we could create one identifying directory
     # and put these other directories inside
@@ -51,6 +74,55 @@ def addApplicationArgumentGroup(parser):
     group.add_argument("files", type=str, nargs='*', metavar='file',
                         help='Files to process')
 
+# options which control how (much of) a pipeline is run rather than which stages
+# it consists of, so needn't invalidate a compiled plan; all executor options
+# except those below are also of this kind
+PLAN_INDEPENDENT_OPTIONS = ["restart", "restart_check", "stat_threads", "create_graph",
+                            "execute", "show_version", "verbose", "targets", "use_compiled_plan"]
+
+# executor options read while a pipeline is constructed, whose effect is saved with its
+# plan (stages without a memory requirement of their own get --default-job-mem's as
+# they're added) rather than applied afresh when the plan is loaded
+PLAN_DEPENDENT_EXECUTOR_OPTIONS = ["merge_equivalent_stages", "default_job_mem"]
+
+def planInputFiles(options, names):
+    """the input files, and those named by the given options which a pipeline's
+    construction may read: files (with any others sharing their base name, such as an
+    initial model's mask and native-space files) and the contents of directories
+    (e.g., an atlas library); the output directory, being written, is left out"""
+    files = list(options.files)
+    for name in names:
+        if name in ["files", "output_directory"]:
+            continue
+        values = getattr(options, name)
+        for v in (values if isinstance(values, list) else [values]):
+            if not isinstance(v, basestring) or not v or not os.path.exists(v):
+                continue
+            if os.path.isdir(v):
+                for root, _, filenames in os.walk(v):
+                    files.extend(os.path.join(root, f) for f in filenames)
+            else:
+                files.append(v)
+                files.extend(glob.glob(os.path.splitext(v)[0] + "_*"))
+    return sorted(set(files))
+
+def compiledPlanKey(options, version):
+    """digest of everything a pipeline's construction depends on: the program, its
+    version and options (including those from config files), and the input files and
+    other files named by the options"""
+    executor_parser = ArgParser()
+    addExecutorArgumentGroup(executor_parser)
+    ignored = ((set(vars(executor_parser.parse_args([]))) | set(PLAN_INDEPENDENT_OPTIONS))
+               - set(PLAN_DEPENDENT_EXECUTOR_OPTIONS))
+    relevant = sorted((k, v) for k, v in vars(options).iteritems() if k not in ignored)
+    h = hashlib.sha1()
+    h.update(os.path.basename(sys.argv[0]))
+    h.update(version)
+    h.update(repr(relevant))
+    files = planInputFiles(options, [k for k, _ in relevant])
+    h.update(repr(sorted(statFiles(files, options.stat_threads).items())))
+    return h.hexdigest()
+
 # Some sneakiness... Using the following lines, it's possible
 # to add an epilog to the parser that is written to screen
 # verbatim. That way in the help file you can show an example
@@ -140,8 +212,10 @@ class AbstractApplication(object):
         self._print_version()
 
         # Check to make sure some executors have been specified if we are 
-        # actually going to run:
-        if self.options.execute:
+        # actually going to run (other than in-process, by submitting stages as
+        # jobs, or on another pipeline's server, none of which needs them):
+        if self.options.execute and not (self.options.local_fast or self.options.submit_stages
+                                         or self.options.join_server):
             noExecSpecified(self.options.num_exec)
              
         self._setup_pipeline(self.options)
@@ -154,17 +228,25 @@ class AbstractApplication(object):
         # or contents of any config file so isn't really complete
         self.reconstructCommand()
 
-        pbs_submit = self.options.queue_type == "pbs" \
-                     and not self.options.local
+        backend = queueBackend(self.options, sys.argv)
+        submit_server = backend is not None and backend.submits_server \
+                        and not (self.options.local or self.options.local_fast
+                                 or self.options.submit_stages or self.options.join_server)
 
         # --create-graph causes the pipeline to be constructed
-        # both at PBS submit time and on the grid; this may be an extremely
+        # both at submit time and on the grid; this may be an extremely
         # expensive duplication
-        if (self.options.execute and not pbs_submit) or self.options.create_graph:
-            logger.debug("Calling `run`")
-            self.run()
-            logger.debug("Calling `initialize`")
-            self.pipeline.initialize()
+        if (self.options.execute and not submit_server) or self.options.create_graph:
+            if self.options.use_compiled_plan:
+                planFile = os.path.join(self.outputDir, self.options.pipeline_name + "_compiled_plan.pkl")
+                planKey = compiledPlanKey(self.options, self.__version__)
+            if not (self.options.use_compiled_plan and self.pipeline.loadPlan(planFile, planKey)):
+                logger.debug("Calling `run`")
+                self.run()
+                logger.debug("Calling `initialize`")
+                self.pipeline.initialize()
+                if self.options.use_compiled_plan:
+                    self.pipeline.savePlan(planFile, planKey)
             self.pipeline.printStages(self.options.pipeline_name)
 
         if self.options.create_graph:
@@ -176,10 +258,13 @@ class AbstractApplication(object):
             print("Not executing the command (--no-execute is specified).\nDone.")
             return
         
-        if pbs_submit:
-            roq = runOnQueueingSystem(self.options, sys.argv)
-            roq.createAndSubmitPbsScripts()
-            logger.info("Finished submitting PBS job scripts...quitting")
+        if self.options.join_server:
+            self.joinServer()
+            return
+
+        if submit_server:
+            backend.submitServerGenerations()
+            logger.info("Finished submitting job scripts...quitting")
             return 
                 
         #pipelineDaemon runs pipeline, launches Pyro client/server and executors (if specified)
@@ -188,6 +273,17 @@ class AbstractApplication(object):
         pipelineDaemon(self.pipeline, self.options, sys.argv[0])
         logger.info("Server has stopped.  Quitting...")
 
+    def joinServer(self):
+        """hand the pipeline to a running --persistent-server instead of running it here;
+        its progress is recorded in our usual finished stages journal"""
+        planFile = os.path.abspath(os.path.join(self.outputDir, self.options.pipeline_name + "_submitted_plan.pkl"))
+        self.pipeline.savePlan(planFile, None)
+        with open(self.options.join_server) as f:
+            serverURI = Pyro4.URI(f.readline())
+        n = Pyro4.Proxy(serverURI).submitPlan(planFile, self.options.pipeline_name, self.options.share_weight,
+                                              os.path.abspath(self.pipeline.backupFileLocation))
+        print("Submitted %d new stages to the server at %s" % (n, serverURI))
+
     def setup_appName(self):
         """sets the name of the application"""
         pass
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+from collections import namedtuple, Counter
+import logging
+
+"""Choosing how many executors of which sizes to launch (or retire) so that the
+executors' capacity matches the (current and imminent) demand of runnable stages"""
+
+logger = logging.getLogger(__name__)
+
+ExecutorShape = namedtuple("ExecutorShape", ["mem", "procs"])
+
+# executor memory is rounded up to one of these sizes (in G, up to --mem),
+# so that a few shapes of executor cover many slightly different demands
+MEM_SIZES = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512]
+
+def quantize(mem, maxMem):
+    return min([m for m in MEM_SIZES if m >= mem] + [maxMem])
+
+class Bin(object):
+    """an executor (existing or planned) into which stages are packed"""
+    def __init__(self, mem, procs, key=None):
+        self.mem = mem
+        self.procs = procs
+        self.key = key
+        self.used_mem = 0.0
+        self.used_procs = 0
+    def fits(self, mem, procs):
+        return (self.used_mem + mem <= self.mem + 1e-6
+                and self.used_procs + procs <= self.procs)
+    def add(self, mem, procs):
+        self.used_mem += mem
+        self.used_procs += procs
+
+def firstFit(demands, bins):
+    """place (mem, procs) demands, largest first, into the first bin with room;
+    returns the demands which didn't fit anywhere"""
+    unplaced = []
+    for mem, procs in sorted(demands, reverse=True):
+        for b in bins:
+            if b.fits(mem, procs):
+                b.add(mem, procs)
+                break
+        else:
+            unplaced.append((mem, procs))
+    return unplaced
+
+def packDemand(demands, maxMem, maxProcs):
+    """first-fit-decreasing bin packing of (mem, procs) demands into executors
+    of at most (maxMem, maxProcs); returns the shape of each executor needed"""
+    bins = []
+    for mem, procs in sorted(demands, reverse=True):
+        if mem > maxMem or procs > maxProcs:
+            logger.warn("Stage requiring %.2fG and %d processors can't run on any executor", mem, procs)
+            continue
+        if firstFit([(mem, procs)], bins):
+            b = Bin(maxMem, maxProcs)
+            b.add(mem, procs)
+            bins.append(b)
+    return [ExecutorShape(quantize(b.used_mem, maxMem), b.used_procs) for b in bins]
+
+class Autoscaler(object):
+    """Decides, each time the server loop runs, which executors to launch and which
+    idle ones to retire.  Demand is first packed into the free capacity of existing
+    (busy, then idle) executors and those launched but not yet registered; the rest
+    determines which new executors are wanted.  A launch or retirement only happens
+    once it has been wanted for `hysteresis` consecutive rounds, so short-lived
+    fluctuations in demand don't cause executors to be started and stopped."""
+    def __init__(self, maxExecutors, maxMem, maxProcs, launch, hysteresis=2):
+        self.maxExecutors = maxExecutors
+        self.maxMem = maxMem
+        self.maxProcs = maxProcs
+        # function called with an ExecutorShape to launch an executor of that shape
+        self.launch = launch
+        self.hysteresis = hysteresis
+        # shapes of launched executors which haven't yet registered
+        self.pending = Counter()
+        # consecutive rounds for which we've wanted new executors of each shape
+        self.wanted_rounds = Counter()
+        # consecutive rounds for which each (idle) client's capacity went unused
+        self.unused_rounds = Counter()
+
+    def registered(self, shape):
+        """an executor we (may have) launched has registered with the server"""
+        if self.pending[shape] > 0:
+            self.pending[shape] -= 1
+
+    def update(self, demands, clients):
+        """demands: (mem, procs) of runnable and soon-to-be-runnable stages;
+        clients: (uri, shape, used_mem, used_procs) of registered executors.
+        Launches executors as needed and returns the URIs of idle ones to retire."""
+        busy = [c for c in clients if c[2] > 0 or c[3] > 0]
+        idle = [c for c in clients if not (c[2] > 0 or c[3] > 0)]
+        bins = []
+        for uri, shape, used_mem, used_procs in busy + idle:
+            b = Bin(shape.mem, shape.procs, key=uri)
+            b.add(used_mem, used_procs)
+            bins.append(b)
+        for shape, n in self.pending.iteritems():
+            bins.extend(Bin(shape.mem, shape.procs) for _ in range(n))
+        unplaced = firstFit(demands, bins)
+
+        wanted = Counter(packDemand(unplaced, self.maxMem, self.maxProcs))
+        for shape in self.wanted_rounds.keys():
+            if shape not in wanted:
+                del self.wanted_rounds[shape]
+        room = self.maxExecutors - len(clients) - sum(self.pending.values())
+        # launch the largest executors first, since they can run anything
+        for shape in sorted(wanted, reverse=True):
+            self.wanted_rounds[shape] += 1
+            if self.wanted_rounds[shape] < self.hysteresis:
+                continue
+            n = min(wanted[shape], room)
+            for _ in range(n):
+                logger.info("Launching executor with %.2fG and %d processors", shape.mem, shape.procs)
+                self.launch(shape)
+                self.pending[shape] += 1
+            room -= n
+            del self.wanted_rounds[shape]
+
+        retire = []
+        unused = set(b.key for b in bins if b.key is not None and b.used_mem == 0 and b.used_procs == 0)
+        for uri in self.unused_rounds.keys():
+            if uri not in unused:
+                del self.unused_rounds[uri]
+        for uri in unused:
+            self.unused_rounds[uri] += 1
+            if self.unused_rounds[uri] >= self.hysteresis:
+                retire.append(uri)
+                del self.unused_rounds[uri]
+        return retire
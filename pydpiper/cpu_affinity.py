@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import ctypes
+import ctypes.util
+import glob
+import logging
+import multiprocessing
+import os
+
+"""Pinning stages' processes to disjoint sets of CPUs (--pin-cpus), taken from
+a single NUMA node where possible, so that multi-threaded stages sharing a node
+neither compete for its cores nor access memory attached to another node"""
+
+logger = logging.getLogger(__name__)
+
+def parseCPUList(s):
+    """'0-3,8' -> [0, 1, 2, 3, 8] (as in /sys and /proc)"""
+    cpus = []
+    for part in s.strip().split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+def allowedCPUs():
+    """the CPUs this process may run on"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("Cpus_allowed_list:"):
+                    return parseCPUList(line.split(":", 1)[1])
+    except IOError:
+        pass
+    return range(multiprocessing.cpu_count())
+
+def numaNodes():
+    """lists of the CPUs in each NUMA node (just one list if this is unknown)"""
+    nodes = []
+    for d in sorted(glob.glob("/sys/devices/system/node/node[0-9]*")):
+        try:
+            with open(os.path.join(d, "cpulist")) as f:
+                nodes.append(parseCPUList(f.read()))
+        except IOError:
+            pass
+    return nodes or [range(multiprocessing.cpu_count())]
+
+def setAffinity(cpus):
+    """restrict the calling process (and the threads and processes it starts later)
+    to the given CPUs (as os.sched_setaffinity, which Python 2 lacks)"""
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * (1024 // bits))()
+    for c in cpus:
+        mask[c // bits] |= 1 << (c % bits)
+    if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+class CPUAllocator(object):
+    """Keeps track of which of an executor's CPUs are in use by its stages"""
+    def __init__(self):
+        allowed = set(allowedCPUs())
+        self.nodes = [[c for c in node if c in allowed] for node in numaNodes()]
+        self.nodes = [node for node in self.nodes if node] or [sorted(allowed)]
+        self.free = allowed
+
+    def allocate(self, n):
+        """Take n free CPUs, all from the same NUMA node if possible (that with the
+        fewest free CPUs which suffices, keeping larger blocks for larger stages),
+        or return None if there aren't n free"""
+        n = int(n)
+        if n < 1 or n > len(self.free):
+            return None
+        free_by_node = [[c for c in node if c in self.free] for node in self.nodes]
+        sufficient = [f for f in free_by_node if len(f) >= n]
+        if sufficient:
+            cpus = min(sufficient, key=len)[:n]
+        else:
+            # spread over as few nodes as possible
+            cpus = []
+            for f in sorted(free_by_node, key=len, reverse=True):
+                cpus.extend(f[:n - len(cpus)])
+        self.free.difference_update(cpus)
+        return cpus
+
+    def release(self, cpus):
+        if cpus:
+            self.free.update(cpus)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+from pipes import quote
+from resources import parseResources
+from queueing import queueBackend
+import networkx as nx
+import logging
+import os
+import subprocess
+import sys
+import time
+
+"""Running a pipeline by submitting each stage (or chain of stages) as its own
+SGE, PBS or SLURM job, with job dependencies mirroring those between stages,
+instead of via a server and executors.  Suited to pipelines of few but long stages.
+
+Since every job is submitted up front, the memory requested for a stage whose
+requirement is computed from its inputs (by its runnable_hooks, e.g., mincANTS,
+minctracc and mincblur) is computed only if those inputs already exist; others
+get their default (--default-job-mem) unless their program is given one with
+--stage-mem."""
+
+logger = logging.getLogger(__name__)
+
+# seconds between checks for newly completed jobs
+POLL_INTERVAL = 10
+
+# a job no longer in the queue but which hasn't recorded the status of its stages
+# (e.g., killed by the queueing system for exceeding its limits) is presumed lost
+# once it has been missing for this many checks (allowing for delays in seeing
+# its status files on a network file system)
+MISSING_CHECKS = 2
+
+# written to a stage's status file (in place of an exit code) if the stage
+# wasn't run since a stage it depends on failed
+SKIPPED = "skipped"
+
+class DirectSubmission(object):
+    def __init__(self, pipeline, options):
+        self.p = pipeline
+        self.options = options
+        self.backend = queueBackend(options)
+        if self.backend is None:
+            raise ValueError("Submitting stages as jobs requires a queueing system (--queue-type)")
+        self.jobDir = os.path.abspath(os.path.join(os.curdir, options.pipeline_name + "-stage-jobs"))
+        self.statusDir = os.path.join(self.jobDir, "status")
+        self.stage_mem = parseResources(options.stage_mem) if options.stage_mem else {}
+        # the submitted units, their job IDs (by their first stage), and how many checks
+        # each unfinished one has been missing from the queue for
+        self.units = []
+        self.jobIDs = {}
+        self.missing = {}
+        for d in [self.jobDir, self.statusDir]:
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+    def statusFile(self, i):
+        return os.path.join(self.statusDir, str(i))
+
+    def jobName(self, unit):
+        return "%s-%d" % (self.options.pipeline_name, unit[0])
+
+    def stageMem(self, i):
+        """the memory to request for stage i: as given by --stage-mem for its program,
+        or as computed by its hooks where the inputs they look at already exist"""
+        s = self.p.stages[i]
+        if s.getTool() in self.stage_mem:
+            return self.stage_mem[s.getTool()]
+        if s.runnable_hooks and all(os.path.exists(f) for f in s.inputFiles):
+            for f in s.runnable_hooks:
+                f()
+        return s.mem
+
+    def computeUnits(self):
+        """Group the stages still to be run into jobs, in dependency order.  With
+        --fuse-chains, a stage whose only remaining predecessor has no other remaining
+        successor runs in the same job as that predecessor, saving a job submission."""
+        todo = set(i for i in xrange(len(self.p.stages))
+                   if not self.p.stages[i].isFinished() and i not in self.p.excluded_stages)
+        units = []
+        unit_of = {}
+        for i in nx.topological_sort(self.p.G):
+            if i not in todo:
+                continue
+            preds = [k for k in self.p.G.predecessors(i) if k in todo]
+            if (self.options.fuse_chains and len(preds) == 1
+                and len([j for j in self.p.G.successors(preds[0]) if j in todo]) == 1):
+                unit = unit_of[preds[0]]
+                unit.append(i)
+            else:
+                unit = [i]
+                units.append(unit)
+            unit_of[i] = unit
+        return units, unit_of
+
+    def jobScript(self, unit, unit_of):
+        """a script running the unit's stages in turn, recording each one's exit status;
+        if a stage it depends on failed, it records its stages as skipped instead"""
+        first = unit[0]
+        preds = [k for k in self.p.G.predecessors(first) if k in unit_of]
+        lines = ["#!/bin/bash", "cd %s" % quote(os.getcwd())]
+        for k in preds:
+            lines.append('if [ "$(cat %s 2>/dev/null)" != 0 ]; then' % quote(self.statusFile(k)))
+            lines.extend("  echo %s > %s" % (SKIPPED, quote(self.statusFile(i))) for i in unit)
+            lines.append("  exit 1")
+            lines.append("fi")
+        for i in unit:
+            s = self.p.stages[i]
+            logfile = s.logFile or os.path.join(self.jobDir, "stage-%d.log" % i)
+            status = self.statusFile(i)
+            lines.append("echo \"Stage %d running on $(hostname) at $(date)\" >> %s" % (i, quote(logfile)))
+            lines.append("echo %s >> %s" % (quote(repr(s)), quote(logfile)))
+            lines.append("%s >> %s 2>&1" % (repr(s), quote(logfile)))
+            lines.append("r=$?")
+            lines.append("echo $r > %s.tmp && mv %s.tmp %s" % ((quote(status),) * 3))
+            lines.append('[ "$r" = 0 ] || exit $r')
+        filename = os.path.join(self.jobDir, self.jobName(unit) + ".sh")
+        with open(filename, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        return filename
+
+    def submitCommand(self, unit, unit_of, script):
+        """the shell command submitting a unit, requesting the largest memory and
+        processor requirements of its stages, and holding it until its predecessors finish"""
+        mem   = max(self.stageMem(i) for i in unit)
+        procs = max(self.p.stages[i].procs for i in unit)
+        name  = self.jobName(unit)
+        pred_units = []
+        for k in self.p.G.predecessors(unit[0]):
+            if k in unit_of and unit_of[k] not in pred_units:
+                pred_units.append(unit_of[k])
+        # dependencies are by job ID (rather than by name, which jobs left over from
+        # a previous run may share), which we capture in shell variables as we go
+        cmd = self.backend.stageJobCommand(name, os.path.join(self.jobDir, name + ".log"), mem, procs,
+                                           script, ["$J%d" % u[0] for u in pred_units])
+        return "J%d=$(%s) || exit 1" % (unit[0], cmd)
+
+    def submit(self):
+        """submit all remaining stages with a single batch script (rather than a
+        process per qsub call); returns the units submitted"""
+        units, unit_of = self.computeUnits()
+        # status files left by a previous run's jobs would be taken for those of this one's
+        for unit in units:
+            for i in unit:
+                if os.path.exists(self.statusFile(i)):
+                    os.remove(self.statusFile(i))
+        # (so that a failed submission piped through another command stops the script)
+        lines = ["#!/bin/bash", "set -o pipefail"]
+        for unit in units:
+            script = self.jobScript(unit, unit_of)
+            lines.append(self.submitCommand(unit, unit_of, script))
+            lines.append("echo %d $J%d" % (unit[0], unit[0]))
+        batch = os.path.join(self.jobDir, "submit-%s.sh" % time.strftime("%Y%m%d-%H%M%S"))
+        with open(batch, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        logger.info("Submitting %d jobs for %d stages", len(units), sum(len(u) for u in units))
+        out = subprocess.check_output(["bash", batch])
+        logger.debug("Job IDs:\n%s", out)
+        for line in out.splitlines():
+            first, _, jobID = line.strip().partition(" ")
+            if jobID:
+                self.jobIDs[int(first)] = jobID
+        self.units = units
+        return units
+
+    def queuedJobs(self):
+        """the (numeric parts of the) IDs of the jobs in the queue and not yet
+        completed, or None if the queue can't be listed"""
+        try:
+            return self.backend.queuedJobs()
+        except (OSError, subprocess.CalledProcessError):
+            logger.warning("Unable to list the queue's jobs")
+            return None
+
+    def stageFailed(self, i):
+        self.p.stages[i].setFailed()
+        print("\nERROR in Stage %d: %s" % (i, self.p.stages[i]))
+        print("Logfile for (potentially) more information:\n%s\n" % self.p.stages[i].logFile)
+        sys.stdout.flush()
+        self.p.failedStages.append(i)
+        descendants = nx.descendants(self.p.G, i)
+        for j in descendants:
+            self.p.failedStages.append(j)
+        self.cancelJobs([u for u in self.units if u[0] in descendants])
+
+    def cancelJobs(self, units):
+        """remove the (still queued) jobs of units which can no longer succeed; otherwise
+        those held until their predecessors succeed (PBS, SLURM) would remain queued"""
+        for unit in units:
+            jobID = self.jobIDs.get(unit[0])
+            if jobID is None:
+                continue
+            try:
+                self.backend.cancel(jobID)
+            except (OSError, subprocess.CalledProcessError):
+                # (most likely, it has already finished)
+                logger.debug("Unable to cancel job %s (stages %s)", jobID, unit, exc_info=True)
+            else:
+                logger.info("Cancelled job %s (stages %s)", jobID, unit)
+
+    def checkStatus(self, units, done):
+        """record the stages whose jobs have finished since the last check in the
+        finished stages journal (or as failed); returns True once no more stages
+        can finish, i.e., each has finished, failed, or depends on a failed stage;
+        a stage whose job has left the queue without recording its status has failed"""
+        # (listed before reading status files, since a job writes them before leaving)
+        queued = self.queuedJobs() if self.jobIDs else None
+        for unit in units:
+            for i in unit:
+                if i in done or i in self.p.failedStages:
+                    continue
+                try:
+                    with open(self.statusFile(i)) as f:
+                        status = f.read().strip()
+                except IOError:
+                    jobID = self.jobIDs.get(unit[0])
+                    if queued is not None and jobID is not None and jobID.split(".")[0] not in queued:
+                        self.missing[unit[0]] = self.missing.get(unit[0], 0) + 1
+                        if self.missing[unit[0]] >= MISSING_CHECKS:
+                            logger.error("Job %s (stages %s) has left the queue without finishing "
+                                         "(killed by the queueing system?)", jobID, unit)
+                            self.stageFailed(i)
+                    break
+                done.add(i)
+                if status == "0":
+                    self.p.setStageFinished(i, "direct-submission", checking_pipeline_status = True)
+                elif status != SKIPPED:
+                    self.stageFailed(i)
+        failed = set(self.p.failedStages)
+        return all(i in done or i in failed for unit in units for i in unit)
+
+    def run(self):
+        units = self.submit()
+        done = set()
+        while not self.checkStatus(units, done):
+            time.sleep(POLL_INTERVAL)
+        if self.p.failedStages:
+            print("Not all pipeline stages have been processed.\nPipeline failed...")
+        else:
+            print("All pipeline stages have been processed.\nPipeline finished successfully!")
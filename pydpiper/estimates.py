@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+from collections import deque
+import json
+import os
+
+"""Estimates of how long pipeline stages take to run (and corrections to how
+much memory they need), keyed by the tool a stage runs"""
+
+# rough runtimes (in seconds) of commonly used tools on a typical input;
+# these are only used to tell short stages from long ones, so need only
+# be right to within an order of magnitude
+DEFAULT_RUNTIMES = {
+    "ln"            : 0.1,
+    "xfmconcat"     : 1,
+    "xfminvert"     : 1,
+    "xfmavg"        : 1,
+    "mincmath"      : 2,
+    "mincpik"       : 5,
+    "autocrop"      : 10,
+    "mincblur"      : 30,
+    "mincresample"  : 60,
+    "mincblob"      : 60,
+    "minc_displacement" : 60,
+    "inormalize"    : 60,
+    "mincaverage"   : 120,
+    "pmincaverage"  : 120,
+    "smooth_vector" : 120,
+    "voxel_vote"    : 300,
+    "nu_estimate"   : 300,
+    "nu_evaluate"   : 60,
+    "minctracc"     : 600,
+    "rotational_minctracc.py" : 1800,
+    "mincANTS"      : 4 * 3600,
+}
+
+# assumed for tools not listed above
+DEFAULT_RUNTIME = 600
+
+# number of recent observations per tool used to compute learned estimates
+HISTORY_LENGTH = 101
+
+class RuntimeEstimates(object):
+    """Static per-tool runtime defaults, superseded by the median of observed
+    runtimes once stages running the tool have completed"""
+    def __init__(self, defaults=DEFAULT_RUNTIMES):
+        self.defaults = defaults
+        self.observed = {}
+        # cache of medians, since these are consulted on every dispatch
+        self.medians = {}
+    def record(self, tool, seconds):
+        if tool not in self.observed:
+            self.observed[tool] = deque(maxlen=HISTORY_LENGTH)
+        self.observed[tool].append(seconds)
+        self.medians.pop(tool, None)
+    def numberObserved(self, tool):
+        return len(self.observed.get(tool, ()))
+    def median(self, tool):
+        """median of observed runtimes, or None if none have been observed"""
+        if tool not in self.medians:
+            obs = sorted(self.observed.get(tool, ()))
+            self.medians[tool] = obs[len(obs) // 2] if obs else None
+        return self.medians[tool]
+    def estimate(self, tool):
+        m = self.median(tool)
+        return m if m is not None else self.defaults.get(tool, DEFAULT_RUNTIME)
+
+class MemoryCorrections(object):
+    """Factors by which stages running a tool were found to need more memory than
+    they requested (learned from stages killed for running out of it), saved to
+    a file, if given, so later runs of the pipeline request enough from the start"""
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.factors = {}
+        if filename is not None and os.path.exists(filename):
+            with open(filename) as f:
+                self.factors = json.load(f)
+    def factor(self, tool):
+        return self.factors.get(tool, 1.0)
+    def record(self, tool, factor):
+        if factor > self.factor(tool):
+            self.factors[tool] = factor
+            self.save()
+    def save(self):
+        if self.filename is not None:
+            tmp = self.filename + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump(self.factors, f)
+            os.rename(tmp, self.filename)
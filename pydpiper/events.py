@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import json
+import logging
+import os
+import Queue
+import threading
+import time
+
+"""A journal of the server's scheduling activity (--event-journal), for
+analyzing a run afterwards (e.g., with status.py) without parsing its log.
+Each event is a JSON object on a line of its own, such as
+
+  {"event":"start","stage":17,"executor":"PYRO:obj_...@10.0.0.5:41234","t":1449163323.417}
+
+giving its kind, the time it occurred and other fields depending on the kind:
+
+  dispatch    stage, executor, how ("run_stage", "run_batch", "lease", ...),
+              resources (the stage's requirements, including mem and procs)
+  start       stage, executor
+  finish      stage, executor, runtime (seconds)
+  fail        stage, executor, cause (if known, e.g., "timeout")
+  retry       stage, executor, cause, retries (so far), and mem if increased
+  lost        stage, executor
+  register    executor, mem, procs
+  unregister  executor
+
+Events are encoded and written by a background thread, so recording one costs
+the server little more than putting it on a queue."""
+
+logger = logging.getLogger(__name__)
+
+class EventJournal(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.queue = None
+        self.pid = None
+
+    def start(self):
+        # (started on the first event in the process recording them, since the
+        # server's Pyro daemon runs in a process forked after the pipeline is
+        # created, and threads don't survive a fork)
+        self.queue = Queue.Queue()
+        self.pid = os.getpid()
+        writer = threading.Thread(target=self.write, name="event-journal")
+        writer.daemon = True
+        writer.start()
+
+    def record(self, event, **fields):
+        if self.pid != os.getpid():
+            self.start()
+        fields["event"] = event
+        fields["t"] = round(time.time(), 3)
+        self.queue.put(fields)
+
+    def write(self):
+        f, failed = None, False
+        while True:
+            fields = self.queue.get()
+            try:
+                if not failed:
+                    if f is None:
+                        f = open(self.filename, 'a')
+                    f.write(json.dumps(fields, separators=(",", ":")) + "\n")
+                    if self.queue.empty():
+                        f.flush()
+            except (IOError, OSError):
+                logger.exception("Unable to write event journal %s; no more events will be recorded", self.filename)
+                failed = True
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """wait until the events recorded so far have been written"""
+        if self.queue is not None and self.pid == os.getpid():
+            self.queue.join()
+
+def readEvents(filename):
+    """the events in a journal, as dicts"""
+    with open(filename) as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                pass  # (the last line, partly written when the server was killed)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import logging
+
+"""Sharing executors fairly between several (logically independent) pipelines
+run by one server: each pipeline's stages form a share, and the next stage to
+be dispatched comes from the runnable share which has so far received the
+least (estimated) processor time relative to its weight."""
+
+logger = logging.getLogger(__name__)
+
+class Share(object):
+    def __init__(self, name, weight=1.0):
+        self.name = name
+        self.weight = float(weight)
+        # processor-seconds charged to this share, divided by its weight
+        self.vtime = 0.0
+        self.runnable = set()
+        # number of stages in the share, for numbering them within it
+        self.size = 0
+        # finished stages journal for this share alone (opened by the Pipeline)
+        self.journal_fh = None
+
+class FairShareSet(object):
+    """The set of runnable stages, partitioned into shares.  Supports the set
+    operations used on Pipeline.runnable; pop() chooses the stage fairly.
+    Stages not assigned to any share belong to a default share (named None)."""
+    def __init__(self):
+        self.shares = { None : Share(None) }
+        # stage index -> share name, and index within that share
+        self.share_of = {}
+        self.local_index = {}
+
+    def addShare(self, name, weight=1.0):
+        if name not in self.shares:
+            self.shares[name] = Share(name, weight)
+        return self.shares[name]
+
+    def assign(self, i, name):
+        """put stage i in the named share; returns its index within the share"""
+        self.share_of[i] = name
+        share = self.shares[name]
+        self.local_index[i] = share.size
+        share.size += 1
+        return self.local_index[i]
+
+    def shareOf(self, i):
+        return self.shares[self.share_of.get(i)]
+
+    def stageId(self, i):
+        name = self.share_of.get(i)
+        return str(i) if name is None else "%d (%s:%d)" % (i, name, self.local_index[i])
+
+    def charge(self, i, cost):
+        """account for a stage of the given cost (e.g., processor-seconds) being started"""
+        share = self.shareOf(i)
+        share.vtime += cost / share.weight
+
+    def add(self, i):
+        share = self.shareOf(i)
+        if not share.runnable:
+            # a share which had nothing to run doesn't bank credit meanwhile: bring
+            # it up to the least virtual time of those which did, so it doesn't
+            # then monopolize the executors until it catches up
+            active = [s.vtime for s in self.shares.itervalues() if s.runnable]
+            if active:
+                share.vtime = max(share.vtime, min(active))
+        share.runnable.add(i)
+
+    def remove(self, i):
+        self.shareOf(i).runnable.remove(i)
+
+    def discard(self, i):
+        self.shareOf(i).runnable.discard(i)
+
+    def pop(self):
+        active = [s for s in self.shares.itervalues() if s.runnable]
+        if not active:
+            raise KeyError('pop from an empty set')
+        share = min(active, key=lambda s: s.vtime)
+        return share.runnable.pop()
+
+    def __len__(self):
+        return sum(len(s.runnable) for s in self.shares.itervalues())
+
+    def __iter__(self):
+        for s in self.shares.values():
+            for i in list(s.runnable):
+                yield i
+
+    def __contains__(self, i):
+        return i in self.shareOf(i).runnable
+
+    def __eq__(self, other):
+        return set(self) == set(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "FairShareSet(%s)" % sorted(self)
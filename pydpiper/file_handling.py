@@ -2,10 +2,17 @@
 
 from __future__ import print_function
 from os.path import basename, isdir, splitext, abspath, join
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+import hashlib
+import logging
+import threading
 import os
 
 """File handling methods for creating subdirectories/base file names as needed"""
 
+logger = logging.getLogger(__name__)
+
 existing_dirs = set()
 
 cached_cwd = os.getcwd()
@@ -66,3 +73,115 @@ def makeIgnoreExisting(dirname, f, test):
             print("Could not create directory " + str(dirname))
             raise
     return newDir
+
+def outputPosition(arg, outputFiles):
+    """If a command argument names one of a stage's outputs, returns a pair of
+    the output's position and whether the argument is the full filename (as
+    opposed to a prefix such as the base given to mincblur); otherwise None"""
+    for k, o in enumerate(outputFiles):
+        if arg == o:
+            return (k, True)
+        elif arg and o.startswith(arg) and os.path.dirname(arg) == os.path.dirname(o) \
+             and os.path.dirname(arg) != '':
+            return (k, False)
+    return None
+def _mapChunked(f, filenames, threads, chunksize):
+    """apply f to each filename using a pool of threads, returning a dict.
+    Filenames are handed to the threads in chunks to keep overhead down."""
+    filenames = list(filenames)
+    chunks = [filenames[i:i+chunksize] for i in xrange(0, len(filenames), chunksize)]
+    pool = ThreadPool(threads)
+    try:
+        return dict(r for rs in pool.map(lambda c: [(fn, f(fn)) for fn in c], chunks) for r in rs)
+    finally:
+        pool.close()
+def _statOrNone(filename):
+    try:
+        st = os.stat(filename)
+        return (st.st_mtime, st.st_size)
+    except OSError:
+        return None
+def statFiles(filenames, threads=32, chunksize=256):
+    """returns a dict of filename -> (mtime, size), or None if the file doesn't exist.
+    The stats are done in parallel since each one may be a round trip on NFS"""
+    return _mapChunked(_statOrNone, filenames, threads, chunksize)
+def fileDigest(filename, blocksize=2**20):
+    """sha1 of a file's contents"""
+    h = hashlib.sha1()
+    with open(filename, 'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+def _digestOrNone(filename):
+    try:
+        return fileDigest(filename)
+    except (IOError, OSError):
+        return None
+def digestFiles(filenames, threads=8, chunksize=16):
+    """returns a dict of filename -> digest, or None if the file can't be read"""
+    return _mapChunked(_digestOrNone, filenames, threads, chunksize)
+def readDigests(filename):
+    """read a file written by DigestRecorder into a dict of key -> { filename : digest }"""
+    digests = {}
+    with open(filename, 'r') as fh:
+        for l in fh:
+            key, rest = l.rstrip('\n').split(',', 1)
+            f, digest = rest.rsplit(',', 1)
+            digests.setdefault(key, {})[f] = digest
+    return digests
+def readJournalHashes(filename):
+    """the stage hashes in a finished stages journal of "index,hash" lines
+    (none if the journal doesn't exist)"""
+    try:
+        with open(filename, 'r') as fh:
+            return frozenset(int(l.split(',')[1]) for l in fh.read().split())
+    except IOError:
+        return frozenset()
+
+class DigestRecorder(object):
+    """Appends "key,filename,digest" lines to a file.  The digests are computed
+    in a background thread so that callers aren't held up reading files, and
+    remembered while a file's mtime and size don't change, since many stages
+    may share an input (e.g., a template)."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.queue = None
+        # filename -> ((mtime, size), digest)
+        self.digests = {}
+    def record(self, key, filenames):
+        if self.queue is None:
+            # started lazily since the server forks after the pipeline is
+            # constructed and threads don't survive a fork
+            self.queue = Queue()
+            t = threading.Thread(target=self._write)
+            t.daemon = True
+            t.start()
+        self.queue.put((key, filenames))
+    def flush(self):
+        """wait for the digests recorded so far to be written (since the thread
+        writing them won't keep the process alive)"""
+        if self.queue is not None:
+            self.queue.join()
+    def _digest(self, filename):
+        stamp = _statOrNone(filename)
+        if stamp is None:
+            return None
+        memo = self.digests.get(filename)
+        if memo is not None and memo[0] == stamp:
+            return memo[1]
+        digest = _digestOrNone(filename)
+        if digest is not None:
+            self.digests[filename] = (stamp, digest)
+        return digest
+    def _write(self):
+        with open(self.filename, 'a') as fh:
+            while True:
+                key, filenames = self.queue.get()
+                for f in filenames:
+                    digest = self._digest(f)
+                    if digest is None:
+                        logger.warn("Couldn't compute digest of %s", f)
+                    else:
+                        fh.write("%s,%s,%s\n" % (key, f, digest))
+                fh.flush()
+                self.queue.task_done()
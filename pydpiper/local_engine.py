@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+from result_cache import ResultCache
+from memory_limits import MemoryLimiter
+from pipeline_executor import executeStage
+import resources
+import logging
+import os
+import Queue
+import signal
+import threading
+import time
+
+"""Running a pipeline on a single machine (--local-fast) by driving the
+Pipeline object directly from a loop in this process, rather than via a Pyro
+server, executor processes and the network calls between them."""
+
+logger = logging.getLogger(__name__)
+
+# the name under which stages are recorded as running (in place of an executor's URI)
+CLIENT = "local"
+
+class LocalEngine(object):
+    """Runs stages as subprocesses, as many at a time as fit in --mem, --proc
+    and --executor-resources (and --resource-pools).
+    Each subprocess is run (by a thread of its own) as an executor would run it,
+    i.e., with its timeout and memory limit (--enforce-memory) applied and its
+    failure classified for retrying; each time one exits, its stage is marked
+    finished (or failed) and newly runnable stages are started straight away."""
+    def __init__(self, pipeline, options):
+        self.p = pipeline
+        self.mem = options.mem
+        self.procs = options.proc
+        self.result_cache = (ResultCache(options.result_cache_dir, options.result_cache_size)
+                             if options.result_cache_dir else None)
+        self.memory_limiter = (MemoryLimiter(options.enforce_memory, options.memory_slack)
+                               if options.enforce_memory else None)
+        # (index, exit status or cause of failure) of stages as they finish
+        self.results = Queue.Queue()
+        # stage index -> (mem, procs, resources) of the stages running, and the pids of their processes
+        self.running = {}
+        self.pids = set()
+        self.used_mem = 0.0
+        self.used_procs = 0
+        self.resources = options.executor_resources or {}
+        self.used_resources = {}
+
+    # (called by runProcess, in place of an executor's)
+    def addPIDtoRunningList(self, pid, i=None):
+        self.pids.add(pid)
+
+    def removePIDfromRunningList(self, pid):
+        self.pids.discard(pid)
+
+    def runStage(self, i, command, logfile, files, timeout, mem, procs):
+        ret = None
+        try:
+            ret = executeStage(self, i, command, logfile or os.devnull, files, self.result_cache,
+                               timeout, mem, self.memory_limiter, procs)
+        except:
+            logger.exception("Exception whilst running stage %i", i)
+        self.results.put((i, ret))
+
+    def startStage(self, i):
+        self.p.setStageStarted(i, CLIENT)
+        mem = self.p.getStageMem(i)
+        procs = self.p.getStageProcs(i)
+        need = self.p.getStageResources(i)
+        files = self.p.getStageFiles(i) if self.result_cache is not None else None
+        t = threading.Thread(target=self.runStage,
+                             args=(i, self.p.getStageCommand(i), self.p.getStageLogfile(i), files,
+                                   self.p.getStageTimeout(i), mem, procs))
+        t.daemon = True
+        self.running[i] = (mem, procs, need)
+        self.used_mem += mem
+        self.used_procs += procs
+        self.used_resources = resources.total(self.used_resources, need)
+        t.start()
+
+    def startRunnable(self):
+        """start runnable stages, longest first, until no more fit"""
+        while not self.p.allStagesCompleted():
+            free = self.p.freeResources(self.mem - self.used_mem, self.procs - self.used_procs,
+                                        resources.remaining(self.resources, self.used_resources))
+            i = self.p.backfillStage(None, free)
+            if i is None:
+                return
+            self.p.grantProcs(i, free)
+            self.startStage(i)
+
+    def waitForStage(self):
+        """wait for any running stage to exit and record its result, or until
+        a stage which timed out is due to be retried"""
+        # (always with a timeout, since an untimed get can't be interrupted)
+        timeout = max(0, self.p.retry_at[0][0] - time.time()) if self.p.retry_at else 3600
+        try:
+            i, ret = self.results.get(timeout=timeout)
+        except Queue.Empty:
+            return
+        mem, procs, need = self.running.pop(i)
+        self.used_mem -= mem
+        self.used_procs -= procs
+        self.used_resources = resources.remaining(self.used_resources, need)
+        logger.info("Stage %i finished, return was: %s", i, ret)
+        if ret == 0:
+            self.p.setStageFinished(i, CLIENT)
+        else:
+            # (ret may give the cause, e.g., a timeout, for setStageFailed to act on)
+            self.p.setStageFailed(i, CLIENT, ret)
+
+    def run(self):
+        self.p.printNumberProcessedStages()
+        self.p.registerClient(CLIENT, self.mem, None, self.procs)
+        try:
+            while True:
+                self.p.requeueTimedOut()
+                self.startRunnable()
+                if not self.running and not self.p.retry_at:
+                    break
+                self.waitForStage()
+        except:
+            logger.exception("Exception (=> killing running stages): ")
+            for pid in list(self.pids):
+                try:
+                    os.killpg(pid, signal.SIGKILL)
+                except OSError:
+                    pass  # (just exited)
+            raise
+        if self.p.runnable and not self.p.allStagesCompleted():
+            msg = ("Stages requiring more memory or processors (%s) than available (--mem=%.2fG, --proc=%d) "
+                   "can't be run." % (", ".join("stage %d: %.2fG, %d" % (i, self.p.getStageMem(i), self.p.getStageProcs(i))
+                                               for i in sorted(self.p.runnable)), self.mem, self.procs))
+            print(msg)
+            logger.warn(msg)
+        self.p.printShutdownMessage()
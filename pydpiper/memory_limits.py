@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import logging
+import os
+import resource
+
+"""Enforcing stages' memory requirements (--enforce-memory), so that a stage
+using far more memory than it asked for fails on its own, rather than causing
+the kernel to kill other stages on its node (or the executor).  Each stage is
+either run with a resource limit on its data segment, or, where the executor
+may create cgroups (e.g., under a batch system's or systemd's delegation), in
+a cgroup (v2) of its own with a memory limit, which also detects violations
+exactly."""
+
+logger = logging.getLogger(__name__)
+
+# a stage under a resource limit which fails after its peak RSS has reached this
+# fraction of the limit is presumed to have been stopped by it (an allocation which
+# would have exceeded it having failed)
+LIMIT_RSS_FRACTION = 0.9
+
+def setupCgroups():
+    """Prepare to run stages in cgroups of their own, returning the cgroup v2
+    directory in which to create them, or None if this isn't possible"""
+    try:
+        with open("/proc/self/cgroup") as f:
+            paths = [l.strip().split(":", 2)[2] for l in f if l.startswith("0::")]
+        if not paths:
+            return None
+        base = "/sys/fs/cgroup" + paths[0]
+        # only leaves of the hierarchy may contain processes once controllers are
+        # enabled for their children, so move those in our cgroup (including us,
+        # hence the processes we start later) into a leaf
+        leaf = os.path.join(base, "executor")
+        if not os.path.isdir(leaf):
+            os.mkdir(leaf)
+        with open(os.path.join(base, "cgroup.procs")) as f:
+            pids = f.read().split()
+        for pid in pids:
+            try:
+                with open(os.path.join(leaf, "cgroup.procs"), 'w') as f:
+                    f.write(pid)
+            except (IOError, OSError):
+                pass  # (exited, or not ours to move)
+        with open(os.path.join(base, "cgroup.subtree_control"), 'w') as f:
+            f.write("+memory")
+        return base
+    except (IOError, OSError) as e:
+        logger.info("Can't create cgroups to enforce stages' memory limits (%s)", e)
+        return None
+
+class MemoryLimiter(object):
+    """Applies memory limits of `slack` times their requirements to stages'
+    processes.  Created by the executor (before it starts its worker processes)
+    and passed to them with the stages to run."""
+    def __init__(self, mode, slack):
+        self.slack = slack
+        self.cgroup_base = setupCgroups() if mode == "cgroup" else None
+        if mode == "cgroup" and self.cgroup_base is None:
+            logger.warn("Unable to use cgroups to enforce memory limits; using resource limits instead")
+
+    def limit(self, mem):
+        """the limit (in bytes) for a stage requiring mem GB"""
+        return int(mem * self.slack * 1024 ** 3)
+
+    def createCgroup(self, i, mem):
+        """a new cgroup (its directory) in which to run stage i, or None for a resource limit"""
+        if self.cgroup_base is None:
+            return None
+        cgroup = os.path.join(self.cgroup_base, "stage_%d_%d" % (i, os.getpid()))
+        try:
+            if not os.path.isdir(cgroup):
+                os.mkdir(cgroup)
+            with open(os.path.join(cgroup, "memory.max"), 'w') as f:
+                f.write(str(self.limit(mem)))
+        except (IOError, OSError):
+            logger.exception("Unable to create cgroup %s; using a resource limit instead", cgroup)
+            return None
+        try:
+            # otherwise the stage may carry on in swap
+            with open(os.path.join(cgroup, "memory.swap.max"), 'w') as f:
+                f.write("0")
+        except (IOError, OSError):
+            pass  # (no swap accounting)
+        return cgroup
+
+    def apply(self, mem, cgroup):
+        """(called in the stage's process before running the command)"""
+        if cgroup is not None:
+            with open(os.path.join(cgroup, "cgroup.procs"), 'w') as f:
+                f.write(str(os.getpid()))
+        else:
+            # (since Linux 4.7, the data segment includes private writable mappings,
+            # as used by malloc for large allocations, but unlike the address space
+            # (RLIMIT_AS) it excludes mappings of files such as shared libraries)
+            limit = self.limit(mem)
+            resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+
+    def exceeded(self, mem, cgroup, returncode, maxrss):
+        """whether a stage which exited so (with peak RSS in KB) exceeded its limit"""
+        if returncode == 0:
+            return False
+        if cgroup is not None:
+            try:
+                with open(os.path.join(cgroup, "memory.events")) as f:
+                    return any(l.startswith("oom_kill ") and int(l.split()[1]) > 0 for l in f)
+            except (IOError, ValueError):
+                return False
+        # a resource limit makes allocations fail, which a stage may report in any way,
+        # so presume one which failed after using nearly all of it was stopped by it
+        return maxrss * 1024 >= LIMIT_RSS_FRACTION * self.limit(mem)
+
+    def removeCgroup(self, cgroup):
+        if cgroup is not None:
+            try:
+                os.rmdir(cgroup)
+            except OSError:
+                logger.warn("Unable to remove cgroup %s (still in use?)", cgroup)
@@ -8,11 +8,17 @@ import sys
 import signal
 import socket
 import time
-import re
+import fnmatch
+import types
+import copy_reg
+import cPickle as pickle
+import json
+import heapq
 import resource
 from datetime import datetime
-from subprocess import call, check_output
+from subprocess import call
 from shlex import split
+from pipes import quote
 from multiprocessing import Process, Event
 import logging
 
@@ -23,11 +29,31 @@ os.environ["PYRO_LOGFILE"]  = os.path.splitext(os.path.basename(__file__))[0] +
 
 import Pyro4
 import pipeline_executor as pe
+import queueing
+import file_handling as fh
+from estimates import RuntimeEstimates, MemoryCorrections
+from autoscaling import Autoscaler, ExecutorShape
+from direct_submission import DirectSubmission
+from local_engine import LocalEngine
+from fair_share import FairShareSet
+from events import EventJournal
+import speculation
+import resources
 
 Pyro4.config.SERVERTYPE = pe.Pyro4.config.SERVERTYPE
 
 LOOP_INTERVAL = 5
+# how many runnable stages too big for a node agent's free resources to set
+# aside while filling its lease, before giving up
+LEASE_PROBES = 20
 STAGE_RETRY_INTERVAL = 1
+# a stage which timed out is retried after this many seconds (doubling each time)
+TIMEOUT_RETRY_BACKOFF = 30
+# the least time limit given by --stage-timeout-factor, so that stages of tools
+# which usually run very quickly aren't killed due to a brief delay
+MIN_STAGE_TIMEOUT = 600
+# factor by which the memory given to a stage which ran out of it is increased
+OOM_MEMORY_GROWTH = 2.0
 SUBDEBUG = 5
 
 logger = logging.getLogger(__name__)
@@ -64,16 +90,29 @@ class LogFile(PipelineFile):
     it's still alive (based on a periodic heartbeat)
     """
 class ExecClient(object):
-    def __init__(self, client, maxmemory):
+    def __init__(self, client, maxmemory, maxprocs=None):
         self.clientURI = client
         self.maxmemory = maxmemory
+        self.maxprocs = maxprocs
         self.running_stages = set([])
         self.timestamp = time.time()
+        # when the client's walltime runs out (by the server's clock), if known
+        self.end_time = None
+    def setTimeLeft(self, timeLeft):
+        self.end_time = time.time() + timeLeft if timeLeft is not None else None
+    def timeLeft(self):
+        return self.end_time - time.time() if self.end_time is not None else None
 
 class PipelineStage(object):
     def __init__(self):
         self.mem = None # if not set, use pipeline default
         self.procs = 1 # default number of processors per stage
+        # for a stage able to use a varying number of processors (threads), the
+        # range of this number; procs is then that given to the stage when run
+        self.min_procs = None
+        self.max_procs = None
+        # amounts of other named resources (e.g., 'io_tokens') required; see resources.py
+        self.resources = {}
         self.inputFiles = [] # the input files for this stage
         self.outputFiles = [] # the output files for this stage
         self.logFile = None
@@ -81,6 +120,27 @@ class PipelineStage(object):
         self.name = ""
         self.colour = "black" # used when a graph is created of all stages to colour the nodes
         self.number_retries = 0 
+        # subsets of inputFiles/outputFiles which are read/written strictly
+        # sequentially, so may be replaced by a named pipe (see --stream-intermediates)
+        self.streamableInputs = set()
+        self.streamableOutputs = set()
+        # whether results may be taken from (and put in) the --result-cache-dir;
+        # stages with effects beyond their declared outputs should unset this
+        self.cacheable = True
+        # whether running the stage twice at once (writing different outputs) is
+        # harmless, so a duplicate may be run should it straggle (see --speculate)
+        self.idempotent = False
+        # seconds after which the stage is presumed hung and killed
+        # (if None, as given by --stage-timeout-factor)
+        self.timeout = None
+        # executors on which the stage has timed out, so is best retried elsewhere
+        self.timed_out_on = set()
+        # memory (in GB) the stage was found to need after running out, and its own
+        # requirement and that as corrected for its tool having run out of memory
+        # (see Pipeline.correctMemory)
+        self.oom_mem = None
+        self.requested_mem = None
+        self.corrected_mem = None
 
     def isFinished(self):
         return self.status == "finished"
@@ -98,8 +158,17 @@ class PipelineStage(object):
         return self.mem
     def setProcs(self, num):
         self.procs = num
+    def setProcsRange(self, minimum, maximum):
+        """declare that the stage can use between minimum and maximum processors"""
+        self.procs = self.min_procs = minimum
+        self.max_procs = maximum
     def getProcs(self):
         return self.procs
+    def setResource(self, name, amount):
+        """declare that the stage requires amount of the named resource"""
+        self.resources[name] = amount
+    def getResources(self):
+        return self.resources
     def getHash(self):
         return(hash("".join(self.outputFiles) + "".join(self.inputFiles)))
     def __eq__(self, other):
@@ -110,6 +179,13 @@ class PipelineStage(object):
         return self.number_retries
     def incrementNumberOfRetries(self):
         self.number_retries += 1
+    def getTool(self):
+        """the program this stage runs; used to look up runtime estimates"""
+        return self.name
+    def setStreamable(self, inputs=(), outputs=()):
+        """declare some of this stage's inputs/outputs as streamable"""
+        self.streamableInputs.update(str(f) for f in inputs)
+        self.streamableOutputs.update(str(f) for f in outputs)
 
 class CmdStage(PipelineStage):
     pipeline_start_time = datetime.isoformat(datetime.now())
@@ -154,11 +230,35 @@ class CmdStage(PipelineStage):
         of.close()
         return(returncode)
 
+    def getTool(self):
+        return os.path.basename(self.cmd[0]) if self.cmd else self.name
     def getHash(self):
         return(hash(" ".join(self.cmd)))
     def __repr__(self):
         return(" ".join(self.cmd))
 
+class LinkStage(CmdStage):
+    """Links the outputs of one stage (and their companion files, such as an .xfm's
+    grids) to the filenames another (equivalent) stage would have written, preferring
+    hard links and falling back to symbolic ones"""
+    def __init__(self, sources, targets):
+        script = ("import sys; from pydpiper.result_cache import linkOutputs; "
+                  "n = len(sys.argv) // 2; linkOutputs(sys.argv[1:n + 1], sys.argv[n + 1:])")
+        CmdStage.__init__(self, [sys.executable, "-c", quote(script)]
+                                + [quote(f) for f in list(sources) + list(targets)])
+        self.inputFiles  = list(sources)
+        self.outputFiles = list(targets)
+        self.name = "ln"
+        # linking needs next to no memory
+        self.mem = 0.1
+    def getTool(self):
+        return "ln"
+
+def _reduceMethod(m):
+    return (getattr, (m.im_self, m.im_func.__name__))
+# let bound methods (e.g., in stage hooks) be pickled as part of a compiled plan
+copy_reg.pickle(types.MethodType, _reduceMethod)
+
 """A graph with no edge information; see networkx/classes/digraph.py"""
 class ThinGraph(nx.DiGraph):
     all_edge_dict = {'weight': 1}
@@ -181,8 +281,11 @@ class Pipeline(object):
         # an array of the actual stages (PipelineStage objects)
         self.stages = []
         self.nameArray = []
-        # indices of the stages ready to be run
-        self.runnable = set()
+        # indices of the stages ready to be run, partitioned among pipelines
+        # added with addPipeline(..., name=...) which share the executors fairly
+        self.runnable = FairShareSet()
+        # whether the dependencies and initially runnable stages have been computed
+        self.initialized = False
         # an array to keep track of stage memory requirements
         self.mem_req_for_runnable = []
         # a hideous hack; the idea is that after constructing the underlying graph,
@@ -197,9 +300,42 @@ class Pipeline(object):
         # a hash per stage - computed from inputs and outputs or whole command
         self.stage_dict = {}
         self.num_finished_stages = 0
+        # stages not needed to produce the requested --targets; these are never run
+        self.excluded_stages = set()
         self.failedStages = []
+        # producer index -> (consumer index, filename) for pairs of stages which
+        # can be run simultaneously, connected by a named pipe
+        self.stream_pairs = {}
+        # static/learned runtimes per tool, used to batch up short stages
+        self.runtime_estimates = RuntimeEstimates()
+        # (learned, per tool) factors by which stages' memory requirements are too low
+        self.memory_corrections = MemoryCorrections()
         # location of backup files for restart if needed
         self.backupFileLocation = None
+        # running stages recorded by a previous server for us to adopt (--handoff)
+        self.handoffLocation = None
+        # index -> URI of the executor expected to reattach with that stage running
+        self.awaiting_adoption = {}
+        self.adoption_deadline = None
+        # set once this server has told executors to wait for its successor
+        self.handing_off = False
+        # index -> URI of the executor running a duplicate of that straggling stage
+        self.speculative = {}
+        # index -> URI of the executor a stage has been sent to but which hasn't yet
+        # started it (which takes its share of the --resource-pools meanwhile)
+        self.dispatched = {}
+        # index -> runtime of the duplicate of that stage which finished first, whose
+        # outputs are put in place once the original's executor reports it killed (or is lost)
+        self.superseded = {}
+        # URI -> stages the executor is to kill, sent in reply to its next heartbeat
+        self.kills = {}
+        # heap of (time, index) of stages to be requeued after timing out
+        self.retry_at = []
+        # structured record of scheduling activity (--event-journal)
+        self.events = None
+        # digests of the inputs each stage was run with (--restart-check=digest)
+        self.inputDigestsLocation = None
+        self.input_digests = None
         # table of registered clients (using ExecClient class instances) indexed by URI
         self.clients = {}
         # number of clients (executors) that have been launched by the server
@@ -207,6 +343,10 @@ class Pipeline(object):
         # are actually registered, a whole bunch of them could be waiting in the
         # queue
         self.number_launched_and_waiting_clients = 0
+        # sizes executors to the demand of runnable stages (--autoscale)
+        self.autoscaler = None
+        # idle clients to be told to shut down, as the autoscaler finds them superfluous
+        self.retiring = set()
         # clients we've lost contact with due to crash, etc.
         self.failed_executors = 0
         # main option hash, needed for the pipeline (server) to launch additional
@@ -228,11 +368,15 @@ class Pipeline(object):
                 self.outputDir = os.getcwd()
             # redirect the standard output to a text file
             serverLogFile = os.path.join(self.outputDir,self.options.pipeline_name + '_server_stdout.log')
-            if self.options.queue_type == "pbs" and self.options.local:
+            backend = queueing.queueBackend(self.options)
+            if backend is not None and backend.submits_server and self.options.local:
                 sys.stdout = open(serverLogFile, 'a', 1) # 1 => line buffering
         
     # expose methods to get/set shutdown_ev via Pyro (setter not needed):
     def set_shutdown_ev(self):
+        # (called in the server's process, which is then terminated)
+        if self.input_digests is not None:
+            self.input_digests.flush()
         self.shutdown_ev.set()
 
     def get_shutdown_ev(self):
@@ -307,11 +451,79 @@ class Pipeline(object):
         self.backupFileLocation = os.path.join(outputDir,
                                     self.options.pipeline_name
                                      + '_finished_stages')
-    def addPipeline(self, p):
+        self.inputDigestsLocation = os.path.join(outputDir,
+                                      self.options.pipeline_name
+                                       + '_input_digests')
+        self.handoffLocation = os.path.join(outputDir,
+                                 self.options.pipeline_name
+                                  + '_handoff.json')
+        if self.options.restart_check == "digest":
+            self.input_digests = fh.DigestRecorder(self.inputDigestsLocation)
+        self.memory_corrections = MemoryCorrections(os.path.join(outputDir,
+                                                      self.options.pipeline_name
+                                                       + '_memory_corrections.json'))
+        if self.options.event_journal:
+            self.events = EventJournal(os.path.join(outputDir,
+                                         self.options.pipeline_name
+                                          + '_events.jsonl'))
+    def addPipeline(self, p, name=None, weight=1.0, journal=None):
+        """Add the stages of another pipeline.  If a name is given, its stages form a
+        share of the executors (see fair_share.py) with the given weight, and may also
+        be recorded in a finished stages journal of their own (whose stages are skipped).
+        If this pipeline is already running, the new stages are scheduled at once."""
         if p.skipped_stages > 0:
             self.skipped_stages += p.skipped_stages
+        first = self.counter
         for s in p.stages:
             self.addStage(s)
+        new = range(first, self.counter)
+        previous = frozenset()
+        if name is not None:
+            share = self.runnable.addShare(name, weight)
+            for i in new:
+                self.runnable.assign(i, name)
+            if journal is not None and share.journal_fh is None:
+                previous = fh.readJournalHashes(journal)
+                share.journal_fh = open(journal, 'a')
+            logger.info("Added pipeline '%s' (weight %.2f) of %d new stages", name, weight, len(new))
+        if self.initialized:
+            self.scheduleNewStages(new, previous)
+
+    def scheduleNewStages(self, new, previous):
+        """compute dependencies of stages added to a running pipeline (which, since
+        they're new, no existing stage depends on), marking as finished those whose
+        hashes are in `previous` if their predecessors are, and enqueue the runnable ones"""
+        for i in new:
+            for ip in self.stages[i].inputFiles:
+                if self.outputhash.has_key(ip):
+                    self.G.add_edge(self.outputhash[ip], i)
+        for i in nx.topological_sort(self.G, new):
+            if (i >= len(self.unfinished_pred_counts) and self.stages[i].getHash() in previous
+                and all(self.stages[k].isFinished() for k in self.G.predecessors(i))):
+                self.stages[i].status = "finished"
+                self.num_finished_stages += 1
+                self.writeJournal(i)
+        for i in new:
+            self.unfinished_pred_counts.append(len([k for k in self.G.predecessors(i)
+                                                    if not self.stages[k].isFinished()]))
+        for i in new:
+            if self.checkIfRunnable(i):
+                self.enqueue(i)
+
+    def submitPlan(self, filename, name, weight=1.0, journal=None):
+        """(called by a pipeline run with --join-server) add the pipeline saved (with
+        savePlan, using no key) in filename to this one as a new share of the executors.
+        Returns the number of its stages not already in this pipeline."""
+        p = Pipeline()
+        if not p.loadPlan(filename, None):
+            raise ValueError("couldn't load the plan in %s" % filename)
+        n = self.counter
+        self.addPipeline(p, name, weight, journal)
+        return self.counter - n
+
+    def getStageId(self, i):
+        """a stage's index, qualified by its pipeline and index there if in a share"""
+        return self.runnable.stageId(i)
 
     def printStages(self, name):
         """Prints stages to a file, stage info to stdout"""
@@ -324,6 +536,8 @@ class Pipeline(object):
         print("Total number of stages in the pipeline: ", len(self.stages))
                  
     def printNumberProcessedStages(self):
+        if self.excluded_stages:
+            print("Number of stages not needed for targets:", len(self.excluded_stages))
         print("Number of stages already processed:     ", self.num_finished_stages)
                   
     def createEdges(self):
@@ -339,9 +553,98 @@ class Pipeline(object):
         endtime = time.time()
         logger.info("Create Edges time: " + str(endtime-starttime))
 
+    def mergeEquivalentStages(self):
+        """Find stages whose commands are identical except for their output filenames
+        (e.g., the same file blurred in two directories) and replace all but one of each
+        such group by a stage which links the surviving stage's outputs into place.
+        Must be called before createEdges, which then makes consumers of the replaced
+        stages' outputs depend (via the link stage) on the survivor."""
+        survivors = {}
+        merged = 0
+        for i, s in enumerate(self.stages):
+            if not isinstance(s, CmdStage) or not s.outputFiles:
+                continue
+            signature = []
+            for a in s.cmd:
+                out = fh.outputPosition(a, s.outputFiles)
+                signature.append(a if out is None else out)
+            signature = tuple(signature + [len(s.outputFiles)])
+            if signature not in survivors:
+                survivors[signature] = i
+                continue
+            link = LinkStage(self.stages[survivors[signature]].outputFiles, s.outputFiles)
+            link.logFile = s.logFile
+            link.finished_hooks = s.finished_hooks
+            del self.stage_dict[s.getHash()]
+            self.stage_dict[link.getHash()] = i
+            self.stages[i] = link
+            self.nameArray[i] = link.name
+            merged += 1
+        logger.info("Replaced %d stages by links to equivalent stages", merged)
+
+    def selectTargets(self, targets):
+        """exclude all stages other than those producing the given targets (output
+        files or stage names, possibly globs) and their ancestors"""
+        wanted = set()
+        for t in targets:
+            if t in self.outputhash:
+                matches = [self.outputhash[t]]
+            elif os.path.abspath(t) in self.outputhash:
+                matches = [self.outputhash[os.path.abspath(t)]]
+            else:
+                # (output files are generally named by absolute paths, so a relative
+                # glob is also matched relative to the current directory)
+                patterns = set([t, os.path.abspath(t)])
+                matches = ([self.outputhash[o] for o in self.outputhash.iterkeys()
+                            if any(fnmatch.fnmatch(o, pattern) for pattern in patterns)]
+                           + [i for i, name in enumerate(self.nameArray) if fnmatch.fnmatch(name, t)])
+            if not matches:
+                raise ValueError("target %s is neither an output file nor the name of any stage" % t)
+            wanted.update(matches)
+        needed = set(wanted)
+        for i in wanted:
+            needed.update(nx.ancestors(self.G, i))
+        self.excluded_stages = set(xrange(len(self.stages))) - needed
+        logger.info("Running %d stages needed for targets %s; excluding %d others",
+                    len(needed), targets, len(self.excluded_stages))
+
+    def computeStreamPairs(self):
+        """find producer/consumer pairs which can be connected by a named pipe
+        instead of an intermediate file: the file must be declared streamable
+        by both stages and must not be read by any other stage"""
+        consumers = {}
+        for i in self.G.nodes_iter():
+            for ip in self.stages[i].inputFiles:
+                consumers.setdefault(ip, []).append(i)
+        streamed = set()
+        for i in self.G.nodes_iter():
+            for f in self.stages[i].streamableOutputs:
+                cs = consumers.get(f, [])
+                if (len(cs) == 1 and cs[0] not in streamed
+                    and f in self.stages[cs[0]].streamableInputs):
+                    self.stream_pairs[i] = (cs[0], f)
+                    streamed.add(cs[0])
+                    break
+        logger.info("Stream pairs: %d", len(self.stream_pairs))
+
+    def getStreamConsumer(self, i):
+        """the consumer which can be launched together with stage i, if any.
+        All of the consumer's inputs other than the streamed file must exist."""
+        if i not in self.stream_pairs:
+            return None
+        j, _ = self.stream_pairs[i]
+        if (self.unfinished_pred_counts[j] == 1 and self.stages[j].status is None
+            and j not in self.excluded_stages):
+            return j
+        return None
+
+    def getStreamFile(self, i):
+        return self.stream_pairs[i][1]
+
     def computeGraphHeads(self):
         """adds stages with no incomplete predecessors to the runnable queue"""
-        graphHeads = filter(lambda n: self.unfinished_pred_counts[n] == 0,
+        graphHeads = filter(lambda n: self.unfinished_pred_counts[n] == 0
+                                      and n not in self.excluded_stages,
                             self.G.nodes_iter())
         logger.info("Graph heads: " + str(graphHeads))
         return graphHeads # TODO call \ix -> self.enqueue ix on these
@@ -353,10 +656,32 @@ class Pipeline(object):
         return(self.stages[i].mem)
     def getStageProcs(self,i):
         return(self.stages[i].procs)
+    def getStageResources(self, i):
+        """the stage's requirements of resources other than memory and processors"""
+        return(self.stages[i].resources)
+    def getStageRequirements(self, i):
+        """the stage's full resource vector, including its memory and processors"""
+        s = self.stages[i]
+        return dict(s.resources, mem=s.mem, procs=s.procs)
     def getStageCommand(self,i):
         return(repr(self.stages[i]))
     def getStageLogfile(self,i):
         return(self.stages[i].logFile)
+    def getStageTimeout(self, i):
+        """seconds after which stage i is presumed hung and killed, or None for no limit;
+        doubled for each retry, in case the stage is merely slower than expected"""
+        s = self.stages[i]
+        if s.timeout is not None:
+            limit = s.timeout
+        elif self.options is not None and self.options.stage_timeout_factor:
+            limit = max(MIN_STAGE_TIMEOUT, self.options.stage_timeout_factor * self.estimatedRuntime(i))
+        else:
+            return None
+        return limit * 2 ** s.getNumberOfRetries()
+    def getStageFiles(self, i):
+        """(inputs, outputs) of a stage whose results can be cached, otherwise None"""
+        s = self.stages[i]
+        return (s.inputFiles, s.outputFiles) if s.cacheable else None
 
     def is_time_to_drain(self):
         return self.shutdown_ev.is_set()
@@ -368,7 +693,15 @@ class Pipeline(object):
     lines to getRunnableStageIndex) and update server's internal view of client.
     This is highly stateful, being a resource-tracking wrapper around
     getRunnableStageIndex and hence a glorified Set.pop."""
-    def getCommand(self, clientURIstr, clientMemFree, clientProcsFree):
+    def getCommand(self, clientURIstr, clientMemFree, clientProcsFree, clientTimeLeft=None,
+                   clientResourcesFree=None):
+        if clientTimeLeft is not None and clientURIstr in self.clients:
+            self.clients[clientURIstr].setTimeLeft(clientTimeLeft)
+        if self.handing_off:
+            return ("handoff", None)
+        if clientURIstr in self.retiring and not self.clients[clientURIstr].running_stages:
+            self.retiring.discard(clientURIstr)
+            return ("shutdown_normally", None)
         if self.is_time_to_drain():
             return ("shutdown_abnormally", None)
 
@@ -377,28 +710,380 @@ class Pipeline(object):
         # (e.g., by passing available resources
         # into getRunnableStageIndex)?
         flag, i = self.getRunnableStageIndex()
+        timeLeft = self.clients[clientURIstr].timeLeft() if clientURIstr in self.clients else None
+        free = self.freeResources(clientMemFree, clientProcsFree, clientResourcesFree)
+        if flag == "run_stage" and not self.fitsInTime(i, timeLeft):
+            # don't start a stage the client will be killed before finishing;
+            # instead look for a shorter one to fill its remaining time
+            j = self.backfillStage(timeLeft, free)
+            self.enqueue(i)
+            if j is None:
+                logger.debug("No runnable stage fits in the %.0fs remaining to %s", timeLeft, clientURIstr)
+                if not self.clients[clientURIstr].running_stages:
+                    # let it exit so a fresh executor can be launched in its place
+                    return ("shutdown_normally", None)
+                return ("wait", None)
+            i = j
+        if flag == "run_stage" and self.avoids(i, clientURIstr):
+            self.enqueue(i)
+            return ("wait", None)
         if flag == "run_stage":
-            eps = 0.000001
-            memOK   = self.getStageMem(i) <= clientMemFree + eps
-            procsOK = self.getStageProcs(i) <= clientProcsFree
-            if memOK and procsOK:
+            pools = self.poolsFree()
+            # launch a producer together with its consumer if both fit:
+            j = self.getStreamConsumer(i)
+            if (j is not None and self.fitsInTime(j, timeLeft)
+                and self.fits([i, j], free, pools)):
+                self.reserve([i, j], clientURIstr)
+                self.recordDispatch([i, j], clientURIstr, "run_gang")
+                return ("run_gang", [i, j])
+            lacking = self.resourceShortfall([i], free, pools)
+            if lacking is None:
+                if (self.options is not None and self.options.batch_size > 1
+                    and self.isSmallStage(i)):
+                    batch = self.fillBatch(i, free, timeLeft)
+                    if len(batch) > 1:
+                        self.reserve(batch, clientURIstr)
+                        self.recordDispatch(batch, clientURIstr, "run_batch")
+                        return ("run_batch", batch)
+                self.grantProcs(i, free)
+                self.reserve([i], clientURIstr)
+                self.recordDispatch([i], clientURIstr, flag)
                 return (flag, i)
             else:
-                if not memOK:
-                    logger.debug("The executor does not have enough free memory (free: %.2fG, required: %.2fG) to run stage %d. (Executor: %s)", clientMemFree, self.getStageMem(i), i, clientURIstr)
-                if not procsOK:
-                    logger.debug("The executor does not have enough free processors (free: %.1f, required: %.1f) to run stage %d. (Executor: %s)", clientProcsFree, self.getStageProcs(i), i, clientURIstr)
+                need = self.getStageRequirements(i)
+                if resources.shortfall(need, free) is not None:
+                    logger.debug("The executor does not have enough free %s (free: %.2f, required: %.2f) to run stage %d. (Executor: %s)",
+                                 lacking, free[lacking], need[lacking], i, clientURIstr)
+                else:
+                    logger.debug("Not enough of the %s pool is free (free: %.2f, required: %.2f) to run stage %d.",
+                                 lacking, pools[lacking], need[lacking], i)
                 self.enqueue(i)
                 return ("wait", None)
+        elif flag == "wait":
+            # with nothing else to run, the client may as well duplicate a straggler
+            j = self.findStraggler(clientURIstr, free)
+            if j is not None:
+                speculation.prepare(j, self.stages[j])
+                self.speculative[j] = clientURIstr
+                logger.info("Stage %s is straggling; running a duplicate on %s", self.getStageId(j), clientURIstr)
+                self.recordDispatch([j], clientURIstr, "run_speculative")
+                return ("run_speculative", j)
+            return (flag, i)
         else:
             return (flag, i)
 
+    def grantProcs(self, i, free):
+        """Decide how many processors stage i (about to be run by a client with the
+        free resources given) gets, if it can use a range of them: the client's free
+        processors are divided between it and the other runnable stages which would
+        fit on the client, so stages get more when few are runnable (e.g., at the end
+        of a registration generation).  Since the other stages are spread over all the
+        executors, the client is presumed to run only its (equal) share of them."""
+        s = self.stages[i]
+        if s.max_procs is None:
+            return
+        fitting = sum(1 for j in self.runnable if self.fits([j], free, {}))
+        executors = max(1, len(self.clients))
+        share = int(free["procs"] // ((fitting + executors - 1) // executors + 1))
+        s.procs = max(s.min_procs, min(s.max_procs, share))
+        if s.procs > s.min_procs:
+            logger.debug("Giving stage %s %d processors", self.getStageId(i), s.procs)
+
+    def freeResources(self, clientMemFree, clientProcsFree, clientResourcesFree=None):
+        """the resource vector free on a client, which has no limit on resources
+        not in clientResourcesFree (see --executor-resources)"""
+        return dict(clientResourcesFree or {}, mem=clientMemFree, procs=clientProcsFree)
+
+    def reserve(self, indices, clientURI):
+        """note that stages have been sent to a client, so that their requirements are
+        taken from the pools straight away, rather than only once the client's worker
+        process reports their start (before which other clients could take the same
+        share); leased stages, marked as started when leased, needn't be"""
+        for i in indices:
+            self.dispatched[i] = clientURI
+
+    def poolsFree(self):
+        """what is left of each of the --resource-pools, shared by all clients, after
+        the running stages (and duplicates of them) and those dispatched but not yet
+        started have taken their requirements"""
+        if self.options is None or not self.options.resource_pools:
+            return {}
+        running = (list(self.currently_running_stages.union(self.dispatched))
+                   + list(self.speculative))
+        return resources.remaining(self.options.resource_pools,
+                                   resources.total(*[self.getStageRequirements(i) for i in running]))
+
+    def resourceShortfall(self, indices, free, pools):
+        """a resource of which there isn't enough free, either on the client (free)
+        or in the global pools, to run the given stages at once; None if they fit"""
+        need = resources.total(*[self.getStageRequirements(i) for i in indices])
+        return resources.shortfall(need, free) or resources.shortfall(need, pools)
+
+    def fits(self, indices, free, pools):
+        return self.resourceShortfall(indices, free, pools) is None
+
+    def recordEvent(self, event, **fields):
+        """add an event to the --event-journal (see events.py), if we're writing one"""
+        if self.events is not None:
+            self.events.record(event, **fields)
+
+    def recordDispatch(self, indices, clientURI, how):
+        if self.events is not None:
+            for i in indices:
+                self.events.record("dispatch", stage=i, executor=clientURI, how=how,
+                                   resources=self.getStageRequirements(i))
+
+    def stageLogLevel(self):
+        """the level at which stages' starts and finishes are logged (with their commands,
+        whose formatting is costly for a large pipeline): these are recorded in the
+        --event-journal instead, if we're writing one"""
+        return logging.DEBUG if self.events is not None else logging.INFO
+
+    def isSmallStage(self, i):
+        return self.estimatedRuntime(i) <= self.options.small_stage_runtime
+
+    def estimatedRuntime(self, i):
+        return self.runtime_estimates.estimate(self.stages[i].getTool())
+
+    def fitsInTime(self, i, timeLeft):
+        """whether stage i can be expected to finish within timeLeft seconds (None = unlimited)"""
+        return (timeLeft is None or self.options is None
+                or self.estimatedRuntime(i) * self.options.runtime_safety_factor <= timeLeft)
+
+    def upcomingStages(self):
+        """(expected time runnable, index) of each stage whose unfinished
+        predecessors are all running, based on the latter's estimated runtimes"""
+        now = time.time()
+        finish = dict((i, now + max(0, self.estimatedRuntime(i) - (now - self.stages[i].start_time)))
+                      for i in self.currently_running_stages)
+        upcoming = []
+        for j in set(j for i in finish for j in self.G.successors(i)):
+            if self.stages[j].status is not None or j in self.excluded_stages:
+                continue
+            preds = [k for k in self.G.predecessors(j) if not self.stages[k].isFinished()]
+            if all(k in finish for k in preds):
+                upcoming.append((max(finish[k] for k in preds), j))
+        return upcoming
+
+    def getUpcomingWork(self, clientURI, horizon):
+        """Estimate the number of seconds until an idle client will next be given
+        a stage, or None if this isn't expected within horizon seconds.  Stages
+        expected to become runnable are successors whose unfinished predecessors
+        are all running, and are shared out in order of their expected start
+        among the idle clients (taken in a fixed order)."""
+        now = time.time()
+        upcoming = sorted(t for t, _ in self.upcomingStages())
+        idle = sorted(uri for uri, c in self.clients.iteritems() if not c.running_stages)
+        if clientURI not in idle:
+            return None
+        k = idle.index(clientURI)
+        if k >= len(upcoming) or upcoming[k] - now > horizon:
+            return None
+        return upcoming[k] - now
+
+    def backfillStage(self, timeLeft, free):
+        """remove and return the longest runnable stage which fits both the client's
+        free resources and its remaining time, or None if there isn't one"""
+        pools = self.poolsFree()
+        candidates = [j for j in self.runnable
+                      if self.fitsInTime(j, timeLeft)
+                      and self.fits([j], free, pools)]
+        if not candidates:
+            return None
+        j = max(candidates, key=self.estimatedRuntime)
+        self.runnable.remove(j)
+        self.mem_req_for_runnable.remove(self.stages[j].mem)
+        return j
+
+    def fillBatch(self, i, free, timeLeft=None):
+        """Gather up to --batch-small-stages short runnable stages (including i)
+        to be run one after another by a single executor process (and finishing
+        within timeLeft seconds, if given)"""
+        batch = [i]
+        # (the batch's stages are all counted against the pools while it runs,
+        # so each must fit alongside the others)
+        pools = resources.remaining(self.poolsFree(), self.getStageRequirements(i))
+        runtime = self.estimatedRuntime(i)
+        for j in self.runnable:
+            if len(batch) >= self.options.batch_size:
+                break
+            if (self.isSmallStage(j)
+                and self.fits([j], free, pools)
+                and self.fitsInTime(j, None if timeLeft is None else timeLeft - runtime)):
+                batch.append(j)
+                pools = resources.remaining(pools, self.getStageRequirements(j))
+                runtime += self.estimatedRuntime(j)
+        for j in batch[1:]:
+            self.runnable.remove(j)
+            self.mem_req_for_runnable.remove(self.stages[j].mem)
+        return batch
+
+    # batched versions of the calls made by runStage, to save round trips:
+    def setStagesStarted(self, indices, clientURI):
+        for i in indices:
+            self.setStageStarted(i, clientURI)
+
+    def getStagesInfo(self, indices):
+        return [(i, self.getStageCommand(i), self.getStageLogfile(i), self.getStageTimeout(i),
+                 self.getStageMem(i), self.getStageProcs(i)) for i in indices]
+
+    def getStagesFiles(self, indices):
+        return [self.getStageFiles(i) for i in indices]
+
+    def getStagesMemAndProcs(self, indices):
+        return [(self.getStageMem(i), self.getStageProcs(i)) for i in indices]
+
+    def getStagesResources(self, indices):
+        return [self.getStageResources(i) for i in indices]
+
+    def setStagesTerminated(self, results, clientURI):
+        """results is a list of (index, returncode, runtime) triples"""
+        for i, returncode, runtime in results:
+            if returncode == 0:
+                self.setStageFinished(i, clientURI, runtime = runtime)
+            else:
+                self.setStageFailed(i, clientURI, cause = returncode)
+
+    # speculative re-execution (--speculate):
+    def findStraggler(self, clientURI, free):
+        """Of the idempotent stages running for over --speculate times the median runtime
+        of their tool, return the most overdue not already duplicated and which could run
+        on this client (but isn't running there), or None"""
+        if self.options is None or not self.options.speculation_factor:
+            return None
+        pools = self.poolsFree()
+        now = time.time()
+        here = self.clients[clientURI].running_stages if clientURI in self.clients else set()
+        streamed = set(self.stream_pairs) | set(j for j, _ in self.stream_pairs.values())
+        best, most_overdue = None, self.options.speculation_factor
+        for i in self.currently_running_stages:
+            s = self.stages[i]
+            if (not s.idempotent or i in self.speculative or i in self.superseded
+                or i in here or i in streamed
+                or self.runtime_estimates.numberObserved(s.getTool()) < speculation.MIN_SAMPLES
+                or not self.fits([i], free, pools)):
+                continue
+            median = self.runtime_estimates.median(s.getTool())
+            overdue = (now - s.start_time) / median if median > 0 else 0
+            if overdue > most_overdue and speculation.speculativeCommand(i, s) is not None:
+                best, most_overdue = i, overdue
+        return best
+
+    def getSpeculativeCommand(self, i):
+        """command and log file for a duplicate of stage i"""
+        s = self.stages[i]
+        return (" ".join(speculation.speculativeCommand(i, s)),
+                s.logFile + ".speculative" if s.logFile else None)
+
+    def setSpeculativeStageTerminated(self, i, returncode, runtime, clientURI):
+        """a duplicate of stage i has exited.  If it succeeded and is still wanted, kill the
+        original, putting the duplicate's outputs in place once it has stopped (so it can't
+        overwrite them); otherwise discard them"""
+        if self.speculative.get(i) != clientURI:
+            # the original has since finished (or otherwise stopped running)
+            speculation.discard(i, self.stages[i])
+            return
+        del self.speculative[i]
+        if returncode != 0:
+            logger.info("Duplicate of stage %s failed; the original continues", self.getStageId(i))
+            speculation.discard(i, self.stages[i])
+            return
+        original = [uri for uri, c in self.clients.iteritems() if i in c.running_stages][0]
+        logger.info("Duplicate of stage %s finished first (on %s); killing the original on %s",
+                    self.getStageId(i), clientURI, original)
+        self.superseded[i] = runtime
+        self.killStageOnClient(i, original)
+
+    def supersede(self, i, clientURI):
+        """the original of stage i, whose duplicate finished first, has stopped (or its
+        executor has been lost), so the duplicate's outputs can take the place of its own"""
+        runtime = self.superseded.pop(i)
+        logger.info("Stage %s's original has stopped; using its duplicate's outputs", self.getStageId(i))
+        speculation.promote(i, self.stages[i])
+        self.setStageFinished(i, clientURI, runtime = runtime)
+
+    def cancelSpeculation(self, i):
+        """stage i has stopped running, so any duplicate is no longer needed"""
+        uri = self.speculative.pop(i, None)
+        if uri is not None:
+            logger.info("Killing the duplicate of stage %s on %s", self.getStageId(i), uri)
+            self.killStageOnClient(i, uri)
+
+    def killStageOnClient(self, i, clientURI):
+        """have the executor kill stage i (or its duplicate), which it does on its next
+        heartbeat (rather than calling it now, which would hold up the server)"""
+        self.kills.setdefault(clientURI, set()).add(i)
+
+    # node agents (executors run with --node-agent):
+    def leaseStages(self, clientURI, clientMemFree, clientProcsFree, clientTimeLeft=None,
+                    clientResourcesFree=None):
+        """Hand a node agent as many runnable stages as fit in its free resources
+        (and remaining time), together with all it needs to run them, so it can
+        do so without further calls to the server.  The stages are marked as
+        running on the agent; if its heartbeats stop, the lease is reclaimed by
+        requeueing them as for any lost executor.  Returns a command as for
+        getCommand and a list of (index, command, logfile, mem, procs, files, timeout,
+        resources)."""
+        if clientTimeLeft is not None and clientURI in self.clients:
+            self.clients[clientURI].setTimeLeft(clientTimeLeft)
+        if self.handing_off:
+            return ("handoff", [])
+        if clientURI in self.retiring and not self.clients[clientURI].running_stages:
+            self.retiring.discard(clientURI)
+            return ("shutdown_normally", [])
+        if self.is_time_to_drain():
+            return ("shutdown_abnormally", [])
+        timeLeft = self.clients[clientURI].timeLeft() if clientURI in self.clients else None
+        free = self.freeResources(clientMemFree, clientProcsFree, clientResourcesFree)
+        pools = self.poolsFree()
+        leased, unsuitable = [], []
+        while len(unsuitable) < LEASE_PROBES:
+            flag, i = self.getRunnableStageIndex()
+            if flag != "run_stage":
+                if flag == "shutdown_normally" and not leased:
+                    return (flag, [])
+                break
+            if (self.fits([i], free, pools)
+                and self.fitsInTime(i, timeLeft)
+                and not self.avoids(i, clientURI)):
+                self.grantProcs(i, free)
+                leased.append(i)
+                free = resources.remaining(free, self.getStageRequirements(i))
+                pools = resources.remaining(pools, self.getStageRequirements(i))
+            else:
+                unsuitable.append(i)
+        for i in unsuitable:
+            self.enqueue(i)
+        if not leased:
+            return ("wait", [])
+        want_files = self.options is not None and self.options.result_cache_dir
+        stages = []
+        self.recordDispatch(leased, clientURI, "lease")
+        for i in leased:
+            self.setStageStarted(i, clientURI)
+            stages.append((i, self.getStageCommand(i), self.getStageLogfile(i),
+                           self.getStageMem(i), self.getStageProcs(i),
+                           self.getStageFiles(i) if want_files else None,
+                           self.getStageTimeout(i), self.getStageResources(i)))
+        logger.debug("Leased stages %s to %s", leased, clientURI)
+        return ("run_stages", stages)
+
+    def reportLeasedStages(self, results, clientURI):
+        """record a node agent's batch of (index, returncode, runtime) results, ignoring
+        those for stages whose lease has meanwhile been reclaimed (and the stage requeued)"""
+        held = self.clients[clientURI].running_stages if clientURI in self.clients else set()
+        stale = [i for i, _, _ in results if i not in held]
+        if stale:
+            logger.info("Ignoring results for stages %s, no longer leased to %s", stale, clientURI)
+        self.setStagesTerminated([r for r in results if r[0] in held], clientURI)
+
     """Return a tuple of a command ("shutdown_normally" if all stages are finished,
     "wait" if no stages are currently runnable, or "run_stage" if a stage is
     available) and the next runnable stage if the flag is "run_stage", otherwise
     None"""
     def getRunnableStageIndex(self):
-        if self.allStagesCompleted():
+        self.requeueTimedOut()
+        if self.allStagesCompleted() and not self.persistent():
             return ("shutdown_normally", None)
         elif len(self.runnable) == 0:
             return ("wait", None)
@@ -412,8 +1097,12 @@ class Pipeline(object):
                 logger.exception("It wasn't here!")
             return ("run_stage", index)
 
+    def persistent(self):
+        """whether to keep running once all stages have completed, awaiting more (--persistent-server)"""
+        return self.options is not None and self.options.persistent_server
+
     def allStagesCompleted(self): 
-        return self.num_finished_stages == len(self.stages) 
+        return self.num_finished_stages == len(self.stages) - len(self.excluded_stages)
 
     def addRunningStageToClient(self, clientURI, index):
         try:
@@ -437,8 +1126,8 @@ class Pipeline(object):
                 raise
 
     def setStageStarted(self, index, clientURI):
-        URIstring = "(" + str(clientURI) + ")"
-        logger.info("Starting Stage " + str(index) + ": " + str(self.stages[index]) + URIstring)
+        logger.log(self.stageLogLevel(), "Starting Stage %s: %s(%s)", self.getStageId(index), self.stages[index], clientURI)
+        self.recordEvent("start", stage=index, executor=clientURI)
         # There may be a bug in which a stage is added to the runnable set multiple times.
         # It would be better to catch that earlier (by using a different/additional data structure)
         # but for now look for the case when a stage is run twice at the same time, which may
@@ -447,22 +1136,35 @@ class Pipeline(object):
             raise Exception('stage %d is already running' % index)
         self.addRunningStageToClient(clientURI, index)
         self.currently_running_stages.add(index)
+        self.dispatched.pop(index, None)
         self.stages[index].setRunning()
+        self.stages[index].start_time = time.time()
+        self.runnable.charge(index, self.estimatedRuntime(index) * self.stages[index].procs)
 
     def checkIfRunnable(self, index):
         """stage added to runnable set if all predecessors finished"""
         logger.log(SUBDEBUG, "Checking if stage " + str(index) + " is runnable ...")
+        # (a stage can already be running if it was launched as part of a gang)
         canRun = (not self.stages[index].isFinished()) \
+                 and self.stages[index].status != "running" \
+                 and index not in self.excluded_stages \
                  and self.unfinished_pred_counts[index] == 0
         logger.log(SUBDEBUG, "Stage " + str(index) + " Runnable: " + str(canRun))
         return canRun
 
     def setStageFinished(self, index, clientURI, save_state = True,
-                         checking_pipeline_status = False):
-        """given an index, sets corresponding stage to finished and adds successors to the runnable set"""
+                         checking_pipeline_status = False, runtime = None):
+        """given an index, sets corresponding stage to finished and adds successors to the runnable set.
+        The runtime, if not reported by the executor, is measured by the server's clock."""
 
         s = self.stages[index]
         
+        if index in self.superseded:
+            # (it finished before it could be killed, so its own outputs are complete)
+            logger.info("Stage %d finished before its duplicate's outputs could replace its own", index)
+            del self.superseded[index]
+            speculation.discard(index, s)
+
         # since we want to use refcounting (where a 'reference' is an
         # unsatisfied dependency of a stage and 'collection' is
         # adding to the set of runnable stages) to determine whether a stage's
@@ -482,44 +1184,94 @@ class Pipeline(object):
             logger.log(SUBDEBUG, "Already finished stage " + str(index))
             s.status = "finished"
         else:
-            logger.info("Finished Stage " + str(index) + ": " + str(self.stages[index]))
+            logger.log(self.stageLogLevel(), "Finished Stage %s: %s", self.getStageId(index), self.stages[index])
             self.removeFromRunning(index, clientURI, new_status = "finished")
+            if runtime is None:
+                runtime = time.time() - s.start_time
+            self.runtime_estimates.record(s.getTool(), runtime)
+            self.recordEvent("finish", stage=index, executor=clientURI, runtime=runtime)
             # run any potential hooks now that the stage has finished:
             for f in s.finished_hooks:
                 f()
         self.num_finished_stages += 1
-        # write out the (index, hash) pairs to disk.  We don't actually need the indices
-        # for anything (in fact, the restart code in skip_completed_stages is resilient 
-        # against an arbitrary renumbering of stages), but a human-readable log is somewhat useful.
-        self.finished_stages_fh.write("%d,%s\n" % (index, self.stages[index].getHash()))
-        self.finished_stages_fh.flush()
+        self.writeJournal(index)
+        if self.input_digests is not None and not checking_pipeline_status:
+            self.input_digests.record(s.getHash(), s.inputFiles)
         for i in self.G.successors(index):
             self.unfinished_pred_counts[i] -= 1
             if self.checkIfRunnable(i):
                 self.enqueue(i)
 
+    def setGangTerminated(self, indices, returncodes, clientURI):
+        """a producer and its consumer have terminated.  Since the streamed
+        intermediate file was never written to disk, they succeed or fail together"""
+        producer, consumer = indices
+        if all(r == 0 for r in returncodes):
+            self.setStageFinished(producer, clientURI)
+            self.setStageFinished(consumer, clientURI)
+        else:
+            logger.info("Gang %s failed (return codes: %s); no longer streaming %s",
+                        indices, returncodes, self.getStreamFile(producer))
+            del self.stream_pairs[producer]
+            # the consumer will become runnable again once the producer has been rerun
+            self.removeFromRunning(consumer, clientURI, new_status = None)
+            self.setStageFailed(producer, clientURI)
+
     def removeFromRunning(self, index, clientURI, new_status):
+        self.dispatched.pop(index, None)
         try:
             self.currently_running_stages.discard(index)
         except:
             logger.exception("Unable to remove stage %d from client %s's stages: %s", index, clientURI, self.clients[clientURI].running_stages)
         self.removeRunningStageFromClient(clientURI, index)
         self.stages[index].status = new_status
+        self.cancelSpeculation(index)
 
     def setStageLost(self, index, clientURI):
         """Clean up a stage lost due to unresponsive client"""
         logger.info("Lost Stage %d: %s: ", index, self.stages[index])
+        self.recordEvent("lost", stage=index, executor=clientURI)
+        if index in self.superseded:
+            # (its duplicate has finished, so needn't be rerun)
+            self.supersede(index, clientURI)
+            return
         self.removeFromRunning(index, clientURI, new_status = None)
         self.enqueue(index)
 
-    def setStageFailed(self, index, clientURI):
+    def setStageFailed(self, index, clientURI, cause=None):
+        """cause may be pe.TIMED_OUT, pe.OUT_OF_MEMORY or pe.MEMORY_LIMIT_EXCEEDED if the
+        executor found the stage was killed for running too long or using too much memory
+        (other values are ignored)"""
+        if index in self.superseded:
+            # (killed when its duplicate finished first)
+            self.supersede(index, clientURI)
+            return
+        if cause in (pe.OUT_OF_MEMORY, pe.MEMORY_LIMIT_EXCEEDED) and self.escalateMemory(index):
+            # (not a retry as such, since it runs differently this time)
+            self.removeFromRunning(index, clientURI, new_status = None)
+            self.recordEvent("retry", stage=index, executor=clientURI, cause=cause,
+                             retries=self.stages[index].getNumberOfRetries(), mem=self.stages[index].oom_mem)
+            self.enqueue(index)
+            return
+        timed_out = cause == pe.TIMED_OUT
         # given an index, sets stage to failed, adds to failed stages array
         # But... only if this stage has already been retried twice (<- for now static)
         # Once in while retrying a stage makes sense, because of some odd I/O
         # read write issue (NFS race condition?). At least that's what I think is 
         # happening, so trying this to see whether it solves the issue.
         num_retries = self.stages[index].getNumberOfRetries()
-        if num_retries < 2:
+        if num_retries < 2 and timed_out:
+            # (don't block the server: it may have hung due to a problem with the
+            # executor's node which hasn't yet cleared up)
+            delay = TIMEOUT_RETRY_BACKOFF * 2 ** num_retries
+            self.removeFromRunning(index, clientURI, new_status = None)
+            self.stages[index].incrementNumberOfRetries()
+            self.stages[index].timed_out_on.add(clientURI)
+            self.recordEvent("retry", stage=index, executor=clientURI, cause=cause, retries=num_retries + 1)
+            logger.info("RETRYING: Stage %d timed out on %s; retrying in %ds, elsewhere if possible",
+                        index, clientURI, delay)
+            heapq.heappush(self.retry_at, (time.time() + delay, index))
+        elif num_retries < 2:
             # without a sleep statement, the stage will be retried within 
             # a handful of milliseconds, that won't solve anything...
             # this sleep command will block the server for a small amount 
@@ -527,13 +1279,18 @@ class Pipeline(object):
             time.sleep(STAGE_RETRY_INTERVAL)
             self.removeFromRunning(index, clientURI, new_status = None)
             self.stages[index].incrementNumberOfRetries()
+            self.recordEvent("retry", stage=index, executor=clientURI, cause=cause, retries=num_retries + 1)
             logger.info("RETRYING: ERROR in Stage " + str(index) + ": " + str(self.stages[index]))
             logger.info("RETRYING: adding this stage back to the runnable set.")
             logger.info("RETRYING: Logfile for Stage " + str(self.stages[index].logFile))
             self.enqueue(index)
         else:
             self.removeFromRunning(index, clientURI, new_status = "failed")
-            logger.info("ERROR in Stage " + str(index) + ": " + str(self.stages[index]))
+            self.recordEvent("fail", stage=index, executor=clientURI, cause=cause)
+            logger.info("ERROR in Stage " + str(index) + ": " + str(self.stages[index])
+                        + (" (timed out)" if timed_out else "")
+                        + (" (out of memory)" if cause == pe.OUT_OF_MEMORY else "")
+                        + (" (exceeded its memory limit)" if cause == pe.MEMORY_LIMIT_EXCEEDED else ""))
             # This is something we should also directly report back to the user:
             print("\nERROR in Stage %s: %s" % (str(index), str(self.stages[index])))
             print("Logfile for (potentially) more information:\n%s\n" % self.stages[index].logFile)
@@ -543,25 +1300,123 @@ class Pipeline(object):
                 self.failedStages.append(i)
                 
 
+    def escalateMemory(self, i):
+        """Raise the memory requirement of stage i, which ran out of memory (or exceeded
+        its limit), by OOM_MEMORY_GROWTH (up to the memory of the largest executor), and
+        record the correction for other stages running its tool.  Returns False if it's
+        already as large as it can be."""
+        s = self.stages[i]
+        maxmem = self.options.mem if self.options is not None else None
+        if maxmem is None or s.mem >= maxmem:
+            return False
+        s.oom_mem = min(s.mem * OOM_MEMORY_GROWTH, maxmem)
+        logger.info("Stage %s ran out of memory with %.2fG; retrying with %.2fG",
+                    self.getStageId(i), s.mem, s.oom_mem)
+        self.memory_corrections.record(s.getTool(), s.oom_mem / (s.requested_mem or s.mem))
+        return True
+
+    def correctMemory(self, i):
+        """raise stage i's memory requirement, as just set by the stage (or its hooks),
+        if it (or others running the same tool) have run out of memory"""
+        s = self.stages[i]
+        if s.mem is None:
+            return
+        if s.mem != s.corrected_mem:
+            # a fresh requirement, rather than that set by a previous correction
+            s.requested_mem = s.mem
+        mem = s.requested_mem * self.memory_corrections.factor(s.getTool())
+        if self.options is not None:
+            mem = min(mem, self.options.mem)
+        s.mem = s.corrected_mem = max(mem, s.requested_mem, s.oom_mem)
+
+    def requeueTimedOut(self):
+        """make runnable again the stages whose backoff after timing out has elapsed"""
+        now = time.time()
+        while self.retry_at and self.retry_at[0][0] <= now:
+            _, i = heapq.heappop(self.retry_at)
+            self.enqueue(i)
+
+    def avoids(self, i, clientURI):
+        """whether stage i, having timed out on this client, should be left for another"""
+        avoid = self.stages[i].timed_out_on
+        return clientURI in avoid and any(uri not in avoid for uri in self.clients)
+
     def enqueue(self, i):
         """If stage cannot be run due to insufficient mem/procs, executor returns it to the runnable set"""
         logger.log(SUBDEBUG, "Queueing stage %d", i)
+        self.dispatched.pop(i, None)
         self.runnable.add(i)
         for f in self.stages[i].runnable_hooks:
             f()
+        if self.stages[i].min_procs is not None:
+            # (it's given more again, if appropriate, when next run)
+            self.stages[i].procs = self.stages[i].min_procs
+        self.correctMemory(i)
         # keep track of the memory requirements of the runnable jobs
         self.mem_req_for_runnable.append(self.stages[i].mem)
 
     def initialize(self):
         """called once all stages have been added - computes dependencies and adds graph heads to runnable set"""
+        if self.options is not None and self.options.merge_equivalent_stages:
+            self.mergeEquivalentStages()
         self.createEdges()
+        self.computeRunnable()
+
+    def computeRunnable(self):
+        """given the dependency graph, determine which stages will run and which can run now"""
+        if self.options is not None and self.options.targets:
+            self.selectTargets(self.options.targets.split(','))
+        if self.options is not None and self.options.stream_intermediates:
+            self.computeStreamPairs()
         # could also set this on G itself ...
         self.unfinished_pred_counts = [ len(filter(lambda i: not self.stages[i].isFinished(),
                                                    self.G.predecessors(n)))
                                         for n in xrange(self.G.order()) ]
         for n in self.computeGraphHeads():
             self.enqueue(n)
+        self.initialized = True
         
+    def savePlan(self, filename, key):
+        """save the stages and dependency graph, which are costly to construct for a large
+        pipeline, so that a later invocation with the same key can call loadPlan instead"""
+        plan = { 'key'        : key,
+                 'stages'     : self.stages,
+                 'successors' : [self.G.successors(i) for i in xrange(len(self.stages))] }
+        tmp = filename + ".tmp"
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(plan, f, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            # e.g., a stage with a lambda among its hooks, or an unwritable output directory
+            logger.exception("Unable to save compiled plan; it will be rebuilt next time")
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+        else:
+            os.rename(tmp, filename)
+            logger.info("Saved compiled plan to %s", filename)
+
+    def loadPlan(self, filename, key):
+        """replace the (empty) pipeline by one saved with savePlan; returns False
+        if no plan exists or it was compiled from different options or inputs"""
+        try:
+            with open(filename, 'rb') as f:
+                plan = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            logger.info("No usable compiled plan at %s", filename)
+            return False
+        if plan['key'] != key:
+            logger.info("Compiled plan %s is out of date", filename)
+            return False
+        for stage in plan['stages']:
+            stage.setNone()
+            self.addStage(stage)
+        for i, succs in enumerate(plan['successors']):
+            for j in succs:
+                self.G.add_edge(i, j)
+        self.computeRunnable()
+        logger.info("Loaded compiled plan from %s", filename)
+        return True
+
     """
         Returns True unless all stages are finished, then False
         
@@ -578,6 +1433,10 @@ class Pipeline(object):
             logger.debug("Shutdown event is set ... quitting")
             return False
 
+        elif self.persistent():
+            # more pipelines may yet be submitted
+            return True
+
         elif self.allStagesCompleted():
             logger.info("All stages complete ... done")
             return False
@@ -587,7 +1446,9 @@ class Pipeline(object):
         # (e.g., if some stages have repeatedly failed)
         # TODO this might indicate a bug, so better reporting would be useful
         elif (len(self.runnable) == 0
-            and len(self.currently_running_stages) == 0):
+            and len(self.currently_running_stages) == 0
+            and len(self.awaiting_adoption) == 0
+            and len(self.retry_at) == 0):
             logger.info("ERROR: no more runnable stages, however not all stages have finished. Going to shut down.")
             print("\nERROR: no more runnable stages, however not all stages have finished. Going to shut down.\n")
             sys.stdout.flush()
@@ -624,6 +1485,7 @@ class Pipeline(object):
             return True
 
     def updateClientTimestamp(self, clientURI, tick):
+        """returns the stages the client is to kill (see killStageOnClient)"""
         t = time.time() # use server clock for consistency
         try:
             self.clients[clientURI].timestamp = t
@@ -633,6 +1495,7 @@ class Pipeline(object):
             print("Error: could not find client %s while updating the time stamp" % clientURI)
             logger.exception("clientURI not found in server client list:")
             raise
+        return sorted(self.kills.pop(clientURI, []))
 
     # requires: stages != []
     # a better interface might be (self, [stage]) -> { MemAmount : (NumStages, [Stage]) }
@@ -644,7 +1507,14 @@ class Pipeline(object):
     # this can't be a loop since we call it via sockets and don't want to block the socket forever
     def manageExecutors(self):
         logger.debug("Looping ...")
-        executors_to_launch = self.numberOfExecutorsToLaunch()
+        self.requeueTimedOut()
+        if self.awaiting_adoption and time.time() > self.adoption_deadline:
+            self.abandonAdoptions()
+        if self.options.autoscale:
+            self.autoscale()
+            executors_to_launch = 0
+        else:
+            executors_to_launch = self.numberOfExecutorsToLaunch()
         if executors_to_launch > 0:
             # RAM needed to run a single job:
             memNeeded = self.executor_memory_required(self.runnable)
@@ -686,6 +1556,29 @@ class Pipeline(object):
                     # stages that were associated with the lost client
                     self.unregisterClient(client.clientURI)
 
+    def autoscale(self):
+        """launch executors sized to fit the runnable stages and those expected to become
+        runnable soon (within --seppuku-lookahead, since an executor launched for them would
+        stay alive that long anyway), and retire idle executors which aren't needed"""
+        if self.autoscaler is None:
+            self.autoscaler = Autoscaler(maxExecutors = self.options.num_exec,
+                                         maxMem       = self.memAvail,
+                                         maxProcs     = self.options.proc,
+                                         launch       = lambda shape: self.launchExecutorsFromServer(
+                                                                          1, shape.mem, shape.procs),
+                                         hysteresis   = self.options.autoscale_hysteresis)
+        if self.failed_executors > self.options.max_failed_executors:
+            return
+        now = time.time()
+        horizon = self.options.seppuku_lookahead * 60
+        stages = list(self.runnable) + [j for t, j in self.upcomingStages() if t - now <= horizon]
+        demands = [(self.stages[i].mem, self.stages[i].procs) for i in stages]
+        clients = [(uri, ExecutorShape(c.maxmemory, c.maxprocs or self.options.proc),
+                    sum(self.stages[i].mem for i in c.running_stages),
+                    sum(self.stages[i].procs for i in c.running_stages))
+                   for uri, c in self.clients.iteritems()]
+        self.retiring.update(self.autoscaler.update(demands, clients))
+
     """
         Returns an integer indicating the number of executors to launch
         
@@ -720,12 +1613,20 @@ class Pipeline(object):
         else:
             return 0
         
-    def launchExecutorsFromServer(self, number_to_launch, memNeeded):
+    def launchExecutorsFromServer(self, number_to_launch, memNeeded, procsNeeded=None):
         try:
             logger.info("Launching %i executors", number_to_launch)
+            if submitsExecutors(self.options):
+                # submit all at once as an array job
+                p = Process(target=launchPipelineExecutor,
+                            args=(self.options, memNeeded, self.programName, procsNeeded, number_to_launch))
+                p.start()
+                for i in range(number_to_launch):
+                    self.incrementLaunchedClients()
+                return
             for i in range(number_to_launch):
                 p = Process(target=launchPipelineExecutor,
-                            args=(self.options, memNeeded, self.programName))
+                            args=(self.options, memNeeded, self.programName, procsNeeded))
                 p.start()
                 self.incrementLaunchedClients()
         except:
@@ -735,15 +1636,19 @@ class Pipeline(object):
     def getProcessedStageCount(self):
         return self.num_finished_stages
 
-    def registerClient(self, clientURI, maxmemory):
+    def registerClient(self, clientURI, maxmemory, timeLeft=None, maxprocs=None):
         # Adds new client (represented by a URI string)
         # to array of registered clients. If the server launched
         # its own clients, we should remove 1 from the number of launched and waiting
         # clients (It's possible though that users launch clients themselves. In that 
         # case we should not decrease this variable)
-        self.clients[clientURI] = ExecClient(clientURI, maxmemory)
+        self.clients[clientURI] = ExecClient(clientURI, maxmemory, maxprocs)
+        self.clients[clientURI].setTimeLeft(timeLeft)
+        if self.autoscaler is not None:
+            self.autoscaler.registered(ExecutorShape(maxmemory, maxprocs))
         if self.number_launched_and_waiting_clients > 0:
             self.number_launched_and_waiting_clients -= 1
+        self.recordEvent("register", executor=clientURI, mem=maxmemory, procs=maxprocs)
         logger.debug("Client registered (banzai): %s", clientURI)
         if self.verbose:
             print("Client registered (banzai!): %s" % clientURI)
@@ -756,7 +1661,17 @@ class Pipeline(object):
         try:
             for s in self.clients[clientURI].running_stages.copy():
                 self.setStageLost(s, clientURI)
+            for s in [s for s, uri in self.dispatched.items() if uri == clientURI]:
+                # (sent to it, but never started, so not among its running stages)
+                logger.info("Lost Stage %d: %s: ", s, self.stages[s])
+                self.recordEvent("lost", stage=s, executor=clientURI)
+                self.enqueue(s)
+            for s in [s for s, uri in self.speculative.iteritems() if uri == clientURI]:
+                del self.speculative[s]
+                speculation.discard(s, self.stages[s])
+            self.kills.pop(clientURI, None)
             del self.clients[clientURI]
+            self.recordEvent("unregister", executor=clientURI)
         except:
             if self.verbose:
                 print("Unable to un-register client: " + clientURI)
@@ -766,10 +1681,147 @@ class Pipeline(object):
                 print("Client un-registered (seppuku!): " + clientURI)
             logger.info("Client un-registered (seppuku!): " + clientURI)
 
+    def writeJournal(self, index):
+        # write out the (index, hash) pairs to disk.  We don't actually need the indices
+        # for anything (in fact, the restart code in skip_completed_stages is resilient 
+        # against an arbitrary renumbering of stages), but a human-readable log is somewhat useful.
+        self.finished_stages_fh.write("%d,%s\n" % (index, self.stages[index].getHash()))
+        self.finished_stages_fh.flush()
+        share = self.runnable.shareOf(index)
+        if share.journal_fh is not None:
+            # the pipeline's own journal, numbered as in that pipeline
+            share.journal_fh.write("%d,%s\n" % (self.runnable.local_index[index], self.stages[index].getHash()))
+            share.journal_fh.flush()
+
+    def beginHandoff(self):
+        """Called when this server is about to exit but will be succeeded by another
+        (e.g., the next job in a chain of PBS server jobs).  Records which executor is
+        running each stage, as well as retry counts, for the successor to load, and from
+        now on tells executors to wait for the successor rather than shutting down."""
+        snapshot = { 'running' : [(i, self.stages[i].getHash(), uri, self.stages[i].start_time)
+                                  for uri, c in self.clients.iteritems()
+                                  for i in c.running_stages],
+                     'retries' : [(s.getHash(), s.getNumberOfRetries())
+                                  for s in self.stages if s.getNumberOfRetries() > 0] }
+        tmp = self.handoffLocation + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(snapshot, f)
+        os.rename(tmp, self.handoffLocation)
+        self.handing_off = True
+        logger.info("Handing off %d running stages to the next server", len(snapshot['running']))
+
+    def loadHandoffSnapshot(self):
+        """Mark stages which were running when the previous server handed off as
+        running, pending their executors' reattachment (see reattachClient).
+        Must be called after skip_completed_stages."""
+        try:
+            with open(self.handoffLocation) as f:
+                snapshot = json.load(f)
+        except (IOError, ValueError):
+            logger.info("No hand-off from a previous server")
+            return
+        os.remove(self.handoffLocation)
+        retries = dict(snapshot['retries'])
+        for s in self.stages:
+            s.number_retries = retries.get(s.getHash(), s.number_retries)
+        for i, h, clientURI, start_time in snapshot['running']:
+            # stages are numbered identically by each server, but check just in case
+            if i >= len(self.stages) or self.stages[i].getHash() != h or self.stages[i].isFinished():
+                continue
+            if i in self.runnable:
+                self.runnable.remove(i)
+                self.mem_req_for_runnable.remove(self.stages[i].mem)
+            self.stages[i].setRunning()
+            self.stages[i].start_time = start_time
+            self.awaiting_adoption[i] = clientURI
+        self.adoption_deadline = time.time() + self.options.handoff_timeout * 60
+        logger.info("Awaiting reattachment of executors running %d stages", len(self.awaiting_adoption))
+
+    def reattachClient(self, clientURI, maxmemory, stages, notifications, timeLeft=None, maxprocs=None):
+        """Register an executor which was running the given stages for the previous
+        server, adopting those we expected it to be running, and process the
+        notifications (stage results) it buffered in the meantime.
+        Returns the adopted stages; the executor should kill the others."""
+        self.clients[clientURI] = ExecClient(clientURI, maxmemory, maxprocs)
+        self.clients[clientURI].setTimeLeft(timeLeft)
+        adopted = [i for i in stages if self.awaiting_adoption.get(i) == clientURI]
+        for i in adopted:
+            del self.awaiting_adoption[i]
+            start_time = self.stages[i].start_time
+            self.stages[i].setNone()
+            self.setStageStarted(i, clientURI)
+            self.stages[i].start_time = start_time
+        logger.info("Client %s reattached; adopted stages %s", clientURI, adopted)
+        for n in notifications:
+            if n[0] == "setStagesTerminated":
+                self.setStagesTerminated([r for r in n[1] if r[0] in adopted], clientURI)
+            elif n[0] == "setGangTerminated" and all(i in adopted for i in n[1]):
+                self.setGangTerminated(n[1], n[2], clientURI)
+            elif n[0] == "setSpeculativeStageTerminated":
+                # (not a duplicate this server started, so its outputs are discarded)
+                self.setSpeculativeStageTerminated(n[1][0], n[2], n[3], clientURI)
+        return adopted
+
+    def abandonAdoptions(self):
+        """give up on executors which haven't reattached to the new server in time"""
+        logger.info("Executors didn't reattach; rerunning stages %s", self.awaiting_adoption.keys())
+        for i in self.awaiting_adoption.keys():
+            del self.awaiting_adoption[i]
+            self.stages[i].setNone()
+            if self.checkIfRunnable(i):
+                self.enqueue(i)
+
     def incrementLaunchedClients(self):
         self.number_launched_and_waiting_clients += 1
 
+    def upToDateStages(self, mode):
+        """Make-style freshness check: the set of (indices of) stages whose outputs
+        all exist and are newer than all their inputs.  With mode "digest", a stage
+        with some newer inputs is also up to date if the contents of those inputs
+        match those the stage was last run with."""
+        cmd_stages = [i for i in xrange(len(self.stages)) if isinstance(self.stages[i], CmdStage)]
+        files = set()
+        for i in cmd_stages:
+            files.update(self.stages[i].inputFiles)
+            files.update(self.stages[i].outputFiles)
+        starttime = time.time()
+        stats = fh.statFiles(files, threads=self.options.stat_threads)
+        logger.info("Checked %d files in %.1f s", len(files), time.time() - starttime)
+
+        up_to_date = set()
+        # (index, inputs newer than outputs) for possible "touched" inputs:
+        to_compare = []
+        for i in cmd_stages:
+            s = self.stages[i]
+            outputs = [stats[f] for f in s.outputFiles]
+            inputs  = [stats[f] for f in s.inputFiles]
+            if not outputs or None in outputs or None in inputs:
+                continue
+            oldest_output = min(mtime for mtime, _ in outputs)
+            newer = [f for f in s.inputFiles if stats[f][0] > oldest_output]
+            if not newer:
+                up_to_date.add(i)
+            elif mode == "digest":
+                to_compare.append((i, newer))
+
+        if to_compare:
+            try:
+                previous = fh.readDigests(self.inputDigestsLocation)
+            except:
+                logger.info("Input digests file doesn't exist or is corrupt.")
+                previous = {}
+            to_compare = [(i, newer) for i, newer in to_compare
+                          if str(self.stages[i].getHash()) in previous]
+            current = fh.digestFiles(set(f for _, newer in to_compare for f in newer),
+                                     threads=self.options.stat_threads)
+            for i, newer in to_compare:
+                recorded = previous[str(self.stages[i].getHash())]
+                if all(recorded.get(f) == current[f] for f in newer):
+                    up_to_date.add(i)
+        return up_to_date
+
     def skip_completed_stages(self):
+        mode = self.options.restart_check
         try:
             with open(self.backupFileLocation, 'r') as fh:
                 # a stage's index is just an artifact of the graph construction,
@@ -777,7 +1829,15 @@ class Pipeline(object):
                 previous_hashes = frozenset((int(e.split(',')[1]) for e in fh.read().split()))
         except:
             logger.info("Finished stages log doesn't exist or is corrupt.")
-            return
+            if mode == "journal":
+                return
+            previous_hashes = frozenset()
+        if mode == "journal":
+            isCompleted = lambda i: self.stages[i].getHash() in previous_hashes
+        else:
+            # the filesystem, not the log, is authoritative
+            up_to_date = self.upToDateStages(mode)
+            isCompleted = lambda i: i in up_to_date
         self.finished_stages_fh = open(self.backupFileLocation, 'w')
         runnable  = []
         completed = 0
@@ -800,8 +1860,8 @@ class Pipeline(object):
                 runnable.append(i)
                 continue
 
-            # we've never run this command before
-            if not s.getHash() in previous_hashes:
+            # we've never run this command before (or its outputs are out of date)
+            if not isCompleted(i):
                 runnable.append(i)
                 continue
 
@@ -831,12 +1891,21 @@ class Pipeline(object):
         print("######################################################\n")
         logger.debug("Clients still registered at shutdown: " + str(self.clients))
         sys.stdout.flush()
-
-def launchPipelineExecutor(options, memNeeded, programName=None):
-    """Launch pipeline executor directly from pipeline"""
-    pipelineExecutor = pe.pipelineExecutor(options, memNeeded)
-    if options.queue_type == "sge":
-        pipelineExecutor.submitToQueue(programName)
+        if self.events is not None:
+            self.events.flush()
+
+def submitsExecutors(options):
+    """whether the server submits executors to the queueing system, rather than
+    running them itself (as when the server is itself submitted as a job, e.g., on PBS)"""
+    backend = queueing.queueBackend(options)
+    return backend is not None and not backend.submits_server
+
+def launchPipelineExecutor(options, memNeeded, programName=None, procsNeeded=None, number=1):
+    """Launch pipeline executor directly from pipeline (or, when the server
+    submits executors to the queueing system, submit `number` of them)"""
+    pipelineExecutor = pe.pipelineExecutor(options, memNeeded, procsNeeded)
+    if submitsExecutors(options):
+        pipelineExecutor.submitToQueue(programName, number)
     else:
         pe.launchExecutor(pipelineExecutor)
         
@@ -852,7 +1921,7 @@ def launchServer(pipeline, options):
     # rather baroque anyway, and arguably launchServer/pipelineDaemon ought to be
     # a single method with cleaned-up initialization
     #executors_local = pipeline.options.local or (pipeline.options.queue_type is None)
-    executors_local = pipeline.options.queue_type in [None, 'pbs']
+    executors_local = not submitsExecutors(pipeline.options)
     if executors_local:
         # measured once -- we assume that server memory usage will be
         # roughly constant at this point
@@ -942,19 +2011,20 @@ def launchServer(pipeline, options):
         h.daemon = True
         h.start()
 
-        try:
-            jid    = os.environ["PBS_JOBID"]
-            output = check_output(['qstat', '-f', jid])
-
-            time_left = int(re.search('Walltime.Remaining = (\d*)', output).group(1))
+        time_left = queueing.remainingWalltime()
+        if time_left is not None:
             logger.debug("Time remaining: %d s" % time_left)
             time_to_live = time_left - shutdown_time
-        except:
+        else:
             logger.info("I couldn't determine your remaining walltime from qstat.")
             time_to_live = None
         flag = pipeline.shutdown_ev.wait(time_to_live)
         if not flag:
             logger.info("Time's up!")
+            if options.handoff:
+                p.beginHandoff()
+                # give executors time to receive the hand-off command
+                time.sleep(pe.WAIT_TIMEOUT + options.latency_tolerance)
         pipeline.shutdown_ev.set()
 
     # FIXME if we terminate abnormally, we should _actually_ kill child executors (if running locally)
@@ -999,6 +2069,16 @@ def flatten_pipeline(p):
                 
     return sorted([(i, str(p.stages[i]), p.G.predecessors(i)) for i in p.G.nodes_iter()],cmp=post)
 
+def sge_script(p):
+    """return the SGE commands submitting each stage as a held job, adding
+       the dependencies between them, and then releasing them all.
+       (See direct_submission.py for running a pipeline in this way.)
+    """
+    flat = flatten_pipeline(p)
+    return (["qsub -h -N job_%d %s" % (i, cmd) for i, cmd, _ in flat]
+            + ["qalter -hold_jid job_%d job_%d" % (d, i) for i, _, deps in flat for d in deps]
+            + ["qalter -h U job_%d" % i for i, _, _ in flat])
+
 def pipelineDaemon(pipeline, options, programName=None):
     """Launches Pyro server and (if specified by options) pipeline executors"""
 
@@ -1009,8 +2089,11 @@ def pipelineDaemon(pipeline, options, programName=None):
         logger.debug("Examining filesystem to determine skippable stages...")
         pipeline.skip_completed_stages()
 
+    if options.handoff:
+        pipeline.loadHandoffSnapshot()
+
     #check for valid pipeline 
-    if len(pipeline.runnable) == 0:
+    if len(pipeline.runnable) == 0 and len(pipeline.awaiting_adoption) == 0 and not pipeline.persistent():
         print("Pipeline has no runnable stages. Exiting...")
         sys.exit()
    
@@ -1025,8 +2108,15 @@ def pipelineDaemon(pipeline, options, programName=None):
         # previously completed stages to it in skip_completed_stages
         with open(pipeline.backupFileLocation, 'a') as fh:
             pipeline.finished_stages_fh = fh
-            logger.debug("Starting server...")
-            launchServer(pipeline, options)
+            if options.submit_stages:
+                logger.debug("Submitting stages as jobs...")
+                DirectSubmission(pipeline, options).run()
+            elif options.local_fast:
+                logger.debug("Running stages in-process...")
+                LocalEngine(pipeline, options).run()
+            else:
+                logger.debug("Starting server...")
+                launchServer(pipeline, options)
     except:
         logger.exception("Exception (=> quitting): ")
         raise
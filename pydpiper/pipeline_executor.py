@@ -4,12 +4,17 @@ from __future__ import print_function
 import time
 import sys
 import os
+import errno
 from configargparse import ArgParser
 from datetime import datetime
 from multiprocessing import Process, Pool
 import subprocess
 import shlex
 import pydpiper.queueing as q
+from pydpiper.result_cache import ResultCache
+from pydpiper.memory_limits import MemoryLimiter
+from pydpiper.cpu_affinity import CPUAllocator, setAffinity
+import pydpiper.resources as resources
 import atoms_and_modules.registration_functions as rf
 import logging
 import socket
@@ -23,6 +28,25 @@ Pyro4.config.SERVERTYPE = "multiplex"
 #TODO add these to executorArgumentGroup as options, pass into pipelineExecutor
 WAIT_TIMEOUT = 5.0
 HEARTBEAT_INTERVAL = 10.0
+# reported in place of the exit status of a stage killed for exceeding its time limit
+TIMED_OUT = "timeout"
+# ... and of one killed (most likely) for running out of memory
+OUT_OF_MEMORY = "oom"
+# a stage killed by SIGKILL after using at least this fraction of its memory
+# is presumed to have been killed for exceeding it
+OOM_RSS_FRACTION = 0.9
+# ... and of one which exceeded the limit set with --enforce-memory
+MEMORY_LIMIT_EXCEEDED = "memory_limit"
+# environment variables through which common libraries (OpenMP, ITK, BLAS, ...)
+# are told how many threads to use, set to the number of processors a stage requires
+THREAD_VARIABLES = ["OMP_NUM_THREADS", "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+                    "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS",
+                    "VECLIB_MAXIMUM_THREADS"]
+# seconds between checks on the processes of a gang (streamed producer and consumer)
+GANG_POLL_INTERVAL = 0.5
+# seconds a producer may carry on after its consumer has exited successfully
+# before it's presumed to be blocked on the pipe, and killed
+GANG_GRACE_PERIOD = 10
 #SHUTDOWN_TIME = WAIT_TIMEOUT + LATENCY_TOLERANCE
 
 logger = logging.getLogger(__name__)
@@ -75,7 +99,11 @@ def addExecutorArgumentGroup(parser):
     group.add_argument("--queue-name", dest="queue_name", type=str, default=None,
                        help="Name of the queue, e.g., all.q (MICe) or batch (SciNet)")
     group.add_argument("--queue-type", dest="queue_type", type=str, default=None,
-                       help="""Queue type to submit jobs, i.e., "sge" or "pbs".  [Default = %(default)s]""")              
+                       help="""Queue type to submit jobs, i.e., "sge", "pbs" or "slurm".  [Default = %(default)s]""")              
+    group.add_argument("--pbs-array-style", dest="pbs_array_style",
+                       type=str, default="torque", choices=["torque", "pbspro"],
+                       help="Kind of PBS job arrays used to submit many executors at once: "
+                            "'torque' (qsub -t) or 'pbspro' (qsub -J). [Default = %(default)s]")
     group.add_argument("--queue-opts", dest="queue_opts",
                        type=str, default="",
                        help="A string of extra arguments/flags to pass to qsub. [Default = %(default)s]")
@@ -84,10 +112,18 @@ def addExecutorArgumentGroup(parser):
     group.add_argument("--time-to-seppuku", dest="time_to_seppuku", 
                        type=int, default=1,
                        help="The number of minutes an executor is allowed to continuously sleep, i.e. wait for an available job, while active on a compute node/farm before it kills itself due to resource hogging. [Default = %(default)s]")
+    group.add_argument("--seppuku-lookahead", dest="seppuku_lookahead",
+                       type=float, default=10,
+                       help="After --time-to-seppuku minutes of idleness, remain for up to this many further "
+                            "minutes if the server expects that the stages currently running will soon "
+                            "make work for this executor. [Default = %(default)s]")
     group.add_argument("--time-to-accept-jobs", dest="time_to_accept_jobs", 
                        type=int,
                        help="The number of minutes after which an executor will not accept new jobs anymore. This can be useful when running executors on a batch system where other (competing) jobs run for a limited amount of time. The executors can behave in a similar way by giving them a rough end time. [Default = %(default)s]")
     group.add_argument('--local', dest="local", action='store_true', default=False, help="Don't submit anything to any specified queueing system but instead run as a server/executor")
+    group.add_argument('--local-fast', dest="local_fast", action='store_true', default=False,
+                       help="Run all stages on this machine (as many at once as fit in --mem and --proc) "
+                            "directly from the main process, without a server or executors. [Default = %(default)s]")
     group.add_argument("--config-file", type=str, metavar='config_file', is_config_file=True,
                        required=False, help='Config file location')
     group.add_argument("--prologue-file", type=str, metavar='file',
@@ -96,6 +132,135 @@ def addExecutorArgumentGroup(parser):
             help="Min walltime (s) allowed by the queuing system [Default = %(default)s]")
     group.add_argument("--max-walltime", dest="max_walltime", type=int, default = None,
             help="Max walltime (s) allowed for jobs on the queuing system, or infinite if None [Default = %(default)s]")
+    group.add_argument("--stream-intermediates", dest="stream_intermediates",
+                       action="store_true", default=False,
+                       help="Run a producer stage and its (sole) consumer simultaneously on one executor, "
+                            "passing files both have declared streamable through a named pipe "
+                            "instead of writing them to disk. [Default = %(default)s]")
+    group.add_argument("--batch-small-stages", dest="batch_size",
+                       type=int, default=1,
+                       help="Dispatch up to this many short stages (see --small-stage-runtime) together, "
+                            "to be run one after another by a single executor process. [Default = %(default)s]")
+    group.add_argument("--small-stage-runtime", dest="small_stage_runtime",
+                       type=float, default=5.0,
+                       help="Stages whose estimated runtime (s) is at most this are eligible for batching. [Default = %(default)s]")
+    group.add_argument("--handoff", dest="handoff",
+                       action="store_true", default=False,
+                       help="When the server runs out of walltime, have it record its running stages for "
+                            "its successor (e.g., the next in a chain of PBS server jobs), and have executors "
+                            "keep running their stages and reconnect to the successor. [Default = %(default)s]")
+    group.add_argument("--handoff-timeout", dest="handoff_timeout",
+                       type=float, default=30,
+                       help="Time (in minutes) executors wait for a successor server, and that server waits "
+                            "for executors to reattach, before giving up. [Default = %(default)s]")
+    group.add_argument("--runtime-safety-factor", dest="runtime_safety_factor",
+                       type=float, default=1.5,
+                       help="Only give an executor stages whose estimated runtime, multiplied by this factor, "
+                            "is less than its remaining walltime. [Default = %(default)s]")
+    group.add_argument("--autoscale", dest="autoscale",
+                       action="store_true", default=False,
+                       help="Launch executors of various sizes (up to --mem and --proc) to fit the memory and "
+                            "processor requirements of runnable stages, rather than identical ones, and "
+                            "retire unneeded idle executors. [Default = %(default)s]")
+    group.add_argument("--autoscale-hysteresis", dest="autoscale_hysteresis",
+                       type=int, default=2,
+                       help="Number of consecutive server loop iterations (every 5s) for which an executor "
+                            "must be needed (or not needed) before it's launched (or retired). "
+                            "[Default = %(default)s]")
+    group.add_argument("--merge-equivalent-stages", dest="merge_equivalent_stages",
+                       action="store_true", default=False,
+                       help="Run only one of a set of stages whose commands differ only in their output files, "
+                            "linking its outputs into place for the others. [Default = %(default)s]")
+    group.add_argument("--result-cache-dir", dest="result_cache_dir",
+                       type=str, default=None,
+                       help="Directory of a cache of stage outputs, shared across pipelines.  A stage whose "
+                            "command and input file contents match a cached result has its outputs copied "
+                            "(as reflinks where supported) from the cache instead of being run. [Default = %(default)s (no caching)]")
+    group.add_argument("--result-cache-size", dest="result_cache_size",
+                       type=float, default=100,
+                       help="Size (in GB) beyond which least recently used cache entries are removed. [Default = %(default)s]")
+    group.add_argument("--submit-stages", dest="submit_stages",
+                       action="store_true", default=False,
+                       help="Instead of running a server and executors, submit each stage as its own job "
+                            "to the queueing system (--queue-type), with job dependencies mirroring those "
+                            "between stages. Suits pipelines of a few long stages. [Default = %(default)s]")
+    group.add_argument("--fuse-chains", dest="fuse_chains",
+                       action="store_true", default=False,
+                       help="With --submit-stages, run chains of stages (each the only remaining successor "
+                            "of the last) as a single job. [Default = %(default)s]")
+    group.add_argument("--stage-mem", dest="stage_mem",
+                       type=str, default=None,
+                       help="With --submit-stages, memory (in GB) to request for the stages running each "
+                            "of some programs, as program=GB,... (e.g., 'mincANTS=16,minctracc=4').  Stages "
+                            "computing their requirements from inputs which don't exist when the pipeline is "
+                            "submitted are otherwise given --default-job-mem. [Default = %(default)s]")
+    group.add_argument("--persistent-server", dest="persistent_server",
+                       action="store_true", default=False,
+                       help="Keep the server running once its stages are done, so that further "
+                            "pipelines can be submitted to it with --join-server. [Default = %(default)s]")
+    group.add_argument("--join-server", dest="join_server",
+                       type=str, default=None, metavar="URI_FILE",
+                       help="Rather than running this pipeline, add it to the --persistent-server whose "
+                            "URI is in the given file, sharing that server's executors with its other "
+                            "pipelines. [Default = %(default)s]")
+    group.add_argument("--share-weight", dest="share_weight",
+                       type=float, default=1.0,
+                       help="With --join-server, this pipeline's share of the executors relative to "
+                            "the server's other pipelines. [Default = %(default)s]")
+    group.add_argument("--stage-timeout-factor", dest="stage_timeout_factor",
+                       type=float, default=None, metavar="F",
+                       help="Kill a stage (with any processes it started) which has run for F times its "
+                            "estimated runtime (learned from its tool's previous stages, otherwise a static "
+                            "default), but at least 10 minutes, as it has presumably hung; it's retried after "
+                            "a delay, on another executor if there is one. [Default = %(default)s (no limit)]")
+    group.add_argument("--enforce-memory", dest="enforce_memory",
+                       type=str, default=None, choices=["rlimit", "cgroup"],
+                       help="Limit each stage's memory to that it requires (times --memory-slack), so a stage "
+                            "using too much fails (and is retried with more) without endangering others on "
+                            "its node: with a resource limit on its data segment, or by running it in a "
+                            "cgroup of its own (if the executor can create cgroups; this also detects "
+                            "violations reliably). [Default = %(default)s (no limit)]")
+    group.add_argument("--memory-slack", dest="memory_slack",
+                       type=float, default=1.25,
+                       help="With --enforce-memory, the factor by which a stage's memory limit exceeds "
+                            "its requirement. [Default = %(default)s]")
+    group.add_argument("--pin-cpus", dest="pin_cpus",
+                       action="store_true", default=False,
+                       help="Restrict each stage to as many of its executor's CPUs as it requires processors, "
+                            "not shared with other stages and from a single NUMA node where possible. "
+                            "[Default = %(default)s]")
+    group.add_argument("--speculate", dest="speculation_factor",
+                       type=float, default=None, metavar="K",
+                       help="Run a duplicate of an idempotent stage (e.g., minctracc, mincANTS) which has been "
+                            "running for K times the median runtime of its tool on an executor with nothing "
+                            "else to do, keeping the outputs of whichever finishes first. "
+                            "[Default = %(default)s (no duplicates)]")
+    group.add_argument("--node-agent", dest="node_agent",
+                       action="store_true", default=False,
+                       help="Run as a node agent: lease as many stages as fit on this node at once, "
+                            "run them without contacting the server, and report their results in "
+                            "batches, reducing traffic to the server on large clusters. [Default = %(default)s]")
+    group.add_argument("--agent-interval", dest="agent_interval",
+                       type=float, default=1.0,
+                       help="With --node-agent, the minimum time (in seconds) between a node agent's "
+                            "calls to the server to report results and lease stages. [Default = %(default)s]")
+    group.add_argument("--executor-resources", dest="executor_resources",
+                       type=resources.parseResources, default=None, metavar="NAME=AMOUNT,...",
+                       help="Amounts of resources other than memory and processors (e.g., 'io_tokens=4,"
+                            "scratch_gb=200') each executor has for its stages; an executor has no limit on "
+                            "those not given. [Default = %(default)s]")
+    group.add_argument("--resource-pools", dest="resource_pools",
+                       type=resources.parseResources, default=None, metavar="NAME=AMOUNT,...",
+                       help="Limits on the total amounts of resources (e.g., 'io_tokens=16') which stages "
+                            "running at once on all executors may require, enforced by the server. "
+                            "[Default = %(default)s (no limits)]")
+    group.add_argument("--event-journal", dest="event_journal",
+                       action="store_true", default=False,
+                       help="Record the server's scheduling activity (stages dispatched, started, finished, "
+                            "failed, retried or lost, and executors registering and unregistering) in "
+                            "<pipeline name>_events.jsonl in the output directory, one JSON object per event, "
+                            "in place of logging each stage's start and finish (with its command) at INFO "
+                            "level. [Default = %(default)s]")
     group.add_argument("--default-job-mem", dest="default_job_mem",
                        type=float, default = 1.75,
                        help="Memory (in GB) to allocate to jobs which don't make a request. [Default=%(default)s]")
@@ -119,26 +284,17 @@ def launchExecutor(executor):
     daemon = Pyro4.core.Daemon(host=network_address)
     clientURI = daemon.register(executor)
 
-    # find the URI of the server:
-    if executor.ns:
-        ns = Pyro4.locateNS()
-        #ns.register("executor", executor, safe=True)
-        serverURI = ns.lookup("pipeline")
-    else:
-        try:
-            uf = open(executor.uri_file)
-            serverURI = Pyro4.URI(uf.readline())
-            uf.close()
-        except:
-            logger.exception("Problem opening the specified uri file:")
-            raise
+    serverURI = executor.findServerURI()
 
     p = Pyro4.Proxy(serverURI)
     # Register the executor with the pipeline
     # the following command only works if the server is alive. Currently if that's
     # not the case, the executor will die which is okay, but this should be
     # more properly handled: a more elegant check to verify the server is running
-    p.registerClient(clientURI.asString(), executor.mem)
+    walltime = q.remainingWalltime()
+    if walltime is not None:
+        executor.end_time = time.time() + walltime
+    p.registerClient(clientURI.asString(), executor.mem, executor.timeLeft(), executor.procs)
 
     executor.registeredWithServer()
     executor.setClientURI(clientURI.asString())
@@ -147,6 +303,8 @@ def launchExecutor(executor):
     
     logger.info("Connected to %s",  serverURI)
     logger.info("Client URI is %s", clientURI)
+    if executor.task_id is not None:
+        logger.info("Running as task %d of an array job", executor.task_id)
     
     executor.connection_time_with_server = time.time()
     logger.info("Connected to the server at: %s", datetime.isoformat(datetime.now(), " "))
@@ -161,9 +319,7 @@ def launchExecutor(executor):
         t = threading.Thread(target=daemon.requestLoop)
         t.daemon = True
         t.start()
-        h = threading.Thread(target=executor.heartbeat)
-        h.daemon = True
-        h.start()
+        executor.startHeartbeat()
         executor.mainLoop()
     except KeyboardInterrupt:
         logger.exception("Caught keyboard interrupt. Shutting down executor...")
@@ -181,7 +337,134 @@ def launchExecutor(executor):
         daemon.shutdown()
         t.join()
 
-def runStage(serverURI, clientURI, i):
+def cgroupOOMKills():
+    """the number of processes the kernel has killed for exceeding the memory
+    limit of our cgroup (v2, or v1 with a recent kernel), or None if unknown"""
+    try:
+        with open("/proc/self/cgroup") as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return None
+    for line in lines:
+        _, controllers, path = line.split(":", 2)
+        if controllers == "":
+            filename = os.path.join("/sys/fs/cgroup" + path, "memory.events")
+        elif "memory" in controllers.split(","):
+            filename = os.path.join("/sys/fs/cgroup/memory" + path, "memory.oom_control")
+        else:
+            continue
+        try:
+            with open(filename) as f:
+                for l in f:
+                    if l.startswith("oom_kill "):
+                        return int(l.split()[1])
+        except (IOError, ValueError):
+            pass
+    return None
+
+def outOfMemory(returncode, maxrss, mem, oom_kills_before, oom_kills_after):
+    """whether a process with the given exit status and maximum RSS (in KB) was most
+    likely killed for exceeding its memory allowance mem (in GB): by SIGKILL, after using
+    nearly all of it or as counted by our cgroup's OOM killer"""
+    if returncode != -signal.SIGKILL:
+        return False
+    if oom_kills_before is not None and oom_kills_after is not None and oom_kills_after > oom_kills_before:
+        return True
+    return mem is not None and maxrss >= OOM_RSS_FRACTION * mem * 1024 * 1024
+
+def threadEnvironment(procs):
+    """the environment for a stage's process, telling it to use procs threads"""
+    env = dict(os.environ)
+    if procs is not None:
+        for var in THREAD_VARIABLES:
+            env[var] = str(int(procs))
+    return env
+
+def runProcess(client, i, args, of, timeout=None, mem=None, limiter=None, procs=None, cpus=None):
+    """Run stage i's process, in a process group of its own so that any processes
+    it starts can be killed with it, and using procs threads on the given cpus (if any).
+    Returns its exit status, or TIMED_OUT if it was killed for running for longer than
+    timeout seconds, MEMORY_LIMIT_EXCEEDED if it used more than the limit set by the
+    limiter (if any), or OUT_OF_MEMORY if it was (apparently) killed for using more
+    than mem GB."""
+    oom_kills = cgroupOOMKills()
+    if not mem:
+        limiter = None
+    cgroup = limiter.createCgroup(i, mem) if limiter is not None else None
+    def preexec():
+        os.setsid()
+        if limiter is not None:
+            limiter.apply(mem, cgroup)
+        if cpus:
+            setAffinity(cpus)
+    process = subprocess.Popen(args, stdout=of, stderr=of, shell=False, preexec_fn=preexec,
+                               env=threadEnvironment(procs))
+    client.addPIDtoRunningList(process.pid, i)
+    timed_out = threading.Event()
+    def reap():
+        logger.warn("Stage %i has run for longer than its limit of %.0fs; killing it", i, timeout)
+        timed_out.set()
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass  # (just exited)
+    timer = threading.Timer(timeout, reap) if timeout is not None else None
+    if timer is not None:
+        timer.daemon = True
+        timer.start()
+    # (wait4 rather than communicate, to get the resources used by this process alone)
+    while True:
+        try:
+            _, status, usage = os.wait4(process.pid, 0)
+            break
+        except OSError as e:
+            if e.errno != errno.EINTR:
+                raise
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    if timer is not None:
+        timer.cancel()
+    client.removePIDfromRunningList(process.pid)
+    exceeded = False
+    if limiter is not None:
+        exceeded = limiter.exceeded(mem, cgroup, process.returncode, usage.ru_maxrss)
+        limiter.removeCgroup(cgroup)
+    if timed_out.is_set() and process.returncode == -signal.SIGKILL:
+        of.write("Killed after running for longer than the limit of %.0fs\n" % timeout)
+        return TIMED_OUT
+    if exceeded:
+        of.write("Failed after exceeding its memory limit of %.2fG\n" % (limiter.limit(mem) / 1024.0 ** 3))
+        return MEMORY_LIMIT_EXCEEDED
+    if outOfMemory(process.returncode, usage.ru_maxrss, mem, oom_kills, cgroupOOMKills()):
+        of.write("Killed, apparently for running out of memory (%.2fG allowed, %.2fG used)\n"
+                 % (mem or 0, usage.ru_maxrss / (1024.0 * 1024)))
+        return OUT_OF_MEMORY
+    return process.returncode
+
+def executeStage(client, i, command_to_run, command_logfile, files=None, result_cache=None,
+                 timeout=None, mem=None, limiter=None, procs=None, cpus=None):
+    """run a stage's command (or restore its outputs from the result cache),
+    returning its exit status (or TIMED_OUT)"""
+    logger.info(command_to_run)
+    # log file for the stage
+    of = open(command_logfile, 'a')
+    of.write("Stage " + str(i) + " running on " + socket.gethostname() + " at " + datetime.isoformat(datetime.now(), " ") + ":\n")
+    of.write(command_to_run + "\n")
+    of.flush()
+
+    args = shlex.split(command_to_run) 
+    key = result_cache.key(args, *files) if files is not None else None
+    if key is not None and result_cache.materialize(key, files[1]):
+        logger.info("Stage %i restored from result cache (%s)", i, key)
+        of.write("Outputs restored from result cache entry " + key + "\n")
+        ret = 0
+    else:
+        ret = runProcess(client, i, args, of, timeout, mem, limiter, procs, cpus)
+        if ret == 0 and key is not None:
+            result_cache.store(key, files[1])
+    of.close()
+    return ret
+
+def runStage(serverURI, clientURI, i, result_cache=None, mem=None, limiter=None, procs=None, cpus=None):
     ## Proc needs its own proxy as it's independent of executor
     p = Pyro4.core.Proxy(serverURI)
     client = Pyro4.core.Proxy(clientURI)
@@ -189,59 +472,209 @@ def runStage(serverURI, clientURI, i):
     # Retrieve stage information, run stage and set finished or failed accordingly  
     try:
         logger.info("Running stage %i (on %s)", i, clientURI)
-        logger.debug("Memory requested: %.2f", p.getStageMem(i))
         p.setStageStarted(i, clientURI)
         try:
             # get stage information
             command_to_run  = str(p.getStageCommand(i))
-            logger.info(command_to_run)
             command_logfile = p.getStageLogfile(i)
-            
-            # log file for the stage
-            of = open(command_logfile, 'a')
-            of.write("Stage " + str(i) + " running on " + socket.gethostname() + " at " + datetime.isoformat(datetime.now(), " ") + ":\n")
-            of.write(command_to_run + "\n")
-            of.flush()
-            
-            args = shlex.split(command_to_run) 
-            process = subprocess.Popen(args, stdout=of, stderr=of, shell=False)
-            client.addPIDtoRunningList(process.pid)
-            process.communicate()
-            client.removePIDfromRunningList(process.pid)
-            ret = process.returncode 
-            of.close()
+            files = p.getStageFiles(i) if result_cache is not None else None
+            ret = executeStage(client, i, command_to_run, command_logfile, files, result_cache,
+                               p.getStageTimeout(i), mem, limiter, procs, cpus)
         except:
             logger.exception("Exception whilst running stage: %i (on %s)", i, clientURI)   
             client.notifyStageTerminated(i)
         else:
-            logger.info("Stage %i finished, return was: %i (on %s)", i, ret, clientURI)
+            logger.info("Stage %i finished, return was: %s (on %s)", i, ret, clientURI)
             client.notifyStageTerminated(i, ret)
-
-        # If completed, return mem & processes back for re-use
-        return (p.getStageMem(i), p.getStageProcs(i))
+        # (don't contact the server again here, since after a hand-off it may be gone)
     except:
         logger.exception("Error communicating to server in runStage. " 
                         "Error raised to calling thread in launchExecutor. ")
         raise     
         
 
+def runSpeculativeStage(serverURI, clientURI, i, procs=None, cpus=None):
+    """run a duplicate of straggling stage i, which writes its outputs elsewhere"""
+    p = Pyro4.core.Proxy(serverURI)
+    client = Pyro4.core.Proxy(clientURI)
+    start = time.time()
+    ret = None
+    try:
+        logger.info("Running a duplicate of stage %i (on %s)", i, clientURI)
+        command_to_run, command_logfile = p.getSpeculativeCommand(i)
+        ret = executeStage(client, i, str(command_to_run), command_logfile, procs=procs, cpus=cpus)
+        logger.info("Duplicate of stage %i finished, return was: %s (on %s)", i, ret, clientURI)
+    except:
+        logger.exception("Exception whilst running a duplicate of stage: %i (on %s)", i, clientURI)
+    # (via the executor, which buffers the result during a hand-off)
+    client.notifySpeculativeStageTerminated(i, ret, time.time() - start)
+
+def runLeasedStage(clientURI, lease, result_cache=None, limiter=None, cpus=None):
+    """Run a stage leased by a node agent.  Everything needed was sent with the
+    lease, so (unlike runStage) this doesn't contact the server; the agent collects
+    the returned (index, returncode, runtime) to report with others."""
+    client = Pyro4.core.Proxy(clientURI)
+    i, command_to_run, command_logfile, mem, procs, files, timeout, _ = lease
+    start = time.time()
+    ret = None
+    try:
+        logger.info("Running leased stage %i (on %s)", i, clientURI)
+        ret = executeStage(client, i, command_to_run, command_logfile,
+                           files if result_cache is not None else None, result_cache, timeout, mem,
+                           limiter, procs, cpus)
+        logger.info("Stage %i finished, return was: %s (on %s)", i, ret, clientURI)
+    except:
+        logger.exception("Exception whilst running stage: %i (on %s)", i, clientURI)
+    return (i, ret, time.time() - start)
+
+def runBatch(serverURI, clientURI, indices, result_cache=None, limiter=None, cpus=None):
+    """Run a batch of (short) stages one after another, using only one call
+    to the server to fetch their commands and one to report their results"""
+    p = Pyro4.core.Proxy(serverURI)
+    client = Pyro4.core.Proxy(clientURI)
+    try:
+        logger.info("Running stages %s (on %s)", indices, clientURI)
+        p.setStagesStarted(indices, clientURI)
+        results = []
+        files = p.getStagesFiles(indices) if result_cache is not None else [None] * len(indices)
+        for (i, command_to_run, command_logfile, timeout, mem, procs), f in zip(p.getStagesInfo(indices), files):
+            start = time.time()
+            ret = None
+            try:
+                ret = executeStage(client, i, str(command_to_run), command_logfile, f, result_cache,
+                                   timeout, mem, limiter, procs, cpus)
+            except:
+                logger.exception("Exception whilst running stage: %i (on %s)", i, clientURI)
+            results.append((i, ret, time.time() - start))
+        logger.info("Stages %s finished, returns were: %s (on %s)", indices, [r[1] for r in results], clientURI)
+        client.notifyStagesTerminated(results)
+    except:
+        logger.exception("Error communicating to server in runBatch. "
+                        "Error raised to calling thread in launchExecutor. ")
+        raise
+
+def killGroup(process):
+    """kill a stage's process and any it started (in its process group)"""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass  # (just exited)
+
+def waitForGang(client, processes, fifo):
+    """Wait for a gang's producer and consumer (a list of (process, log file) pairs)
+    to exit, returning their exit statuses.  The two are polled together, since
+    either may be left blocked on the pipe by the other: if one fails, the other is
+    killed, and a producer still running well after its consumer has exited (e.g.,
+    without ever opening the pipe) is presumed blocked opening it, and killed."""
+    returncodes = [None, None]
+    producer, consumer = [process for process, _ in processes]
+    eof_given = False
+    consumer_done = None
+    while True:
+        for k, (process, of) in enumerate(processes):
+            if returncodes[k] is None and process.poll() is not None:
+                returncodes[k] = process.returncode
+                client.removePIDfromRunningList(process.pid)
+                of.close()
+        if None not in returncodes:
+            return returncodes
+        produced, consumed = returncodes
+        if produced is not None and produced != 0:
+            # the consumer won't see any (complete) input, so don't leave it hanging
+            killGroup(consumer)
+        elif produced == 0 and not eof_given:
+            # the producer may have exited without opening the pipe, in which case
+            # the consumer is still blocked opening it; give it an EOF
+            try:
+                os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            eof_given = True
+        elif consumed is not None and consumed != 0:
+            killGroup(producer)
+        elif consumed is not None:
+            consumer_done = consumer_done or time.time()
+            if time.time() - consumer_done > GANG_GRACE_PERIOD:
+                logger.warn("Producer still running %.0fs after its consumer exited; killing it",
+                            GANG_GRACE_PERIOD)
+                killGroup(producer)
+        time.sleep(GANG_POLL_INTERVAL)
+
+def runGang(serverURI, clientURI, indices, cpus=None):
+    """Run a producer and its consumer at the same time, connected by a named pipe
+    which takes the place of the intermediate file (and each using as many threads,
+    on as many of the given cpus, as it requires processors)"""
+    p = Pyro4.core.Proxy(serverURI)
+    client = Pyro4.core.Proxy(clientURI)
+    producer, consumer = indices
+    processes = []
+    returncodes = [None, None]
+    try:
+        fifo = p.getStreamFile(producer)
+        logger.info("Running stages %s (on %s) via %s", indices, clientURI, fifo)
+        for i in indices:
+            p.setStageStarted(i, clientURI)
+        try:
+            if os.path.lexists(fifo):
+                os.remove(fifo)
+            os.mkfifo(fifo)
+            first_cpu = 0
+            for i in indices:
+                command_to_run  = str(p.getStageCommand(i))
+                procs = p.getStageProcs(i)
+                logger.info(command_to_run)
+                of = open(p.getStageLogfile(i), 'a')
+                of.write("Stage " + str(i) + " running on " + socket.gethostname() + " at " + datetime.isoformat(datetime.now(), " ") + " (streaming " + fifo + "):\n")
+                of.write(command_to_run + "\n")
+                of.flush()
+                stage_cpus = cpus[first_cpu:first_cpu + int(procs)] if cpus else None
+                first_cpu += int(procs)
+                def preexec(stage_cpus=stage_cpus):
+                    os.setsid()
+                    if stage_cpus:
+                        setAffinity(stage_cpus)
+                process = subprocess.Popen(shlex.split(command_to_run), stdout=of, stderr=of, shell=False,
+                                           preexec_fn=preexec, env=threadEnvironment(procs))
+                client.addPIDtoRunningList(process.pid, i)
+                processes.append((process, of))
+            returncodes = waitForGang(client, processes, fifo)
+        except:
+            logger.exception("Exception whilst running stages: %s (on %s)", indices, clientURI)
+            for process, _ in processes:
+                if process.poll() is None:
+                    killGroup(process)
+        finally:
+            if os.path.lexists(fifo):
+                os.remove(fifo)
+        logger.info("Stages %s finished, return was: %s (on %s)", indices, returncodes, clientURI)
+        client.notifyGangTerminated(indices, returncodes)
+    except:
+        logger.exception("Error communicating to server in runGang. "
+                        "Error raised to calling thread in launchExecutor. ")
+        raise
+
+
         """
         This class is used for the actual commands that are run by the 
         executor. A child process is defined as a process that was 
         initiated by the executor
         """
 class ChildProcess(object):
-    def __init__(self, stage, result, mem, procs):
+    def __init__(self, stage, result, mem, procs, cpus=None, resources=None):
         self.stage = stage
         self.result = result
         self.mem = mem
         self.procs = procs 
+        # requirements of other resources (see --executor-resources)
+        self.resources = resources or {}
+        # CPUs the child's stage(s) are pinned to (--pin-cpus)
+        self.cpus = cpus
 
 class InsufficientResources(Exception):
     pass
 
 class pipelineExecutor(object):
-    def __init__(self, options, memNeeded = None):
+    def __init__(self, options, memNeeded = None, procsNeeded = None):
         # better: self.options = options ... ?
         # TODO the additional argument `mem` represents the
         # server's estimate of the amount of memory
@@ -254,15 +687,15 @@ class pipelineExecutor(object):
         logger.debug("self.mem = %0.2fG", self.mem)
         if self.mem > options.mem:
             raise InsufficientResources("executor requesting %.2fG memory but maximum is %.2fG" % (options.mem, self.mem))
-        self.procs = options.proc
+        self.procs = procsNeeded or options.proc
         self.ppn = options.ppn
-        self.pe  = options.pe
-        self.mem_request_variable = options.mem_request_variable
         self.queue_type = options.queue_type
-        self.queue_name = options.queue_name
-        self.queue_opts = options.queue_opts
+        self.queue_backend = q.queueBackend(options, sys.argv)
+        # our index within the array job we were submitted as part of, if any
+        self.task_id = q.arrayTaskId()
         self.ns = options.use_ns
         self.uri_file = options.urifile
+        self.handoff_timeout = options.handoff_timeout
         if self.uri_file is None:
             self.uri_file = os.path.abspath(os.path.join(os.curdir, options.pipeline_name + "_uri"))
         # the next variable is used to keep track of how long the
@@ -274,34 +707,88 @@ class pipelineExecutor(object):
         # the maximum number of minutes an executor can be continuously
         # idle for, before it has to kill itself.
         self.time_to_seppuku = options.time_to_seppuku
+        self.seppuku_lookahead = options.seppuku_lookahead
         # the time in minutes after which an executor will not accept new jobs
         self.time_to_accept_jobs = options.time_to_accept_jobs
         # stores the time of connection with the server
         self.connection_time_with_server = None
+        # when the executor's walltime runs out, if known
+        self.end_time = None
         #initialize runningMem and Procs
         self.runningMem = 0.0
         self.runningProcs = 0   
+        # capacity and use of other resources (e.g., io_tokens)
+        self.resources = options.executor_resources or {}
+        self.runningResources = {}
         self.runningChildren = [] # no scissors (i.e. children should not run around with sharp objects...)
         self.pool = None
+        self.result_cache = (ResultCache(options.result_cache_dir, options.result_cache_size)
+                             if options.result_cache_dir else None)
+        # (created before the pool of worker processes, which may need to start in its cgroup)
+        self.memory_limiter = (MemoryLimiter(options.enforce_memory, options.memory_slack)
+                               if options.enforce_memory else None)
+        self.cpu_allocator = CPUAllocator() if options.pin_cpus else None
         self.pyro_proxy_for_server = None
         self.clientURI = None
         self.serverURI = None
         self.current_running_job_pids = []
+        # pid -> stage index
+        self.running_job_stages = {}
+        # while waiting for a new server after a hand-off, stage results are
+        # buffered here as (server method name, args...) tuples
+        self.handing_off = False
+        self.pending_notifications = []
+        self.notification_lock = threading.Lock()
+        # stages which a new server didn't adopt, so which must not run here
+        self.orphaned_stages = set()
         self.registered_with_server = False
         self.heartbeat_thread_crashed = False
         # we associate an event with each executor which is set when jobs complete.
         # in the future it might also be set by the server, and we might have more
         # than one event (for reclaiming, server messages, ...)
         self.e = threading.Event()
+        # as a node agent, (index, returncode, runtime) of leased stages finished
+        # since the last report to the server
+        self.node_agent = options.node_agent
+        self.agent_interval = options.agent_interval
+        self.last_agent_contact = 0
+        self.leased_results = []
+        self.leased_results_lock = threading.Lock()
         
     def registeredWithServer(self):
         self.registered_with_server = True
         
-    def addPIDtoRunningList(self, pid):
+    def addPIDtoRunningList(self, pid, i=None):
         self.current_running_job_pids.append(pid)
+        self.running_job_stages[pid] = i
+        if i in self.orphaned_stages:
+            os.killpg(pid, signal.SIGTERM)
     
+    def killStage(self, i):
+        """kill stage i's process, as the server asks, e.g., as a duplicate finished first"""
+        for pid, stage in self.running_job_stages.items():
+            if stage == i:
+                logger.info("Killing stage %i (process %d)", i, pid)
+                os.killpg(pid, signal.SIGTERM)
+
     def removePIDfromRunningList(self, pid):
         self.current_running_job_pids.remove(pid)
+        del self.running_job_stages[pid]
+
+    def findServerURI(self):
+        if self.ns:
+            ns = Pyro4.locateNS()
+            #ns.register("executor", executor, safe=True)
+            return ns.lookup("pipeline")
+        else:
+            try:
+                uf = open(self.uri_file)
+                serverURI = Pyro4.URI(uf.readline())
+                uf.close()
+            except:
+                logger.exception("Problem opening the specified uri file:")
+                raise
+            return serverURI
 
     def initializePool(self):
         self.pool = Pool(processes = self.procs)
@@ -324,8 +811,9 @@ class pipelineExecutor(object):
         # track of the process IDs (pid) of the current running jobs. Those are targetted by
         # os.kill in order to stop the processes in the Pool
         logger.debug("Executor shutting down.  Killing running jobs:")
+        # (each is the leader of its own process group, so kill any children too)
         for subprocID in self.current_running_job_pids:
-            os.kill(subprocID, signal.SIGTERM)
+            os.killpg(subprocID, signal.SIGTERM)
         # FIXME the death of the child process causes runStage
         # to notify the server of the job's destruction
         # so the job is no longer in the client's set of stages
@@ -337,10 +825,12 @@ class pipelineExecutor(object):
         # of a keyboard interrupt). So we can close the pool of processes 
         # in the normal way (don't need to use the pids here)
         # prevent more jobs from starting, and exit
-        if len(self.current_running_job_pids) > 0:
+        if len(self.current_running_job_pids) > 0 or (self.node_agent and self.pool is not None):
             self.pool.close()
             # wait for the worker processes (children) to exit (must be called after terminate() or close()
             self.pool.join()
+        if self.node_agent:
+            self.reportLeasedStages()
         self.unregister_with_server()
 
     def unregister_with_server(self):
@@ -358,59 +848,27 @@ class pipelineExecutor(object):
             logger.info("Now going to call unregisterClient on the server (executor: %s)", self.clientURI)
             self.pyro_proxy_for_server.unregisterClient(self.clientURI)
         
-    def submitToQueue(self, programName=None):
-        """Submits to sge queueing system using qsub""" 
-        if self.queue_type == "sge":
-            strprocs = str(self.procs)
-            strmem = "%s=%sG" % (self.mem_request_variable,float(self.mem))
-            jobname = ""
-            if programName is not None:
-                executablePath = os.path.abspath(programName)
-                jobname = os.path.basename(executablePath) + "-" 
-            now = datetime.now().strftime("%Y-%m-%d-at-%H-%M-%S-%f")
-            ident = "pipeline-executor-" + now
-            jobname += ident
-            queue_opts = ['-V', '-j', 'yes',
-                          '-N', jobname,
-                          '-l', strmem,
-                          '-o', os.path.join(os.getcwd(),
-                                             ident + '-eo.log')] \
-                          + (['-q', self.queue_name]
-                             if self.queue_name else []) \
-                          + (['-pe', self.pe, strprocs]
-                             if self.pe else []) \
-                          + shlex.split(self.queue_opts)
-            qsub_cmd = ['qsub'] + queue_opts
-            cmd  = ["pipeline_executor.py", "--local"]
-            cmd += ['--uri-file', self.uri_file]
-            # Only one exec is launched at a time in this manner, so:
-            cmd += ["--num-executors", str(1)]
-            # pass most args to the executor
-            cmd += q.remove_flags(['--num-exec', '--mem'], sys.argv[1:])
-            cmd += ['--mem', str(self.mem)]
-            script = "#!/usr/bin/env bash\n%s\n" % ' '.join(cmd)
-            # FIXME huge hack -- shouldn't we just iterate over options,
-            # possibly checking for membership in the executor option group?
-            # The problem is that we can't easily check if an option is
-            # available from a parser (but what about calling get_defaults and
-            # looking at exceptions?).  However, one possibility is to
-            # create a list of tuples consisting of the data with which to 
-            # call parser.add_arguments and use this to check.
-            # NOTE there's a problem with argparse's prefix matching which
-            # also affects removal of --num-executors
-            env = os.environ.copy()
-            env['PYRO_LOGFILE'] = os.path.join(os.getcwd(), ident + ".log")
-            p = subprocess.Popen(qsub_cmd, stdin=subprocess.PIPE, shell=False, env=env)
-            p.communicate(script)
+    def submitToQueue(self, programName=None, number=1):
+        """Submits `number` executors like this one to the queueing system (as an array job if number > 1)"""
+        if self.queue_backend is not None:
+            self.queue_backend.submitExecutors(number, self.mem, self.procs, self.uri_file, programName)
         else:
-            logger.info("Specified queueing system is: %s" % (self.queue_type))
-            logger.info("Only queue_type=sge or queue_type=None currently supports pipeline launching own executors.")
+            logger.info("No queueing system (--queue-type) specified to submit executors to.")
             logger.info("Exiting...")
             sys.exit()
 
-    def canRun(self, stageMem, stageProcs, runningMem, runningProcs):
-        """Calculates if stage is runnable based on memory and processor availibility"""
-        return stageMem <= self.mem - runningMem and stageProcs <= self.procs - runningProcs
+    def canRun(self, stageMem, stageProcs, runningMem, runningProcs, stageResources=None, runningResources=None):
+        """Calculates if stage is runnable based on memory, processor and other resource availibility"""
+        return resources.shortfall(dict(stageResources or {}, mem=stageMem, procs=stageProcs),
+                                   dict(resources.remaining(self.resources, runningResources or {}),
+                                        mem=self.mem - runningMem, procs=self.procs - runningProcs)) is None
+
+    def resourcesFree(self):
+        """free amounts of the resources other than memory and processors we have a limited amount of"""
+        return resources.remaining(self.resources, self.runningResources)
+
+    def reserveResources(self, stageResources):
+        self.runningResources = resources.total(self.runningResources, stageResources)
     def is_seppuku_time(self):
         # Is it time to perform seppuku: has the
         # idle_time exceeded the allowed time to be idle?
@@ -418,9 +876,30 @@ class pipelineExecutor(object):
         # idle_time       is given in seconds
         if self.time_to_seppuku != None:
             if (self.time_to_seppuku * 60) < self.idle_time:
-                return True
+                return not self.expectingWork()
         return False
+
+    def expectingWork(self):
+        """Whether the server expects to have a stage for us within the lookahead
+        period (e.g., when a running stage will unblock many others), in which case
+        staying idle a while is cheaper than exiting and having a new executor
+        wait in the queue again"""
+        extension = self.idle_time - self.time_to_seppuku * 60
+        horizon = self.seppuku_lookahead * 60 - extension
+        if horizon <= 0:
+            return False
+        eta = self.pyro_proxy_for_server.getUpcomingWork(self.clientURI, horizon)
+        if eta is not None:
+            logger.debug("Expecting work in %.0fs; staying alive", eta)
+        return eta is not None
                         
+    def timeLeft(self):
+        """seconds until this executor is killed, or None if not known to be limited"""
+        if self.end_time is None:
+            return None
+        # the server will consider our stages lost some time before we're killed
+        return max(0, self.end_time - time.time() - HEARTBEAT_INTERVAL)
+
     def is_time_to_drain(self):
         # check whether there is a limit to how long the executor
         # is allowed to accept jobs for. 
@@ -436,18 +915,23 @@ class pipelineExecutor(object):
         # Free up resources from any completed (successful or otherwise) stages
         for child in self.runningChildren:
             if child.result.ready():
-                logger.debug("Freeing up resources for stage %i.", child.stage)
+                logger.debug("Freeing up resources for stage %s.", child.stage)
                 self.runningMem -= child.mem
                 self.runningProcs -= child.procs
+                self.runningResources = resources.remaining(self.runningResources, child.resources)
+                if self.cpu_allocator is not None:
+                    self.cpu_allocator.release(child.cpus)
                 self.runningChildren.remove(child)
 
     def notifyStageTerminated(self, i, returncode=None):
         #try:
-            if returncode == 0:
+            if self.bufferNotification("setStagesTerminated", [(i, returncode, None)]):
+                pass
+            elif returncode == 0:
                 self.pyro_proxy_for_server.setStageFinished(i, self.clientURI)
             else:
                 # a None returncode is also considered a failure
-                self.pyro_proxy_for_server.setStageFailed(i, self.clientURI)
+                self.pyro_proxy_for_server.setStageFailed(i, self.clientURI, returncode)
         #except Pyro4.errors.CommunicationError:
             # the server may have shutdown or otherwise become unavailable
             # (currently this is expected when a long-running job completes;
@@ -457,6 +941,105 @@ class pipelineExecutor(object):
         #    logger.info("Error communing with server; couldn't notify it of stage %d's termination", i)
             self.e.set()  # some work finished and server notified, so wake up
 
+    def notifyStagesTerminated(self, results):
+        if not self.bufferNotification("setStagesTerminated", results):
+            self.pyro_proxy_for_server.setStagesTerminated(results, self.clientURI)
+        self.e.set()
+
+    def leasedStageTerminated(self, result):
+        # (called by the pool's result handler thread)
+        with self.leased_results_lock:
+            self.leased_results.append(result)
+        self.e.set()
+
+    def reportLeasedStages(self):
+        with self.leased_results_lock:
+            results, self.leased_results = self.leased_results, []
+        if results and not self.bufferNotification("setStagesTerminated", results):
+            self.pyro_proxy_for_server.reportLeasedStages(results, self.clientURI)
+
+    def notifyGangTerminated(self, indices, returncodes):
+        if not self.bufferNotification("setGangTerminated", indices, returncodes):
+            self.pyro_proxy_for_server.setGangTerminated(indices, returncodes, self.clientURI)
+        self.e.set()
+
+    def notifySpeculativeStageTerminated(self, i, returncode, runtime):
+        if not self.bufferNotification("setSpeculativeStageTerminated", [i], returncode, runtime):
+            self.pyro_proxy_for_server.setSpeculativeStageTerminated(i, returncode, runtime, self.clientURI)
+        self.e.set()
+
+    def bufferNotification(self, method, stages, *args):
+        """Returns True if the notification needn't (or mustn't) be sent to the server
+        now: during a hand-off it's buffered for the next server, and results of
+        stages the next server didn't adopt are dropped."""
+        with self.notification_lock:
+            indices = [r[0] for r in stages] if method == "setStagesTerminated" else stages
+            orphans = self.orphaned_stages.intersection(indices)
+            if orphans:
+                logger.info("Dropping results of stages %s, which were not adopted", list(orphans))
+                self.orphaned_stages.difference_update(orphans)
+                return True
+            if self.handing_off:
+                self.pending_notifications.append((method, stages) + args)
+                return True
+            return False
+
+    def reattach(self):
+        """The server is exiting but has handed off to a successor: keep our stages
+        running and, once the successor's URI appears, register with it so it
+        adopts them.  Returns True if we reattached."""
+        with self.notification_lock:
+            self.handing_off = True
+        # stop the heartbeat (without unregistering, which would requeue our stages)
+        self.registered_with_server = False
+        oldURI = self.serverURI
+        deadline = time.time() + self.handoff_timeout * 60
+        while time.time() < deadline:
+            self.e.wait(WAIT_TIMEOUT)
+            self.e.clear()
+            self.free_resources()
+            try:
+                uri = self.findServerURI()
+            except:
+                continue
+            if uri.asString() == oldURI:
+                continue
+            p = Pyro4.Proxy(uri)
+            with self.notification_lock:
+                stages = set()
+                for child in self.runningChildren:
+                    stages.update(child.stage if isinstance(child.stage, list) else [child.stage])
+                # (the new server must also adopt stages which finished in the meantime)
+                for n in self.pending_notifications:
+                    stages.update([r[0] for r in n[1]] if n[0] == "setStagesTerminated" else n[1])
+                try:
+                    adopted = p.reattachClient(self.clientURI, self.mem, list(stages),
+                                               self.pending_notifications, self.timeLeft(), self.procs)
+                except Pyro4.errors.CommunicationError:
+                    # the URI file may be stale, or the new server not yet listening
+                    continue
+                self.pending_notifications = []
+                self.handing_off = False
+                self.orphaned_stages = stages.difference(adopted)
+                for pid, i in self.running_job_stages.items():
+                    if i in self.orphaned_stages:
+                        os.killpg(pid, signal.SIGTERM)
+            logger.info("Reattached to %s (adopted stages: %s)", uri, adopted)
+            self.setServerURI(uri.asString())
+            self.setProxyForServer(p)
+            self.registeredWithServer()
+            self.startHeartbeat()
+            # don't count the wait as idle time
+            self.current_time = time.time()
+            return True
+        logger.info("No new server appeared within %.1f minutes", self.handoff_timeout)
+        return False
+
+    def startHeartbeat(self):
+        h = threading.Thread(target=self.heartbeat)
+        h.daemon = True
+        h.start()
+
     def idle(self):
         return self.runningMem == 0 and self.runningProcs == 0 and self.prev_time
 
@@ -466,9 +1049,14 @@ class pipelineExecutor(object):
             while self.registered_with_server:
                 logger.debug("Heartbeat %d...", tick)
                 tick += 1
-                self.pyro_proxy_for_server.updateClientTimestamp(self.clientURI, tick)
+                # (the server replies with any stages it wants killed, e.g., as a duplicate finished first)
+                for i in self.pyro_proxy_for_server.updateClientTimestamp(self.clientURI, tick) or []:
+                    self.killStage(i)
                 time.sleep(HEARTBEAT_INTERVAL)
         except:
+            if self.handing_off:
+                # the old server has gone away; expected
+                return
             logger.exception("Heartbeat thread crashed: ")
             # this will take down the executor to avoid the case
             # where an executor wastes time processing jobs which the server
@@ -480,6 +1068,10 @@ class pipelineExecutor(object):
 
     # use an event set/timeout system to run the executor mainLoop -
     # we might want to pass some extra information in addition to waking the system
+    def allocateCPUs(self, procs):
+        """CPUs to pin a stage requiring procs processors to (with --pin-cpus), if enough are free"""
+        return self.cpu_allocator.allocate(procs) if self.cpu_allocator is not None else None
+
     def mainLoop(self):
         while self.mainFn():
             self.e.wait(WAIT_TIMEOUT)
@@ -523,13 +1115,18 @@ class pipelineExecutor(object):
             logger.info("Time expired for accepting new jobs...leaving main loop.")
             return False
 
+        if self.node_agent:
+            return self.agentFn()
+
         # TODO we get only one stage per loop iteration, so we have to wait for
         # another event/timeout to get another.  In general we might want 
         # getCommand to order multiple stages to be run on the same server
         # (just setting the event immediately would be somewhat hackish)
         cmd, i = self.pyro_proxy_for_server.getCommand(clientURIstr = self.clientURI,
                                                        clientMemFree = self.mem - self.runningMem,
-                                                       clientProcsFree = self.procs - self.runningProcs)
+                                                       clientProcsFree = self.procs - self.runningProcs,
+                                                       clientTimeLeft = self.timeLeft(),
+                                                       clientResourcesFree = self.resourcesFree())
         if cmd == "shutdown_normally":
             logger.debug('Saw shutdown command from server')
             return False
@@ -541,14 +1138,20 @@ class pipelineExecutor(object):
         # maybe throwing an exception is better?
         elif cmd == "wait":
             return True
+        elif cmd == "handoff":
+            logger.info("Server is handing off to a successor; waiting for it with %d running stages",
+                        len(self.runningChildren))
+            return self.reattach()
         elif cmd == "run_stage":
             stageMem, stageProcs = self.pyro_proxy_for_server.getStageMem(i), self.pyro_proxy_for_server.getStageProcs(i)
             # we trust that the server has given us a stage
             # that we have enough memory and processors to run ...
             # reset the idle time, we are running a stage!
             self.idle_time = 0
+            stageResources = self.pyro_proxy_for_server.getStageResources(i)
             self.runningMem += stageMem
             self.runningProcs += stageProcs
+            self.reserveResources(stageResources)
             # The multiprocessing library must pickle things in order to execute them.
             # I wanted the following function (runStage) to be a function of the pipelineExecutor
             # class. That way we can access self.serverURI and self.clientURI from
@@ -557,11 +1160,96 @@ class pipelineExecutor(object):
             # this correctly, that binds the function to a class instance). There is
             # a way to make a bound function picklable, but this seems cumbersome. So instead
             # runStage is now a standalone function.
-            result = self.pool.apply_async(runStage, (self.serverURI, self.clientURI, i))
+            cpus = self.allocateCPUs(stageProcs)
+            result = self.pool.apply_async(runStage, (self.serverURI, self.clientURI, i, self.result_cache, stageMem,
+                                                      self.memory_limiter, stageProcs, cpus))
 
-            self.runningChildren.append(ChildProcess(i, result, stageMem, stageProcs))
+            self.runningChildren.append(ChildProcess(i, result, stageMem, stageProcs, cpus, stageResources))
             logger.debug("Added stage %i to the running pool.", i)
             return True
+        elif cmd == "run_speculative":
+            stageMem, stageProcs = self.pyro_proxy_for_server.getStageMem(i), self.pyro_proxy_for_server.getStageProcs(i)
+            stageResources = self.pyro_proxy_for_server.getStageResources(i)
+            self.idle_time = 0
+            self.runningMem += stageMem
+            self.runningProcs += stageProcs
+            self.reserveResources(stageResources)
+            cpus = self.allocateCPUs(stageProcs)
+            result = self.pool.apply_async(runSpeculativeStage, (self.serverURI, self.clientURI, i, stageProcs, cpus))
+            self.runningChildren.append(ChildProcess(i, result, stageMem, stageProcs, cpus, stageResources))
+            logger.debug("Added a duplicate of stage %i to the running pool.", i)
+            return True
+        elif cmd == "run_gang":
+            # stages connected by a named pipe must run simultaneously, so account for both
+            stageMem   = sum(self.pyro_proxy_for_server.getStageMem(j) for j in i)
+            stageProcs = sum(self.pyro_proxy_for_server.getStageProcs(j) for j in i)
+            stageResources = resources.total(*self.pyro_proxy_for_server.getStagesResources(i))
+            self.idle_time = 0
+            self.runningMem += stageMem
+            self.runningProcs += stageProcs
+            self.reserveResources(stageResources)
+            cpus = self.allocateCPUs(stageProcs)
+            result = self.pool.apply_async(runGang, (self.serverURI, self.clientURI, i, cpus))
+            self.runningChildren.append(ChildProcess(i, result, stageMem, stageProcs, cpus, stageResources))
+            logger.debug("Added stages %s to the running pool.", i)
+            return True
+        elif cmd == "run_batch":
+            # the stages run one at a time, so need only the largest of their requirements
+            reqs = self.pyro_proxy_for_server.getStagesMemAndProcs(i)
+            stageMem, stageProcs = max(m for m, _ in reqs), max(n for _, n in reqs)
+            stageResources = resources.peak(self.pyro_proxy_for_server.getStagesResources(i))
+            self.idle_time = 0
+            self.runningMem += stageMem
+            self.runningProcs += stageProcs
+            self.reserveResources(stageResources)
+            cpus = self.allocateCPUs(stageProcs)
+            result = self.pool.apply_async(runBatch, (self.serverURI, self.clientURI, i, self.result_cache,
+                                                      self.memory_limiter, cpus))
+            self.runningChildren.append(ChildProcess(i, result, stageMem, stageProcs, cpus, stageResources))
+            logger.debug("Added batch %s to the running pool.", i)
+            return True
+        else:
+            raise Exception("Got invalid cmd from server: %s" % cmd)
+
+    def agentFn(self):
+        """The node agent's counterpart to the rest of mainFn: report the stages
+        finished since the last call and lease as many new ones as fit, each in
+        a single call to the server, and start the leased stages running"""
+        # let completions accumulate rather than contacting the server for each
+        wait = self.last_agent_contact + self.agent_interval - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        self.last_agent_contact = time.time()
+        self.free_resources()
+        self.reportLeasedStages()
+        cmd, leases = self.pyro_proxy_for_server.leaseStages(self.clientURI,
+                                                             self.mem - self.runningMem,
+                                                             self.procs - self.runningProcs,
+                                                             self.timeLeft(),
+                                                             self.resourcesFree())
+        if cmd == "shutdown_normally":
+            logger.debug('Saw shutdown command from server')
+            return False
+        elif cmd == "wait":
+            return True
+        elif cmd == "handoff":
+            logger.info("Server is handing off to a successor; waiting for it with %d running stages",
+                        len(self.runningChildren))
+            return self.reattach()
+        elif cmd == "run_stages":
+            self.idle_time = 0
+            for lease in leases:
+                i, stageMem, stageProcs, stageResources = lease[0], lease[3], lease[4], lease[7]
+                self.runningMem += stageMem
+                self.runningProcs += stageProcs
+                self.reserveResources(stageResources)
+                cpus = self.allocateCPUs(stageProcs)
+                result = self.pool.apply_async(runLeasedStage,
+                                               (self.clientURI, lease, self.result_cache, self.memory_limiter, cpus),
+                                               callback=self.leasedStageTerminated)
+                self.runningChildren.append(ChildProcess(i, result, stageMem, stageProcs, cpus, stageResources))
+            logger.debug("Added leased stages %s to the running pool.", [l[0] for l in leases])
+            return True
         else:
             raise Exception("Got invalid cmd from server: %s" % cmd)
                 
@@ -609,14 +1297,8 @@ if __name__ == "__main__":
 
     if options.local:
         local_launch(options)
-    elif options.queue_type == "pbs":
-        roq = q.runOnQueueingSystem(options, sysArgs=sys.argv)
-        for i in range(options.num_exec):
-            roq.createAndSubmitExecutorJobFile(i, after=None,
-                            time=q.timestr_to_secs(options.time))
-    elif options.queue_type == "sge":
-        for i in range(options.num_exec):
-            pe = pipelineExecutor(options)
-            pe.submitToQueue()
+    elif options.queue_type is not None:
+        pe = pipelineExecutor(options)
+        pe.submitToQueue(number=options.num_exec)
     else:
         local_launch(options)
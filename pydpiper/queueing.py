@@ -4,8 +4,11 @@ from __future__ import print_function
 from datetime import datetime
 from os.path import isdir, basename
 from os import mkdir
+from pipes import quote
 import os
 import subprocess
+import shlex
+import re
 
 # FIXME huge hack around not being able to pretty-print
 # flags back out of a parsed representation
@@ -43,7 +46,78 @@ def timestr_to_secs(ts):
     except:
         raise Exception("invalid (H...)HH:MM:SS timestring: %s" % ts)
 
+def slurm_timestr_to_secs(ts):
+    """parse SLURM's [days-][[hours:]minutes:]seconds time format"""
+    try:
+        days, _, hms = ts.rpartition('-')
+        parts = [int(x) for x in hms.split(':')]
+        h, m, s = [0] * (3 - len(parts)) + parts
+        return 86400 * int(days or 0) + 3600 * h + 60 * m + s
+    except:
+        raise Exception("invalid SLURM timestring: %s" % ts)
+
+def qstatJobs():
+    """the (numeric parts of the) IDs of the SGE or PBS jobs in the queue and not
+    yet completed"""
+    out = subprocess.check_output(["qstat"], stderr=open(os.devnull, 'w'))
+    jobs = set()
+    for line in out.splitlines():
+        fields = line.split()
+        # (PBS lists completed jobs, in state C, for a while)
+        if fields and not (len(fields) > 4 and fields[4] == "C"):
+            jobs.add(fields[0].split(".")[0])
+    return jobs
+
+def remainingWalltime():
+    """seconds of walltime remaining for the current job, or None if not
+    running as a job of a queueing system which reports this (or if the query fails)"""
+    for backend in QUEUE_BACKENDS.values():
+        jobId = os.environ.get(backend.job_id_var)
+        if jobId:
+            try:
+                return backend.remainingWalltime(jobId)
+            except:
+                return None
+    return None
+
+def arrayTaskId():
+    """index of the current task within an SGE/Torque/PBS Pro/SLURM job array,
+    or None if not running as part of an array job"""
+    for var in ["SGE_TASK_ID", "PBS_ARRAYID", "PBS_ARRAY_INDEX", "SLURM_ARRAY_TASK_ID"]:
+        try:
+            return int(os.environ[var])
+        except (KeyError, ValueError):
+            # (SGE sets SGE_TASK_ID=undefined for non-array jobs)
+            pass
+    return None
+
+def executorCommand(options, mem, procs, uriFile, sysArgs):
+    """command running a single executor (for submission to a queue)
+    with the given resources and most of the other options we were given"""
+    cmd  = ["pipeline_executor.py", "--local"]
+    cmd += ['--uri-file', uriFile]
+    # Only one exec is launched at a time in this manner, so:
+    cmd += ["--num-executors", str(1)]
+    # pass most args to the executor
+    # FIXME huge hack -- shouldn't we just iterate over options,
+    # possibly checking for membership in the executor option group?
+    # The problem is that we can't easily check if an option is
+    # available from a parser (but what about calling get_defaults and
+    # looking at exceptions?).  However, one possibility is to
+    # create a list of tuples consisting of the data with which to 
+    # call parser.add_arguments and use this to check.
+    # NOTE there's a problem with argparse's prefix matching which
+    # also affects removal of --num-executors
+    cmd += remove_flags(['--num-exec', '--mem', '--proc'], sysArgs[1:])
+    cmd += ['--mem', str(mem), '--proc', str(procs)]
+    return cmd
+
 class runOnQueueingSystem():
+    """Writes and submits PBS job scripts: a chain of server jobs (each also
+    running an executor) and arrays of executor jobs to accompany them"""
+    # directory in which a job was submitted, and index within its job array
+    workdir_var = "$PBS_O_WORKDIR"
+    task_id_var = "${PBS_ARRAYID:-$PBS_ARRAY_INDEX}"
     def __init__(self, options, sysArgs=None):
         #Note: options are the same as whatever is in calling program
         #Options MUST also include standard pydpiper options
@@ -57,6 +131,7 @@ class runOnQueueingSystem():
         self.ppn = options.ppn
         self.queue_name = options.queue_name or options.queue
         self.queue_type = options.queue_type
+        self.array_style = options.pbs_array_style
         self.executor_start_delay = options.executor_start_delay
         # TODO use self.time to compute better time_to_accept_jobs?
         self.time_to_accept_jobs = options.time_to_accept_jobs
@@ -85,13 +160,14 @@ class runOnQueueingSystem():
         reconstruct += " --local --num-executors=1 --time-to-seppuku=%d " \
                          % self.max_walltime
         return reconstruct
-    def constructAndSubmitJobFile(self, identifier, time, isMainFile, after=None, afterany=None):
-        """Construct the bulk of the pbs script to be submitted via qsub"""
+    def constructAndSubmitJobFile(self, identifier, time, isMainFile, after=None, afterany=None, number=1):
+        """Construct the bulk of the pbs script to be submitted via qsub
+        (as an array of `number` jobs, if more than one)"""
         now = datetime.now()  
         jobName = self.jobName + identifier + now.strftime("%Y%m%d-%H%M%S%f") + ".job"
         self.jobFileName = os.path.join(self.jobDir, jobName)
         self.jobFile = open(self.jobFileName, "w")
-        self.addHeaderAndCommands(time, isMainFile)
+        self.addHeaderAndCommands(time, isMainFile, number)
         self.completeJobFile()
         jobId = self.submitJob(jobName, after, afterany)
         return jobId
@@ -106,18 +182,22 @@ class runOnQueueingSystem():
             time_remaining -= t
             serverJobId = self.createAndSubmitMainJobFile(time=t, afterany=serverJobId)
             if self.numexec >= 2:
-                for i in range(1, self.numexec):
-                    self.createAndSubmitExecutorJobFile(i, time=t, after=serverJobId)
+                # the server job runs one executor; the rest are submitted as a single array job
+                self.createAndSubmitExecutorJobFile(1, time=t, after=serverJobId,
+                                                    number=self.numexec - 1)
             # in principle a server could overlap the previous generation of clients,
             # but at present the clients just die within seconds
     def createAndSubmitMainJobFile(self,time, afterany=None):
         return self.constructAndSubmitJobFile("-pipeline-",time, isMainFile=True, afterany=afterany)
-    def createAndSubmitExecutorJobFile(self, i, time, after):
+    def createAndSubmitExecutorJobFile(self, i, time, after, number=1):
         # This is called directly from pipeline_executor
-        # For multiple executors, this will be called multiple times.
-        execId = "-executor-" + str(i) + "-"
-        self.constructAndSubmitJobFile(execId, time, isMainFile=False, after=after)
-    def addHeaderAndCommands(self, time, isMainFile):
+        # Executors i, ..., i + number - 1 are submitted together as an array job
+        if number > 1:
+            execId = "-executors-%d-to-%d-" % (i, i + number - 1)
+        else:
+            execId = "-executor-" + str(i) + "-"
+        return self.constructAndSubmitJobFile(execId, time, isMainFile=False, after=after, number=number)
+    def addHeaderAndCommands(self, time, isMainFile, number=1):
         """Constructs header and commands for pbs script, based on options input from calling program"""
         self.jobFile.write("#!/bin/bash\n")
         requestNodes = 1
@@ -144,9 +224,7 @@ class runOnQueueingSystem():
         m,s = divmod(time,60)
         h,m = divmod(m,60)
         timestr = "%d:%02d:%02d" % (h,m,s)
-        self.jobFile.write("#PBS -l nodes=%d:ppn=%d,walltime=%s\n" % (requestNodes, self.ppn, timestr))
-        self.jobFile.write("#PBS -N %s\n" % name)
-        self.jobFile.write("#PBS -q %s\n" % self.queue_name)
+        self.addDirectives(name, requestNodes, timestr, number)
         if self.prologue_file is not None:
             try:
                 with open(self.prologue_file, 'r') as fh:
@@ -157,17 +235,27 @@ class runOnQueueingSystem():
                 print("Failed copying prologue script into submit script")
                 raise
         # cd from $HOME into the submission directory:
-        self.jobFile.write("cd $PBS_O_WORKDIR\n\n")
+        self.jobFile.write("cd %s\n\n" % self.workdir_var)
         if isMainFile:
             self.jobFile.write(self.buildMainCommand())
             self.jobFile.write(" &\n\n")
         if launchExecs:
+            if number > 1:
+                # a separate Pyro log for each executor in the array
+                self.jobFile.write("export PYRO_LOGFILE=${PYRO_LOGFILE%%.log}-%s.log\n" % self.task_id_var)
             self.jobFile.write("sleep %s\n" %
                                self.executor_start_delay)
             cmd = "pipeline_executor.py --local --num-executors=1 "
             cmd += ' '.join(remove_flags(['--num-exec'], self.arguments[1:]))
             cmd += ' &\n\n'
             self.jobFile.write(cmd)
+    def addDirectives(self, name, requestNodes, timestr, number):
+        """job name, resource requests, etc., for the queueing system"""
+        self.jobFile.write("#PBS -l nodes=%d:ppn=%d,walltime=%s\n" % (requestNodes, self.ppn, timestr))
+        self.jobFile.write("#PBS -N %s\n" % name)
+        self.jobFile.write("#PBS -q %s\n" % self.queue_name)
+        if number > 1:
+            self.jobFile.write("#PBS %s 1-%d\n" % ("-J" if self.array_style == "pbspro" else "-t", number))
     def completeJobFile(self):
         """Completes pbs script--wait for background jobs to terminate as per scinet wiki"""
         self.jobFile.write("wait\n")
@@ -189,3 +277,256 @@ class runOnQueueingSystem():
         print(jobId)
         print("Submitted!")
         return jobId
+
+class runOnSlurm(runOnQueueingSystem):
+    """As runOnQueueingSystem, but writing and submitting SLURM batch scripts"""
+    workdir_var = "$SLURM_SUBMIT_DIR"
+    task_id_var = "$SLURM_ARRAY_TASK_ID"
+    def addDirectives(self, name, requestNodes, timestr, number):
+        self.jobFile.write("#SBATCH --nodes=%d\n" % requestNodes)
+        self.jobFile.write("#SBATCH --ntasks-per-node=%d\n" % self.ppn)
+        self.jobFile.write("#SBATCH --time=%s\n" % timestr)
+        self.jobFile.write("#SBATCH --job-name=%s\n" % name)
+        if self.queue_name:
+            self.jobFile.write("#SBATCH --partition=%s\n" % self.queue_name)
+        if number > 1:
+            self.jobFile.write("#SBATCH --array=1-%d\n" % number)
+    def submitJob(self, jobName, after=None, afterany=None):
+        """Submit job to SLURM"""
+        os.environ['PYRO_LOGFILE'] = jobName + '.log'
+        cmd = ['sbatch', '--parsable', '--export=ALL',
+               '-o', jobName + '-o.log', '-e', jobName + '-e.log']
+        if after is not None:
+            cmd += ['--dependency=after:' + after]
+        if afterany is not None:
+            cmd += ['--dependency=afterany:' + afterany]
+        cmd += [self.jobFileName]
+        out = subprocess.check_output(cmd)
+        # --parsable prints "jobid[;cluster]"
+        jobId = out.strip().split(';')[0]
+        print(' '.join(cmd))
+        print(jobId)
+        print("Submitted!")
+        return jobId
+
+class QueueBackend(object):
+    """A queueing system to which executors (and, for some, the server) are submitted.
+    Subclasses implement submission of executors and server generations,
+    the remaining walltime of a job, and cancellation of a job, as well as
+    the submission and monitoring of stages as jobs (--submit-stages)."""
+    # environment variable holding the ID of the job we're running in
+    job_id_var = None
+    # whether the main program submits the server itself as a chain of jobs (each
+    # running executors locally, alongside further ones submitted as array jobs),
+    # rather than running the server here and having it submit executors as needed
+    submits_server = False
+    # class writing and submitting the job scripts for those which do
+    script_writer = None
+
+    def __init__(self, options, sysArgs=None):
+        self.options = options
+        self.sysArgs = sysArgs
+
+    def submitExecutors(self, number, mem, procs, uriFile, programName=None):
+        """submit `number` executors (as an array job if possible); returns the job ID"""
+        raise NotImplementedError
+
+    def submitServerGenerations(self):
+        """submit the server (and executors) as jobs, successive generations
+        taking over once their predecessors run out of walltime"""
+        if self.script_writer is None:
+            raise NotImplementedError("The %s does not submit the server as a job" % self.__class__.__name__)
+        self.script_writer(self.options, self.sysArgs).createAndSubmitPbsScripts()
+
+    @classmethod
+    def remainingWalltime(cls, jobId):
+        """seconds of walltime remaining for the given job, or None if unknown"""
+        return None
+
+    @classmethod
+    def cancel(cls, jobId):
+        raise NotImplementedError
+
+    def stageJobCommand(self, name, logfile, mem, procs, script, after):
+        """the (shell) command submitting a job script running stages, requesting
+        mem GB and procs processors, and held until the jobs after (whose IDs may be
+        shell variable references) have finished; it prints the job's ID"""
+        raise NotImplementedError
+
+    def dependencyFlags(self, jobIds):
+        """flags holding a job until the given jobs have finished (successfully, where
+        the queueing system distinguishes)"""
+        raise NotImplementedError
+
+    def commandLine(self, cmd, script, after):
+        """cmd (a list) and the dependency flags (unquoted, for the shell to expand
+        the job IDs) submitting script"""
+        return " ".join([quote(c) for c in cmd]
+                        + ([self.dependencyFlags(after)] if after else [])
+                        + [quote(script)])
+
+    @classmethod
+    def queuedJobs(cls):
+        """the (numeric parts of the) IDs of the jobs in the queue and not yet completed"""
+        raise NotImplementedError
+
+    def executorJobName(self, programName):
+        jobname = ""
+        if programName is not None:
+            jobname = basename(os.path.abspath(programName)) + "-"
+        now = datetime.now().strftime("%Y-%m-%d-at-%H-%M-%S-%f")
+        ident = "pipeline-executor-" + now
+        return jobname + ident, ident
+
+class PBSBackend(QueueBackend):
+    job_id_var = "PBS_JOBID"
+    submits_server = True
+    script_writer = runOnQueueingSystem
+
+    def submitExecutors(self, number, mem, procs, uriFile, programName=None):
+        # PBS executors request whole nodes (--ppn), so mem and procs aren't used here
+        roq = self.script_writer(self.options, sysArgs=self.sysArgs)
+        return roq.createAndSubmitExecutorJobFile(0, after=None,
+                                                  time=timestr_to_secs(self.options.time or '48:00:00'),
+                                                  number=number)
+
+    @classmethod
+    def remainingWalltime(cls, jobId):
+        output = subprocess.check_output(['qstat', '-f', jobId])
+        return int(re.search('Walltime.Remaining = (\d*)', output).group(1))
+
+    @classmethod
+    def cancel(cls, jobId):
+        subprocess.check_call(['qdel', jobId])
+
+    def stageJobCommand(self, name, logfile, mem, procs, script, after):
+        resources = "nodes=1:ppn=%d,mem=%dmb" % (procs, int(mem * 1024))
+        if self.options.time:
+            resources += ",walltime=" + self.options.time
+        cmd = ["qsub", "-N", name, "-o", logfile, "-j", "oe", "-V", "-l", resources] \
+              + (["-q", self.options.queue_name] if self.options.queue_name else [])
+        return self.commandLine(cmd, script, after)
+
+    def dependencyFlags(self, jobIds):
+        return "-W depend=afterok:" + ":".join(jobIds)
+
+    queuedJobs = staticmethod(qstatJobs)
+
+class SGEBackend(QueueBackend):
+    job_id_var = "JOB_ID"
+
+    def submitExecutors(self, number, mem, procs, uriFile, programName=None):
+        jobname, ident = self.executorJobName(programName)
+        queue_opts = ['-V', '-j', 'yes', '-terse',
+                      '-N', jobname,
+                      '-l', "%s=%sG" % (self.options.mem_request_variable, float(mem)),
+                      '-o', os.path.join(os.getcwd(),
+                                         ident + ('-$TASK_ID' if number > 1 else '') + '-eo.log')] \
+                      + (['-t', '1-%d' % number] if number > 1 else []) \
+                      + (['-q', self.options.queue_name]
+                         if self.options.queue_name else []) \
+                      + (['-pe', self.options.pe, str(procs)]
+                         if self.options.pe else []) \
+                      + shlex.split(self.options.queue_opts)
+        script = "#!/usr/bin/env bash\n"
+        if number > 1:
+            # a separate Pyro log for each executor in the array
+            script += "export PYRO_LOGFILE=${PYRO_LOGFILE%.log}-$SGE_TASK_ID.log\n"
+        script += "%s\n" % ' '.join(executorCommand(self.options, mem, procs, uriFile, self.sysArgs))
+        env = os.environ.copy()
+        env['PYRO_LOGFILE'] = os.path.join(os.getcwd(), ident + ".log")
+        p = subprocess.Popen(['qsub'] + queue_opts, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             shell=False, env=env)
+        out, _ = p.communicate(script)
+        # (-terse prints "jobid" or, for an array, "jobid.1-n:1")
+        return out.strip().split('.')[0]
+
+    @classmethod
+    def cancel(cls, jobId):
+        subprocess.check_call(['qdel', jobId])
+
+    def stageJobCommand(self, name, logfile, mem, procs, script, after):
+        cmd = ["qsub", "-N", name, "-o", logfile, "-terse", "-j", "y", "-V",
+               "-l", "%s=%sG" % (self.options.mem_request_variable, float(mem))] \
+              + (["-pe", self.options.pe, str(procs)] if self.options.pe else []) \
+              + (["-q", self.options.queue_name] if self.options.queue_name else [])
+        return self.commandLine(cmd, script, after)
+
+    def dependencyFlags(self, jobIds):
+        # (SGE runs a job once those it waits for have finished, successfully or not)
+        return "-hold_jid " + ",".join(jobIds)
+
+    queuedJobs = staticmethod(qstatJobs)
+
+class SLURMBackend(QueueBackend):
+    job_id_var = "SLURM_JOB_ID"
+    submits_server = True
+    script_writer = runOnSlurm
+
+    def submitExecutors(self, number, mem, procs, uriFile, programName=None):
+        jobname, ident = self.executorJobName(programName)
+        cmd = ['sbatch', '--parsable', '--export=ALL',
+               '--job-name=' + jobname,
+               '--mem=%dM' % int(mem * 1024),
+               '--cpus-per-task=%d' % procs,
+               '--output=' + os.path.join(os.getcwd(), ident + ('-%a' if number > 1 else '') + '-eo.log')] \
+              + (['--array=1-%d' % number] if number > 1 else []) \
+              + (['--partition=' + self.options.queue_name] if self.options.queue_name else []) \
+              + (['--time=' + self.options.time] if self.options.time else []) \
+              + shlex.split(self.options.queue_opts)
+        script = "#!/usr/bin/env bash\n"
+        if number > 1:
+            script += "export PYRO_LOGFILE=${PYRO_LOGFILE%.log}-$SLURM_ARRAY_TASK_ID.log\n"
+        script += "%s\n" % ' '.join(executorCommand(self.options, mem, procs, uriFile, self.sysArgs))
+        env = os.environ.copy()
+        env['PYRO_LOGFILE'] = os.path.join(os.getcwd(), ident + ".log")
+        # sbatch reads the script from stdin if not given a file
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, shell=False, env=env)
+        out, _ = p.communicate(script)
+        return out.strip().split(';')[0]
+
+    @classmethod
+    def remainingWalltime(cls, jobId):
+        output = subprocess.check_output(['squeue', '-h', '-j', jobId, '-o', '%L']).strip()
+        if output in ["", "UNLIMITED", "NOT_SET", "INVALID"]:
+            return None
+        return slurm_timestr_to_secs(output)
+
+    @classmethod
+    def cancel(cls, jobId):
+        subprocess.check_call(['scancel', jobId])
+
+    def stageJobCommand(self, name, logfile, mem, procs, script, after):
+        cmd = ['sbatch', '--parsable', '--export=ALL',
+               '--job-name=' + name,
+               '--output=' + logfile,
+               '--mem=%dM' % int(mem * 1024),
+               '--cpus-per-task=%d' % procs] \
+              + (['--partition=' + self.options.queue_name] if self.options.queue_name else []) \
+              + (['--time=' + self.options.time] if self.options.time else [])
+        # --parsable prints "jobid[;cluster]"
+        return "%s | cut -d';' -f1" % self.commandLine(cmd, script, after)
+
+    def dependencyFlags(self, jobIds):
+        return "--dependency=afterok:" + ":".join(jobIds)
+
+    @classmethod
+    def queuedJobs(cls):
+        out = subprocess.check_output(['squeue', '-h', '-o', '%i'], stderr=open(os.devnull, 'w'))
+        # (the tasks of an array job are listed as jobid_task)
+        return set(l.strip().split('_')[0] for l in out.splitlines() if l.strip())
+
+QUEUE_BACKENDS = { "pbs"   : PBSBackend,
+                   "sge"   : SGEBackend,
+                   "slurm" : SLURMBackend }
+
+def queueBackend(options, sysArgs=None):
+    """the backend for the queueing system named by --queue-type, or None if there isn't one"""
+    if options.queue_type is None:
+        return None
+    try:
+        backend = QUEUE_BACKENDS[options.queue_type]
+    except KeyError:
+        raise ValueError("unknown queue type '%s'; choose one of: %s"
+                         % (options.queue_type, ", ".join(sorted(QUEUE_BACKENDS))))
+    return backend(options, sysArgs)
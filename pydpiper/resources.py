@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+"""Resources other than memory and processors which stages may require, such as
+a share of a file system's bandwidth ('io_tokens') or of a node's local scratch
+space ('scratch_gb').  Requirements and capacities are vectors of named
+amounts, represented as dicts; a stage's memory and processors are the 'mem'
+and 'procs' components of its vector.  An executor's capacity is given by
+--executor-resources (resources it doesn't list being unlimited on it), and the
+total amounts stages running anywhere may use at once by --resource-pools."""
+
+# tolerance for rounding errors in comparing amounts
+EPS = 0.000001
+
+def parseResources(s):
+    """'io_tokens=4,scratch_gb=100' -> {'io_tokens': 4.0, 'scratch_gb': 100.0}"""
+    resources = {}
+    for part in s.split(","):
+        if not part.strip():
+            continue
+        name, sep, amount = part.partition("=")
+        if not sep:
+            raise ValueError("resource '%s' has no amount (expected name=amount)" % part)
+        resources[name.strip()] = float(amount)
+    return resources
+
+def total(*vectors):
+    """the sum of some resource vectors"""
+    result = {}
+    for v in vectors:
+        for name, amount in v.iteritems():
+            result[name] = result.get(name, 0) + amount
+    return result
+
+def peak(vectors):
+    """the most of each resource required by any of some vectors (e.g., of stages run one at a time)"""
+    result = {}
+    for v in vectors:
+        for name, amount in v.iteritems():
+            result[name] = max(result.get(name, 0), amount)
+    return result
+
+def remaining(capacity, used):
+    """what is left of capacity (only the resources it lists) after used is taken"""
+    return dict((name, amount - used.get(name, 0)) for name, amount in capacity.iteritems())
+
+def shortfall(need, free):
+    """the name of a resource of which need exceeds what is free (resources not
+    listed in free being unlimited), or None if there is enough of each"""
+    for name in sorted(need):
+        if name in free and need[name] > free[name] + EPS:
+            return name
+    return None
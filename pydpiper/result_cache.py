@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+from os.path import basename, dirname, exists, isdir, join, splitext
+import hashlib
+import logging
+import glob
+import os
+import shutil
+import subprocess
+import time
+import file_handling as fh
+
+"""A cache of stage results which persists across pipelines, keyed by
+the tool, its arguments, and the contents of its input files"""
+
+logger = logging.getLogger(__name__)
+
+# seconds between scans of the whole cache for entries to evict while our estimate of
+# its size (from the last scan and what we've stored since) is within bounds; other
+# executors and pipelines sharing the cache add to it meanwhile
+EVICT_INTERVAL = 600
+
+def copyFile(src, dst):
+    """copy src to dst, as a reflink (sharing blocks until either is modified) where
+    the file system supports it.  (Not a hardlink, so that a later overwrite of an
+    output in place, e.g., by a run without the cache, can't alter a cache entry.)"""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        subprocess.check_call(["cp", "--reflink=auto", src, dst])
+    except (OSError, subprocess.CalledProcessError):
+        shutil.copy2(src, dst)
+
+def companionFiles(output):
+    """files written alongside an output but not named in the command, e.g.,
+    the deformation grids referred to (by relative name) from an .xfm"""
+    if output.endswith(".xfm"):
+        return glob.glob(splitext(output)[0] + "_grid_*.mnc")
+    return []
+
+def linkFile(src, dst):
+    """hard link src to dst, falling back to a symbolic link (e.g., across file systems)"""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        os.symlink(os.path.abspath(src), dst)
+
+def linkOutputs(sources, targets):
+    """link each of one stage's outputs, and their companion files, to the
+    filenames another (equivalent) stage would have written them to"""
+    for src, dst in zip(sources, targets):
+        linkFile(src, dst)
+        for c in companionFiles(src):
+            # (keeping its name, by which the output refers to it)
+            linkFile(c, join(dirname(dst), basename(c)))
+
+class ResultCache(object):
+    """Each entry is a directory holding a stage's outputs (named by their position
+    in the stage's list of outputs) and any companion files.  Entries are used
+    least-recently-used first when the cache grows beyond max_size (in GB);
+    an entry's mtime records when it was last used."""
+    def __init__(self, directory, max_size):
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        # estimated size (in bytes) of the cache, and when it was last scanned
+        self.size = None
+        self.scanned = 0
+        fh.makedirsIgnoreExisting(join(self.directory, "digests"))
+
+    def inputDigest(self, filename):
+        """digest of a file's contents, remembered across runs as long
+        as the file's size and mtime don't change"""
+        st = os.stat(filename)
+        stamp = "%r %d" % (st.st_mtime, st.st_size)
+        memo = join(self.directory, "digests", hashlib.sha1(os.path.abspath(filename)).hexdigest())
+        try:
+            with open(memo) as f:
+                memo_stamp, digest = f.read().rsplit(' ', 1)
+            if memo_stamp == stamp:
+                return digest
+        except (IOError, ValueError):
+            pass
+        digest = fh.fileDigest(filename)
+        with open(memo, 'w') as f:
+            f.write("%s %s" % (stamp, digest))
+        return digest
+
+    def key(self, args, inputFiles, outputFiles):
+        """the cache key for a command, or None if it can't be cached.  The contents of
+        all input files are included, since a tool may take them within a larger
+        argument (e.g., mincANTS's 'CC[source,target,1,4]'); an argument which is
+        itself an input file is represented by its position among them, and an output
+        file by its position and basename (since an output may refer to another by
+        relative name)"""
+        if not outputFiles:
+            return None
+        h = hashlib.sha1()
+        try:
+            for f in inputFiles:
+                h.update("in:" + self.inputDigest(f) + "\0")
+            for a in args:
+                out = fh.outputPosition(a, outputFiles)
+                if a in inputFiles:
+                    h.update("in%d" % inputFiles.index(a))
+                elif out is not None:
+                    h.update("out%d:%s:%s" % (out[0], out[1], basename(a)))
+                else:
+                    h.update("arg:" + a)
+                h.update("\0")
+        except (IOError, OSError):
+            logger.exception("Couldn't compute cache key")
+            return None
+        return h.hexdigest()
+
+    def entry(self, key):
+        return join(self.directory, key[:2], key)
+
+    def materialize(self, key, outputFiles):
+        """if key is in the cache, copy its outputs into place and return True"""
+        entry = self.entry(key)
+        try:
+            with open(join(entry, "manifest")) as f:
+                manifest = [l.rstrip('\n').split(' ', 1) for l in f]
+        except IOError:
+            return False
+        # check the entry is intact before using it
+        for size, name in manifest:
+            path = join(entry, name)
+            if not exists(path) or os.path.getsize(path) != int(size):
+                logger.warn("Discarding corrupt cache entry %s", entry)
+                shutil.rmtree(entry, ignore_errors=True)
+                return False
+        for _, name in manifest:
+            if '.' in name:
+                k, companion = name.split('.', 1)
+                dst = join(dirname(outputFiles[int(k)]), companion)
+            else:
+                dst = outputFiles[int(name)]
+            copyFile(join(entry, name), dst)
+        os.utime(entry, None)
+        return True
+
+    def store(self, key, outputFiles):
+        entry = self.entry(key)
+        if exists(entry):
+            return
+        tmp = "%s.tmp-%s-%d" % (entry, os.uname()[1], os.getpid())
+        fh.makedirsIgnoreExisting(tmp)
+        try:
+            manifest = []
+            size = 0
+            for k, o in enumerate(outputFiles):
+                names = [(str(k), o)] + [("%d.%s" % (k, basename(c)), c) for c in companionFiles(o)]
+                for name, src in names:
+                    copyFile(src, join(tmp, name))
+                    manifest.append("%d %s" % (os.path.getsize(src), name))
+                    size += os.path.getsize(src)
+            with open(join(tmp, "manifest"), 'w') as f:
+                f.write("\n".join(manifest) + "\n")
+            size += os.path.getsize(join(tmp, "manifest"))
+            os.rename(tmp, entry)
+        except OSError:
+            # e.g., another executor stored the same result first
+            logger.debug("Couldn't store %s in the result cache", key, exc_info=True)
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        if self.size is not None:
+            self.size += size
+        if (self.size is None or self.size > self.max_size * 2**30
+            or time.time() - self.scanned > EVICT_INTERVAL):
+            self.evict()
+
+    def evict(self):
+        """remove least recently used entries until the cache fits in max_size"""
+        entries = []
+        for d in glob.glob(join(self.directory, "??", "*")):
+            if '.tmp-' in basename(d) or not isdir(d):
+                continue
+            try:
+                size = sum(os.path.getsize(join(d, f)) for f in os.listdir(d))
+                entries.append((os.path.getmtime(d), size, d))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        limit = self.max_size * 2**30
+        for _, size, d in sorted(entries):
+            if total <= limit:
+                break
+            logger.debug("Evicting %s from the result cache", d)
+            shutil.rmtree(d, ignore_errors=True)
+            total -= size
+        self.size = total
+        self.scanned = time.time()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import logging
+import os
+import shutil
+
+"""Speculative re-execution of straggling stages (--speculate): a duplicate
+of a stage running for much longer than usual for its tool is run on another
+executor, writing its outputs to a separate directory alongside each of the
+stage's output directories.  If the duplicate finishes first, the files in
+these directories are moved into place (each by a rename, which is atomic)."""
+
+logger = logging.getLogger(__name__)
+
+# runtimes of a tool which must have been observed before its stages can be
+# judged to be straggling
+MIN_SAMPLES = 3
+
+def speculativeDir(i, output):
+    """where a duplicate of stage i writes the given output (keeping its
+    basename, so files which refer to one another by name, such as an xfm
+    and its grid, remain consistent)"""
+    return os.path.join(os.path.dirname(os.path.abspath(output)), ".speculative_%d" % i)
+
+def speculativeCommand(i, stage):
+    """stage i's command with its outputs redirected, or None if this can't be
+    done since some output isn't a separate argument (e.g., '-o=file')"""
+    outputs = set(stage.outputFiles)
+    if not outputs or not outputs <= set(stage.cmd):
+        return None
+    return [os.path.join(speculativeDir(i, a), os.path.basename(a)) if a in outputs else a
+            for a in stage.cmd]
+
+def speculativeDirs(i, stage):
+    return sorted(set(speculativeDir(i, o) for o in stage.outputFiles))
+
+def prepare(i, stage):
+    for d in speculativeDirs(i, stage):
+        if os.path.exists(d):
+            shutil.rmtree(d)
+        os.makedirs(d)
+
+def promote(i, stage):
+    """move everything written by a duplicate of stage i into place"""
+    for d in speculativeDirs(i, stage):
+        parent = os.path.dirname(d)
+        for f in os.listdir(d):
+            os.rename(os.path.join(d, f), os.path.join(parent, f))
+        os.rmdir(d)
+
+def discard(i, stage):
+    for d in speculativeDirs(i, stage):
+        shutil.rmtree(d, ignore_errors=True)
@@ -1,5 +1,49 @@
 #!/usr/bin/env python
 
+from pydpiper.pipeline import Pipeline
+from pydpiper.pipeline_executor import addExecutorArgumentGroup
+from pydpiper.application import addApplicationArgumentGroup
+from atoms_and_modules.registration_functions import addGenRegArgumentGroup
+from configargparse import ArgParser
+from multiprocessing import Event
+from StringIO import StringIO
+import tempfile
+
+# helpers shared by the tests (imported from here, e.g., `from conftest import parseOptions`)
+
+def generateFile(i):
+    return("filename_" + str(i) + ".mnc")
+
+def parseOptions(args=[]):
+    """the options of a pipeline (with its output in a new directory) given args"""
+    parser = ArgParser()
+    addGenRegArgumentGroup(parser)
+    addExecutorArgumentGroup(parser)
+    addApplicationArgumentGroup(parser)
+    return parser.parse_args(["--pipeline-name=test",
+                              "--output-dir=" + tempfile.mkdtemp()] + args)
+
+def makePipeline(options, stages):
+    """an initialized pipeline of the given stages, with a client "uri" registered"""
+    p = Pipeline(options)
+    for s in stages:
+        p.addStage(s)
+    p.initialize()
+    p.finished_stages_fh = StringIO()
+    p.shutdown_ev = Event()
+    p.memAvail = options.mem
+    p.registerClient("uri", options.mem)
+    return p
+
+class FakeClient(object):
+    """stands in for the executor's proxy when running stages' processes"""
+    def __init__(self):
+        self.pids = []
+    def addPIDtoRunningList(self, pid, i=None):
+        self.pids.append(pid)
+    def removePIDfromRunningList(self, pid):
+        self.pids.remove(pid)
+
 def pytest_funcarg__setupopts(request):
     return OptsSetup(request)
 
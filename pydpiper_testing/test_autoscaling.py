@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+from pydpiper.autoscaling import Autoscaler, ExecutorShape, packDemand
+from pydpiper.pipeline import CmdStage, InputFile, OutputFile
+from conftest import parseOptions, makePipeline, generateFile
+
+class FakeQueue():
+    """records the executors it's asked to launch instead of submitting them"""
+    def __init__(self):
+        self.launched = []
+    def launch(self, shape):
+        self.launched.append(shape)
+
+def test_pack_demand():
+    shapes = packDemand([(20, 1)] + [(1, 1)] * 10, maxMem=32, maxProcs=4)
+    # the large stage shares an executor with three small ones (4 processors)
+    assert sorted(shapes) == [ExecutorShape(4, 3), ExecutorShape(4, 4), ExecutorShape(32, 4)]
+
+class TestAutoscaler():
+    def setup_method(self, method):
+        self.queue = FakeQueue()
+        self.scaler = Autoscaler(maxExecutors=3, maxMem=32, maxProcs=4,
+                                 launch=self.queue.launch, hysteresis=2)
+
+    def test_hysteresis(self):
+        demands = [(20, 1), (1, 1)]
+        self.scaler.update(demands, [])
+        assert self.queue.launched == []
+        self.scaler.update(demands, [])
+        assert self.queue.launched == [ExecutorShape(32, 2)]
+        # the launched executor is expected to absorb the demand until it registers:
+        self.scaler.update(demands, [])
+        self.scaler.update(demands, [])
+        assert len(self.queue.launched) == 1
+
+    def test_max_executors(self):
+        for _ in range(2):
+            self.scaler.update([(20, 1)] * 5, [])
+        assert self.queue.launched == [ExecutorShape(32, 1)] * 3
+
+    def test_existing_capacity_and_retirement(self):
+        clients = [("busy", ExecutorShape(8, 4), 2, 1), ("idle", ExecutorShape(8, 4), 0, 0)]
+        assert self.scaler.update([(1, 1)], clients) == []
+        assert self.scaler.update([(1, 1)], clients) == ["idle"]
+        assert self.queue.launched == []
+
+def test_server_autoscaling():
+    options = parseOptions(["--autoscale", "--num-executors=2", "--mem=32", "--proc=2"])
+    stages = ([CmdStage(["mincANTS", InputFile(generateFile(0)), OutputFile(generateFile(1))])]
+              + [CmdStage(["mincblur", InputFile(generateFile(i)), OutputFile(generateFile(i + 1))])
+                 for i in [2, 4]])
+    stages[0].setMem(20)
+    for s in stages[1:]:
+        s.setMem(1)
+    p = makePipeline(options, stages)
+    queue = FakeQueue()
+    p.launchExecutorsFromServer = lambda n, mem, procs: queue.launch(ExecutorShape(mem, procs))
+    # "uri" (with 32G and 2 processors) is idle, so fits two stages; one more executor is needed
+    for _ in range(2):
+        p.manageExecutors()
+    assert len(queue.launched) == 1
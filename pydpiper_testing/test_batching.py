@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from conftest import parseOptions, makePipeline, generateFile
+
+class TestBatching():
+    def setup_method(self, method):
+        self.stages = ([CmdStage(["xfmconcat", InputFile(generateFile(i)), OutputFile(generateFile(i + 10))])
+                        for i in range(5)]
+                       + [CmdStage(["mincANTS", InputFile(generateFile(5)), OutputFile(generateFile(15))])])
+
+    def test_batch_dispatch(self):
+        p = makePipeline(parseOptions(["--batch-small-stages=3"]), self.stages)
+        batches = [p.getCommand("uri", 10, 1) for _ in range(3)]
+        flags = sorted(flag for flag, _ in batches)
+        assert flags == ["run_batch", "run_batch", "run_stage"]
+        dispatched = []
+        for flag, i in batches:
+            if flag == "run_batch":
+                assert len(i) <= 3
+                assert all(p.isSmallStage(j) for j in i)
+                dispatched += i
+            else:
+                dispatched.append(i)
+        assert sorted(dispatched) == range(6)
+        assert p.runnable == set()
+
+    def test_batch_results(self):
+        p = makePipeline(parseOptions(["--batch-small-stages=10"]), self.stages[:5])
+        flag, batch = p.getCommand("uri", 10, 1)
+        assert flag == "run_batch" and sorted(batch) == range(5)
+        p.setStagesStarted(batch, "uri")
+        p.setStagesTerminated([(i, 0, 0.5) for i in batch], "uri")
+        assert p.allStagesCompleted()
+        assert p.runtime_estimates.estimate("xfmconcat") == 0.5
+
+    def test_no_batching_by_default(self):
+        p = makePipeline(parseOptions(), self.stages)
+        assert p.getCommand("uri", 10, 1)[0] == "run_stage"
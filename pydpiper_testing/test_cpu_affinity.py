@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+from pydpiper.cpu_affinity import CPUAllocator, parseCPUList, allowedCPUs
+from pydpiper.pipeline_executor import runProcess
+from conftest import FakeClient
+import tempfile
+
+def allocator(nodes):
+    a = CPUAllocator()
+    a.nodes = nodes
+    a.free = set(c for node in nodes for c in node)
+    return a
+
+class TestCPUAllocator():
+    def test_parse(self):
+        assert parseCPUList("0-3,8,10-11\n") == [0, 1, 2, 3, 8, 10, 11]
+
+    def test_numa_locality(self):
+        a = allocator([range(0, 8), range(8, 16)])
+        first = a.allocate(6)
+        assert set(first) <= set(range(0, 8))
+        # the fuller node is used if the stage fits, keeping the other free for a larger one:
+        assert set(a.allocate(2)) <= set(range(0, 8))
+        assert set(a.allocate(8)) == set(range(8, 16))
+        assert a.allocate(1) is None
+        a.release(first)
+        assert len(a.allocate(6)) == 6
+
+    def test_spanning_nodes(self):
+        a = allocator([range(0, 4), range(4, 8)])
+        a.allocate(3)
+        assert len(set(a.allocate(5))) == 5
+        assert not a.free
+
+class TestStageProcess():
+    def output(self, args, **kwargs):
+        log = tempfile.TemporaryFile()
+        assert runProcess(FakeClient(), 0, args, log, **kwargs) == 0
+        log.seek(0)
+        return log.read()
+
+    def test_thread_variables(self):
+        assert self.output(["sh", "-c", "echo $OMP_NUM_THREADS $ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"],
+                           procs=4).split() == ["4", "4"]
+
+    def test_pinning(self):
+        cpu = allowedCPUs()[-1]
+        status = self.output(["grep", "Cpus_allowed_list", "/proc/self/status"], cpus=[cpu])
+        assert parseCPUList(status.split(":")[1]) == [cpu]
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from pydpiper.direct_submission import DirectSubmission
+import pydpiper.direct_submission
+from conftest import parseOptions
+from StringIO import StringIO
+import tempfile
+import os
+
+class TestDirectSubmission():
+    """Stages are submitted to a fake qsub (or sbatch), which records its arguments
+    and runs each job as soon as it's submitted"""
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp()
+        for submit, jobID in [("qsub", "$$.fake"), ("sbatch", "\"$$;cluster\"")]:
+            self.stub(submit, "echo \"$@\" >> %s/qsub_calls\n"
+                              "for script; do :; done\n"
+                              "[ -e %s/norun ] || bash \"$script\" > /dev/null 2>&1\n"
+                              "echo %s" % (self.dir, self.dir, jobID))
+        # an empty queue, the jobs having run (or been killed) already
+        self.stub("qstat", "")
+        self.stub("squeue", "")
+        for cancel in ["qdel", "scancel"]:
+            self.stub(cancel, "echo \"$@\" >> %s/cancelled" % self.dir)
+        self.path = os.environ["PATH"]
+        os.environ["PATH"] = self.dir + os.pathsep + self.path
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)
+        with open("a", 'w') as f:
+            f.write("a")
+
+    def teardown_method(self, method):
+        os.environ["PATH"] = self.path
+        os.chdir(self.cwd)
+
+    def stub(self, command, script):
+        filename = os.path.join(self.dir, command)
+        with open(filename, 'w') as f:
+            f.write("#!/bin/sh\n" + script + "\n")
+        os.chmod(filename, 0755)
+
+    def run(self, commands, args=["--queue-type=sge"]):
+        options = parseOptions(["--submit-stages"] + args)
+        p = Pipeline(options)
+        for c in commands:
+            p.addStage(c if isinstance(c, CmdStage) else CmdStage(c))
+        p.initialize()
+        p.finished_stages_fh = StringIO()
+        self.submission = DirectSubmission(p, options)
+        self.submission.run()
+        self.qsubCalls = open(os.path.join(self.dir, "qsub_calls")).read().splitlines()
+        return p
+
+    def test_dependencies(self):
+        p = self.run([["cp", InputFile("a"), OutputFile("b")],
+                      ["cp", InputFile("b"), OutputFile("c")],
+                      ["cp", InputFile("b"), OutputFile("d")]])
+        assert p.allStagesCompleted()
+        assert os.path.exists("c") and os.path.exists("d")
+        assert len(self.qsubCalls) == 3
+        assert "-hold_jid " + self.submission.jobIDs[0] in self.qsubCalls[1]
+        assert len(p.finished_stages_fh.getvalue().splitlines()) == 3
+
+    def test_failure_skips_descendants(self):
+        p = self.run([["false", InputFile("a"), OutputFile("b")],
+                      ["cp", InputFile("b"), OutputFile("c")],
+                      ["cp", InputFile("a"), OutputFile("d")]])
+        assert not p.allStagesCompleted()
+        assert sorted(p.failedStages) == [0, 1]
+        assert p.stages[2].isFinished()
+        assert not os.path.exists("c")
+
+    def test_fuse_chains(self):
+        p = self.run([["cp", InputFile("a"), OutputFile("b")],
+                      ["cp", InputFile("b"), OutputFile("c")],
+                      ["cp", InputFile("c"), OutputFile("d")]],
+                     args=["--queue-type=sge", "--fuse-chains"])
+        assert p.allStagesCompleted()
+        assert len(self.qsubCalls) == 1
+
+    def test_pbs_dependencies(self):
+        p = self.run([["cp", InputFile("a"), OutputFile("b")],
+                      ["cp", InputFile("b"), OutputFile("c")]],
+                     args=["--queue-type=pbs", "--time=1:00:00"])
+        assert p.allStagesCompleted()
+        assert "-W depend=afterok:" in self.qsubCalls[1]
+        assert "walltime=1:00:00" in self.qsubCalls[0]
+
+    def test_slurm_dependencies(self):
+        p = self.run([["cp", InputFile("a"), OutputFile("b")],
+                      ["cp", InputFile("b"), OutputFile("c")]],
+                     args=["--queue-type=slurm", "--time=1:00:00"])
+        assert p.allStagesCompleted()
+        assert "--dependency=afterok:" + self.submission.jobIDs[0] in self.qsubCalls[1]
+        assert "--time=1:00:00" in self.qsubCalls[0]
+
+    def test_failure_cancels_queued_descendants(self):
+        # (with PBS, the jobs of a failed stage's descendants would never leave the queue)
+        p = self.run([["false", InputFile("a"), OutputFile("b")],
+                      ["cp", InputFile("b"), OutputFile("c")]],
+                     args=["--queue-type=pbs"])
+        assert sorted(p.failedStages) == [0, 1]
+        cancelled = open(os.path.join(self.dir, "cancelled")).read().split()
+        assert cancelled == [self.submission.jobIDs[1]]
+
+    def test_killed_jobs_fail(self):
+        open("norun", 'w').close()
+        poll_interval = pydpiper.direct_submission.POLL_INTERVAL
+        pydpiper.direct_submission.POLL_INTERVAL = 0
+        try:
+            p = self.run([["cp", InputFile("a"), OutputFile("b")],
+                          ["cp", InputFile("b"), OutputFile("c")]])
+        finally:
+            pydpiper.direct_submission.POLL_INTERVAL = poll_interval
+        assert not p.allStagesCompleted()
+        assert sorted(p.failedStages) == [0, 1]
+
+    def test_stale_status_files_ignored(self):
+        # a previous run's record of a stage's success, its job now never running
+        status = os.path.join(self.dir, "test-stage-jobs", "status")
+        os.makedirs(status)
+        with open(os.path.join(status, "0"), 'w') as f:
+            f.write("0\n")
+        open("norun", 'w').close()
+        poll_interval = pydpiper.direct_submission.POLL_INTERVAL
+        pydpiper.direct_submission.POLL_INTERVAL = 0
+        try:
+            p = self.run([["cp", InputFile("a"), OutputFile("b")]])
+        finally:
+            pydpiper.direct_submission.POLL_INTERVAL = poll_interval
+        assert p.failedStages == [0]
+
+    def test_memory_from_hooks(self):
+        s = CmdStage(["cp", InputFile("a"), OutputFile("b")])
+        s.runnable_hooks.append(lambda: s.setMem(5))
+        t = CmdStage(["cat", InputFile("b"), OutputFile("c")])
+        t.runnable_hooks.append(lambda: t.setMem(6))
+        self.run([s, t])
+        # (the second stage's input doesn't exist when it's submitted)
+        assert "vf=5.0G" in self.qsubCalls[0]
+        assert "vf=1.75G" in self.qsubCalls[1]
+
+    def test_stage_mem(self):
+        t = CmdStage(["cat", InputFile("b"), OutputFile("c")])
+        t.runnable_hooks.append(lambda: t.setMem(6))
+        self.run([["cp", InputFile("a"), OutputFile("b")], t],
+                 args=["--queue-type=sge", "--stage-mem=cat=8"])
+        assert "vf=8.0G" in self.qsubCalls[1]
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from pydpiper.events import readEvents
+from conftest import parseOptions
+from multiprocessing import Event
+from StringIO import StringIO
+import tempfile
+import os
+
+class TestEventJournal():
+    def setup_method(self, method):
+        self.outputDir = tempfile.mkdtemp()
+        self.p = Pipeline(parseOptions(["--event-journal"]))
+        for i in range(2):
+            s = CmdStage(["mincaverage", InputFile("in.mnc"), OutputFile("out_%d.mnc" % i)])
+            s.setMem(1)
+            self.p.addStage(s)
+        self.p.setBackupFileLocation(self.outputDir)
+        self.p.initialize()
+        self.p.finished_stages_fh = StringIO()
+        self.p.shutdown_ev = Event()
+        self.p.registerClient("uri", 4, maxprocs=2)
+
+    def events(self):
+        self.p.events.flush()
+        return list(readEvents(os.path.join(self.outputDir, "test_events.jsonl")))
+
+    def test_stage_lifecycle(self):
+        flag, i = self.p.getCommand("uri", 4, 2)
+        self.p.setStageStarted(i, "uri")
+        self.p.setStagesTerminated([(i, 0, 12.5)], "uri")
+        _, j = self.p.getCommand("uri", 4, 2)
+        self.p.setStageStarted(j, "uri")
+        self.p.setStageLost(j, "uri")
+        self.p.unregisterClient("uri")
+        events = self.events()
+        assert [e["event"] for e in events] == ["register", "dispatch", "start", "finish",
+                                                "dispatch", "start", "lost", "unregister"]
+        assert events[0]["procs"] == 2
+        assert events[1]["stage"] == i and events[1]["resources"] == {"mem": 1, "procs": 1}
+        assert events[3]["runtime"] == 12.5 and events[3]["executor"] == "uri"
+        assert all(e["t"] >= events[0]["t"] for e in events)
+
+    def test_retry(self):
+        _, i = self.p.getCommand("uri", 4, 2)
+        self.p.setStageStarted(i, "uri")
+        self.p.setStagesTerminated([(i, 1, None)], "uri")
+        retry = self.events()[-1]
+        assert (retry["event"], retry["stage"], retry["cause"], retry["retries"]) == ("retry", i, 1, 1)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from pydpiper.fair_share import FairShareSet
+from conftest import parseOptions
+from multiprocessing import Event
+from StringIO import StringIO
+import tempfile
+import os
+
+def study(name, n):
+    """a pipeline of n independent stages"""
+    p = Pipeline()
+    for k in range(n):
+        p.addStage(CmdStage(["process", InputFile("%s_%d.mnc" % (name, k)),
+                             OutputFile("%s_%d_out.mnc" % (name, k))]))
+    return p
+
+class TestFairShareSet():
+    def test_weighted_pop(self):
+        s = FairShareSet()
+        s.addShare("a", weight=1)
+        s.addShare("b", weight=3)
+        for i in range(8):
+            s.assign(i, "a" if i < 4 else "b")
+            s.add(i)
+        popped = []
+        for _ in range(4):
+            i = s.pop()
+            s.charge(i, 1.0)
+            popped.append(i)
+        # "b" gets three stages for each of "a"'s:
+        assert len([i for i in popped if i >= 4]) == 3
+        assert len(s) == 4
+
+    def test_idle_share_banks_no_credit(self):
+        s = FairShareSet()
+        s.addShare("a")
+        s.addShare("b")
+        s.assign(0, "a")
+        s.add(0)
+        s.charge(s.pop(), 100.0)
+        s.assign(1, "a")
+        s.add(1)
+        s.assign(2, "b")
+        s.add(2)
+        assert s.shares["b"].vtime == 100.0
+
+class TestMultiplePipelines():
+    def setup_method(self, method):
+        self.options = parseOptions(["--mem=100", "--proc=100"])
+        self.p = Pipeline(self.options)
+        self.p.addPipeline(study("big", 20))
+        self.p.addPipeline(study("small", 2), name="small")
+        self.p.initialize()
+        self.p.finished_stages_fh = StringIO()
+        self.p.shutdown_ev = Event()
+        self.p.registerClient("uri", 100, maxprocs=100)
+
+    def dispatch(self):
+        flag, i = self.p.getCommand("uri", 100, 100)
+        assert flag == "run_stage"
+        self.p.setStageStarted(i, "uri")
+        return i
+
+    def test_small_pipeline_not_starved(self):
+        first = [self.dispatch() for _ in range(4)]
+        assert len([i for i in first if i >= 20]) == 2
+
+    def test_add_while_running(self):
+        self.dispatch()
+        journal = os.path.join(tempfile.mkdtemp(), "late_finished_stages")
+        late = Pipeline()
+        late.addStage(CmdStage(["first", InputFile("in.mnc"), OutputFile("late_1.mnc")]))
+        late.addStage(CmdStage(["second", InputFile("late_1.mnc"), OutputFile("late_2.mnc")]))
+        # as if the first stage ran when the pipeline was run on its own:
+        with open(journal, 'w') as f:
+            f.write("0,%s\n" % late.stages[0].getHash())
+        self.p.addPipeline(late, name="late", journal=journal)
+        assert self.p.stages[22].isFinished()
+        assert 23 in self.p.runnable
+        # the new pipeline hasn't run anything, so it goes next:
+        assert self.dispatch() == 23
+        self.p.setStageFinished(23, "uri")
+        assert open(journal).read().splitlines()[-1] == "1,%s" % self.p.stages[23].getHash()
+
+    def test_persistent_server_waits(self):
+        self.options.persistent_server = True
+        for _ in range(22):
+            self.p.setStageFinished(self.dispatch(), "uri")
+        assert self.p.allStagesCompleted()
+        assert self.p.getCommand("uri", 100, 100) == ("wait", None)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from pydpiper.local_engine import LocalEngine
+from conftest import parseOptions
+import pydpiper.pipeline
+from StringIO import StringIO
+import tempfile
+import time
+import os
+
+class TestLocalEngine():
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)
+        with open("a", 'w') as f:
+            f.write("a")
+        self.retry_interval = pydpiper.pipeline.STAGE_RETRY_INTERVAL
+        pydpiper.pipeline.STAGE_RETRY_INTERVAL = 0
+        self.backoff = pydpiper.pipeline.TIMEOUT_RETRY_BACKOFF
+        pydpiper.pipeline.TIMEOUT_RETRY_BACKOFF = 0
+
+    def teardown_method(self, method):
+        os.chdir(self.cwd)
+        pydpiper.pipeline.STAGE_RETRY_INTERVAL = self.retry_interval
+        pydpiper.pipeline.TIMEOUT_RETRY_BACKOFF = self.backoff
+
+    def run(self, stages, args=[]):
+        options = parseOptions(["--local-fast"] + args)
+        p = Pipeline(options)
+        for s in stages:
+            p.addStage(s)
+        p.initialize()
+        p.finished_stages_fh = StringIO()
+        LocalEngine(p, options).run()
+        return p
+
+    def test_dependencies(self):
+        p = self.run([CmdStage(["cp", InputFile("a"), OutputFile("b")]),
+                      CmdStage(["cp", InputFile("b"), OutputFile("c")]),
+                      CmdStage(["cp", InputFile("b"), OutputFile("d")])])
+        assert p.allStagesCompleted()
+        assert os.path.exists("c") and os.path.exists("d")
+        assert len(p.finished_stages_fh.getvalue().splitlines()) == 3
+
+    def test_concurrency_limited_by_memory(self):
+        # (distinct commands, since identical stages are only added once)
+        stages = [CmdStage(["sleep", "0.5" + "0" * k]) for k in range(4)]
+        for s in stages:
+            s.setMem(1)
+        start = time.time()
+        p = self.run(stages, args=["--mem=2", "--proc=4"])
+        elapsed = time.time() - start
+        assert p.allStagesCompleted()
+        # two at a time:
+        assert 1.0 <= elapsed < 2.0
+
+    def test_failure(self):
+        p = self.run([CmdStage(["false", InputFile("a"), OutputFile("b")]),
+                      CmdStage(["cp", InputFile("b"), OutputFile("c")]),
+                      CmdStage(["cp", InputFile("a"), OutputFile("d")])])
+        assert not p.allStagesCompleted()
+        assert p.stages[0].status == "failed"
+        assert p.stages[2].isFinished()
+        assert not os.path.exists("c")
+
+    def test_oversized_stage(self):
+        big = CmdStage(["true"])
+        big.setMem(100)
+        p = self.run([big], args=["--mem=2"])
+        assert not p.allStagesCompleted()
+        assert p.stages[0].status is None
+
+    def test_timeout(self):
+        slow = CmdStage(["sleep", "30"])
+        slow.timeout = 0.5
+        start = time.time()
+        p = self.run([slow])
+        assert time.time() - start < 10
+        assert p.stages[0].status == "failed"
+        assert p.stages[0].timed_out_on == set(["local"])
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from conftest import parseOptions, makePipeline, generateFile
+
+class TestMalleableStages():
+    def setup_method(self, method):
+        self.stages = [CmdStage(["mincANTS", InputFile(generateFile(0)), OutputFile(generateFile(i))])
+                       for i in range(1, 5)]
+        for s in self.stages:
+            s.setProcsRange(1, 8)
+
+    def test_procs_follow_queue_depth(self):
+        p = makePipeline(parseOptions(), self.stages)
+        p.registerClient("big", 10, maxprocs=8)
+        # four runnable stages share eight processors:
+        flag, i = p.getCommand("big", 10, 8)
+        assert p.getStageProcs(i) == 2
+        p.setStageStarted(i, "big")
+        for _ in range(2):
+            p.setStageStarted(p.getCommand("big", 10, 8)[1], "big")
+        # the last stage may use all those free:
+        flag, j = p.getCommand("big", 10, 6)
+        assert p.getStageProcs(j) == 6
+        # but is back to its minimum if requeued
+        p.setStageStarted(j, "big")
+        p.setStageLost(j, "big")
+        assert p.getStageProcs(j) == 1
+
+    def test_procs_shared_between_executors(self):
+        p = makePipeline(parseOptions(), self.stages)
+        for uri in ["a", "b", "c"]:
+            p.registerClient(uri, 10, maxprocs=8)
+        # (makePipeline also registers an executor, "uri"); the three other runnable
+        # stages are presumed to go one to each of three of the four executors:
+        flag, i = p.getCommand("a", 10, 8)
+        assert p.getStageProcs(i) == 4
+
+    def test_procs_ignore_stages_which_dont_fit(self):
+        self.stages[0].setMem(1)
+        for s in self.stages[1:]:
+            s.setMem(20)
+        p = makePipeline(parseOptions(), self.stages)
+        # none of the other stages could run on this executor, so this one gets all it has:
+        flag, i = p.getCommand("uri", 10, 8)
+        assert i == 0 and p.getStageProcs(i) == 8
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from pydpiper.pipeline_executor import (runProcess, outOfMemory,
+                                        OUT_OF_MEMORY, MEMORY_LIMIT_EXCEEDED)
+from pydpiper.memory_limits import MemoryLimiter
+from conftest import parseOptions, FakeClient
+from multiprocessing import Event
+from StringIO import StringIO
+import tempfile
+import signal
+import os
+
+class TestClassification():
+    def test_out_of_memory(self):
+        # 1.9G of 2G used:
+        assert outOfMemory(-signal.SIGKILL, 1.9 * 1024 * 1024, 2, None, None)
+        assert not outOfMemory(-signal.SIGKILL, 0.5 * 1024 * 1024, 2, None, None)
+        assert not outOfMemory(1, 1.9 * 1024 * 1024, 2, None, None)
+        # counted by the cgroup's OOM killer:
+        assert outOfMemory(-signal.SIGKILL, 0, 2, 3, 4)
+
+    def test_run_process(self):
+        log = tempfile.TemporaryFile()
+        # (any shell uses more than 1KB)
+        assert runProcess(FakeClient(), 0, ["sh", "-c", "kill -9 $$"], log, mem=1e-6) == OUT_OF_MEMORY
+        assert runProcess(FakeClient(), 0, ["sh", "-c", "kill -9 $$"], log) == -signal.SIGKILL
+
+class TestMemoryEscalation():
+    def setup_method(self, method):
+        self.options = parseOptions(["--mem=6"])
+        self.outputDir = tempfile.mkdtemp()
+        self.p = self.pipeline()
+
+    def pipeline(self):
+        p = Pipeline(self.options)
+        s = CmdStage(["mincANTS", InputFile("in.mnc"), OutputFile("out.xfm")])
+        s.setMem(2)
+        p.addStage(s)
+        p.setBackupFileLocation(self.outputDir)
+        p.initialize()
+        p.finished_stages_fh = StringIO()
+        p.shutdown_ev = Event()
+        p.registerClient("uri", 6)
+        return p
+
+    def fail(self):
+        self.p.getCommand("uri", 6, 1)
+        self.p.setStageStarted(0, "uri")
+        self.p.setStagesTerminated([(0, OUT_OF_MEMORY, None)], "uri")
+
+    def test_escalation(self):
+        self.fail()
+        assert self.p.getStageMem(0) == 4
+        assert 0 in self.p.runnable
+        assert self.p.stages[0].getNumberOfRetries() == 0
+        self.fail()
+        # (no more than the largest executor has)
+        assert self.p.getStageMem(0) == 6
+        self.fail()
+        # ... after which it's retried as any other failure
+        assert self.p.getStageMem(0) == 6
+        assert self.p.stages[0].getNumberOfRetries() == 1
+
+    def test_correction_remembered(self):
+        self.fail()
+        # a later run of the pipeline requests enough memory from the start:
+        assert self.pipeline().getStageMem(0) == 4
+
+class TestMemoryLimits():
+    def test_rlimit_exceeded(self):
+        log = tempfile.TemporaryFile()
+        limiter = MemoryLimiter("rlimit", 1.25)
+        grow = ["python", "-c", "l = []\nwhile True: l.append(' ' * 10**6)"]
+        assert runProcess(FakeClient(), 0, grow, log, mem=0.1, limiter=limiter) == MEMORY_LIMIT_EXCEEDED
+        assert runProcess(FakeClient(), 0, ["false"], log, mem=0.1, limiter=limiter) == 1
+        assert runProcess(FakeClient(), 0, ["true"], log, mem=0.1, limiter=limiter) == 0
+
+    def test_failure_within_limit(self):
+        # a stage failing after using more than its requirement, but well within
+        # the limit, failed for some other reason
+        log = tempfile.TemporaryFile()
+        limiter = MemoryLimiter("rlimit", 3)
+        grow = ["python", "-c", "import sys\nl = ' ' * 150 * 10**6\nsys.exit(1)"]
+        assert runProcess(FakeClient(), 0, grow, log, mem=0.1, limiter=limiter) == 1
+        assert not limiter.exceeded(1, None, 1, 1.5 * 1024 ** 2)
+        assert limiter.exceeded(1, None, 1, 2.9 * 1024 ** 2)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from conftest import parseOptions, makePipeline, generateFile
+from shlex import split
+import subprocess
+import tempfile
+import os
+
+class TestMergeEquivalentStages():
+    def setup_method(self, method):
+        self.stages = [CmdStage(["mincblur", "-fwhm", "0.5", InputFile(generateFile(0)),
+                                 OutputFile("%s/blurred.mnc" % d)])
+                       for d in ["dir_a", "dir_b"]]
+        self.stages.append(CmdStage(["mincresample", InputFile("dir_b/blurred.mnc"),
+                                     OutputFile(generateFile(1))]))
+
+    def test_duplicate_becomes_link(self):
+        p = makePipeline(parseOptions(["--merge-equivalent-stages"]), self.stages)
+        assert isinstance(p.stages[1], LinkStage)
+        assert p.stages[1].inputFiles == ["dir_a/blurred.mnc"]
+        assert p.stages[1].outputFiles == ["dir_b/blurred.mnc"]
+        assert p.G.has_edge(0, 1) and p.G.has_edge(1, 2)
+        assert p.runnable == set([0])
+
+    def test_different_args_not_merged(self):
+        self.stages[1].cmd[2] = "1.0"
+        p = makePipeline(parseOptions(["--merge-equivalent-stages"]), self.stages)
+        assert not isinstance(p.stages[1], LinkStage)
+
+    def test_no_merging_by_default(self):
+        p = makePipeline(parseOptions(), self.stages)
+        assert p.runnable == set([0, 1])
+
+class TestLinkStage():
+    def test_links_companion_files(self):
+        d = tempfile.mkdtemp()
+        for f in ["a/nlin.xfm", "a/nlin_grid_0.mnc", "b/.keep"]:
+            if not os.path.isdir(os.path.join(d, os.path.dirname(f))):
+                os.makedirs(os.path.join(d, os.path.dirname(f)))
+            open(os.path.join(d, f), 'w').close()
+        link = LinkStage([os.path.join(d, "a/nlin.xfm")], [os.path.join(d, "b/nlin.xfm")])
+        assert subprocess.call(split(repr(link))) == 0
+        assert os.path.exists(os.path.join(d, "b/nlin.xfm"))
+        # (named as in the linked .xfm, which refers to it)
+        assert os.path.exists(os.path.join(d, "b/nlin_grid_0.mnc"))
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from conftest import parseOptions, makePipeline, generateFile
+
+class TestNodeAgentLeases():
+    def setup_method(self, method):
+        self.stages = [CmdStage(["mincblur", InputFile(generateFile(0)), OutputFile(generateFile(i))])
+                       for i in range(1, 5)]
+        for s, mem in zip(self.stages, [1, 1, 1, 8]):
+            s.setMem(mem)
+
+    def test_lease_fills_node(self):
+        p = makePipeline(parseOptions(["--mem=10"]), self.stages)
+        cmd, leases = p.leaseStages("uri", 3, 4)
+        assert cmd == "run_stages"
+        assert sorted(l[0] for l in leases) == [0, 1, 2]
+        assert p.clients["uri"].running_stages == set([0, 1, 2])
+        assert leases[0][1] == p.getStageCommand(leases[0][0])
+        # the stage which didn't fit is still runnable:
+        assert p.runnable == set([3])
+        assert p.leaseStages("uri", 0, 4) == ("wait", [])
+
+    def test_batched_report(self):
+        p = makePipeline(parseOptions(["--mem=10"]), self.stages)
+        _, leases = p.leaseStages("uri", 11, 4)
+        assert len(leases) == 4
+        p.reportLeasedStages([(l[0], 0, 1.0) for l in leases], "uri")
+        assert p.allStagesCompleted()
+        assert p.leaseStages("uri", 10, 4) == ("shutdown_normally", [])
+
+    def test_reclaimed_lease(self):
+        p = makePipeline(parseOptions(["--mem=10"]), self.stages)
+        p.leaseStages("uri", 3, 4)
+        # the agent is presumed dead, so its stages are requeued ...
+        p.unregisterClient("uri")
+        assert p.runnable == set([0, 1, 2, 3])
+        # ... and a late report is ignored
+        p.registerClient("uri", 10)
+        p.reportLeasedStages([(0, 0, 1.0)], "uri")
+        assert not p.stages[0].isFinished()
@@ -1,7 +1,11 @@
 #!/usr/bin/env python
 
-from pydpiper.queueing import runOnQueueingSystem
+from pydpiper.queueing import runOnQueueingSystem, arrayTaskId
+from pydpiper.pipeline_executor import pipelineExecutor
+from conftest import parseOptions
 import pytest
+import tempfile
+import os
 from os.path import isfile
     
 class TestPbsQueueing():        
@@ -175,4 +179,50 @@ class TestPbsQueueing():
             correctName = True
         assert correctFileName == True
         assert callsExec == True
-        assert correctName == True
\ No newline at end of file
+        assert correctName == True
+class TestArrayJobs():
+    """Executors are submitted as array jobs to a fake qsub, which
+    records its arguments and the submitted script"""
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp()
+        qsub = os.path.join(self.dir, "qsub")
+        with open(qsub, 'w') as f:
+            f.write("#!/bin/sh\n"
+                    "echo \"$@\" >> %s/qsub_calls\n"
+                    "if [ -t 0 ]; then :; else cat >> %s/qsub_stdin; fi\n"
+                    "echo 1234.fake\n" % (self.dir, self.dir))
+        os.chmod(qsub, 0755)
+        self.path = os.environ["PATH"]
+        os.environ["PATH"] = self.dir + os.pathsep + self.path
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)
+
+    def teardown_method(self, method):
+        os.environ["PATH"] = self.path
+        os.chdir(self.cwd)
+
+    def qsubCalls(self):
+        return open(os.path.join(self.dir, "qsub_calls")).read().splitlines()
+
+    def test_sge_array(self):
+        options = parseOptions(["--queue-type=sge", "--num-executors=5"])
+        pipelineExecutor(options).submitToQueue(number=5)
+        calls = self.qsubCalls()
+        assert len(calls) == 1
+        assert "-t 1-5" in calls[0]
+        assert "$SGE_TASK_ID" in open(os.path.join(self.dir, "qsub_stdin")).read()
+
+    def test_pbs_array(self):
+        options = parseOptions(["--queue-type=pbs", "--num-executors=4", "--time=1:00:00",
+                                "--pbs-array-style=pbspro", "--queue-name=batch"])
+        roq = runOnQueueingSystem(options, sysArgs=["prog.py"])
+        roq.createAndSubmitExecutorJobFile(1, time=3600, after=None, number=4)
+        assert len(self.qsubCalls()) == 1
+        assert "#PBS -J 1-4" in open(roq.jobFileName).read()
+
+    def test_task_id(self):
+        os.environ["PBS_ARRAYID"] = "3"
+        try:
+            assert arrayTaskId() == 3
+        finally:
+            del os.environ["PBS_ARRAYID"]
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+from pydpiper.queueing import *
+from conftest import parseOptions
+import tempfile
+import pytest
+import os
+
+class TestQueueBackends():
+    """The queueing systems' commands are replaced by stubs which
+    record their arguments and print canned output"""
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp()
+        self.stub("qsub", "echo 1234.1-3:1")
+        self.stub("qstat", "echo '    Walltime.Remaining = 600'")
+        self.stub("sbatch", "echo '5678;cluster'")
+        self.stub("squeue", "echo 1-02:03:04")
+        self.stub("scancel", "")
+        self.path = os.environ["PATH"]
+        os.environ["PATH"] = self.dir + os.pathsep + self.path
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)
+
+    def teardown_method(self, method):
+        os.environ["PATH"] = self.path
+        os.chdir(self.cwd)
+        for var in ["PBS_JOBID", "SLURM_JOB_ID"]:
+            os.environ.pop(var, None)
+
+    def stub(self, command, output):
+        filename = os.path.join(self.dir, command)
+        with open(filename, 'w') as f:
+            f.write("#!/bin/sh\n"
+                    "echo %s \"$@\" >> %s/calls\n"
+                    "if [ -t 0 ]; then :; else cat >> %s/%s_stdin; fi\n"
+                    "%s\n" % (command, self.dir, self.dir, command, output))
+        os.chmod(filename, 0755)
+
+    def calls(self):
+        return open(os.path.join(self.dir, "calls")).read().splitlines()
+
+    def test_backend_choice(self):
+        assert queueBackend(parseOptions()) is None
+        assert isinstance(queueBackend(parseOptions(["--queue-type=slurm"])), SLURMBackend)
+        with pytest.raises(ValueError):
+            queueBackend(parseOptions(["--queue-type=lsf"]))
+
+    def test_sge_executors(self):
+        backend = queueBackend(parseOptions(["--queue-type=sge", "--pe=smp"]), ["prog.py"])
+        assert backend.submitExecutors(3, 4, 2, "uri") == "1234"
+        call = self.calls()[0]
+        assert "-t 1-3" in call and "-pe smp 2" in call and "vf=4.0G" in call
+        assert "--uri-file uri" in open(os.path.join(self.dir, "qsub_stdin")).read()
+
+    def test_slurm_executors(self):
+        backend = queueBackend(parseOptions(["--queue-type=slurm", "--queue-name=short",
+                                             "--time=1:00:00"]), ["prog.py"])
+        assert backend.submitExecutors(3, 2, 4, "uri") == "5678"
+        call = self.calls()[0]
+        for flag in ["--array=1-3", "--mem=2048M", "--cpus-per-task=4",
+                     "--partition=short", "--time=1:00:00"]:
+            assert flag in call
+        assert "$SLURM_ARRAY_TASK_ID" in open(os.path.join(self.dir, "sbatch_stdin")).read()
+
+    def test_slurm_server_generations(self):
+        options = parseOptions(["--queue-type=slurm", "--queue-name=short", "--num-executors=3",
+                                "--time=4:00:00", "--max-walltime=7200"])
+        queueBackend(options, ["prog.py"]).submitServerGenerations()
+        calls = self.calls()
+        # two generations, each a server job and an executor array job:
+        assert len(calls) == 4
+        assert "--dependency=after:5678" in calls[1]
+        assert "--dependency=afterany:5678" in calls[2]
+        scripts = sorted(os.listdir(os.path.join(self.dir, "pbs-jobs")))
+        assert "#SBATCH --array=1-2" in open(os.path.join(self.dir, "pbs-jobs", scripts[0])).read()
+
+    def test_remaining_walltime(self):
+        assert remainingWalltime() is None
+        os.environ["SLURM_JOB_ID"] = "5678"
+        assert remainingWalltime() == 86400 + 2 * 3600 + 3 * 60 + 4
+        del os.environ["SLURM_JOB_ID"]
+        os.environ["PBS_JOBID"] = "1234"
+        assert remainingWalltime() == 600
+
+    def test_slurm_timestr(self):
+        assert slurm_timestr_to_secs("5:00") == 300
+        assert slurm_timestr_to_secs("2-00:00:01") == 2 * 86400 + 1
+
+    def test_cancel(self):
+        SLURMBackend.cancel("5678")
+        assert self.calls() == ["scancel 5678"]
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from conftest import parseOptions, makePipeline, generateFile
+
+class TestResourceVectors():
+    def setup_method(self, method):
+        self.stages = [CmdStage(["mincaverage", InputFile(generateFile(0)), OutputFile(generateFile(i))])
+                       for i in range(1, 4)]
+        for s in self.stages:
+            s.setMem(1)
+            s.setResource("io_tokens", 2)
+
+    def test_pool_limit(self):
+        p = makePipeline(parseOptions(["--resource-pools=io_tokens=4"]), self.stages)
+        p.registerClient("other", 10)
+        for uri in ["uri", "other"]:
+            flag, i = p.getCommand(uri, 10, 4)
+            assert flag == "run_stage"
+            p.setStageStarted(i, uri)
+        # the pool is used up, though the executors have room:
+        assert p.getCommand("other", 10, 4) == ("wait", None)
+        p.setStageFinished(i, "other")
+        assert p.getCommand("other", 10, 4)[0] == "run_stage"
+
+    def test_pool_reserved_at_dispatch(self):
+        p = makePipeline(parseOptions(["--resource-pools=io_tokens=2"]), self.stages)
+        p.registerClient("other", 10)
+        # (the executors' workers haven't yet reported the first stage's start)
+        assert p.getCommand("uri", 10, 4)[0] == "run_stage"
+        assert p.getCommand("other", 10, 4) == ("wait", None)
+        assert p.getCommand("uri", 10, 4) == ("wait", None)
+        # a stage dispatched to an executor which goes away releases its share
+        p.unregisterClient("uri")
+        assert p.getCommand("other", 10, 4)[0] == "run_stage"
+
+    def test_executor_capacity(self):
+        p = makePipeline(parseOptions(), self.stages)
+        assert p.getCommand("uri", 10, 4, clientResourcesFree={"io_tokens": 1}) == ("wait", None)
+        # (undeclared resources are unlimited)
+        assert p.getCommand("uri", 10, 4)[0] == "run_stage"
+        _, leases = p.leaseStages("uri", 10, 4, clientResourcesFree={"io_tokens": 5})
+        assert len(leases) == 2 and leases[0][7] == {"io_tokens": 2}
+
+    def test_parse(self):
+        assert parseOptions(["--executor-resources=io_tokens=4, scratch_gb=100"]).executor_resources == \
+            {"io_tokens": 4, "scratch_gb": 100}
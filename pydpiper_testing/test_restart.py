@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from pydpiper.file_handling import fileDigest, DigestRecorder, readDigests
+import pydpiper.file_handling
+from pydpiper.application import compiledPlanKey
+from conftest import parseOptions
+from pydpiper.pipeline_executor import pipelineExecutor
+from multiprocessing import Event
+from StringIO import StringIO
+import tempfile
+import os
+
+class TestRestartCheck():
+    def setup_method(self, method):
+        self.options = parseOptions(["--restart-check=mtime"])
+        self.dir = self.options.output_directory
+        self.files = [os.path.join(self.dir, "file_%d.mnc" % i) for i in range(3)]
+        for k, f in enumerate(self.files):
+            with open(f, 'w') as fh:
+                fh.write("contents")
+            os.utime(f, (1000 + k, 1000 + k))
+
+    def makePipeline(self):
+        p = Pipeline(self.options)
+        p.setBackupFileLocation(self.dir)
+        p.addStage(CmdStage(["cmd_a", InputFile(self.files[0]), OutputFile(self.files[1])]))
+        p.addStage(CmdStage(["cmd_b", InputFile(self.files[1]), OutputFile(self.files[2])]))
+        p.initialize()
+        p.shutdown_ev = Event()
+        return p
+
+    def test_up_to_date(self):
+        p = self.makePipeline()
+        p.skip_completed_stages()
+        assert p.allStagesCompleted()
+
+    def test_newer_input(self):
+        os.utime(self.files[1], (2000, 2000))
+        p = self.makePipeline()
+        p.skip_completed_stages()
+        assert p.num_finished_stages == 1
+        assert p.runnable == set([1])
+
+    def test_missing_output(self):
+        os.remove(self.files[1])
+        p = self.makePipeline()
+        p.skip_completed_stages()
+        assert p.num_finished_stages == 0
+        assert p.runnable == set([0])
+
+    def test_touched_input_with_digest(self):
+        self.options.restart_check = "digest"
+        p = self.makePipeline()
+        with open(p.inputDigestsLocation, 'w') as fh:
+            fh.write("%s,%s,%s\n" % (p.stages[1].getHash(), self.files[1],
+                                     fileDigest(self.files[1])))
+        os.utime(self.files[1], (2000, 2000))
+        p.skip_completed_stages()
+        assert p.allStagesCompleted()
+
+    def test_digests_recorded(self):
+        recorder = DigestRecorder(os.path.join(self.dir, "digests"))
+        computed = []
+        digest = pydpiper.file_handling.fileDigest
+        pydpiper.file_handling.fileDigest = lambda f: (computed.append(f), digest(f))[1]
+        try:
+            recorder.record("a", self.files[:2])
+            recorder.record("b", self.files[1:])
+            recorder.flush()
+        finally:
+            pydpiper.file_handling.fileDigest = digest
+        # (the file shared by the stages is read once)
+        assert sorted(computed) == sorted(self.files)
+        digests = readDigests(os.path.join(self.dir, "digests"))
+        assert digests["b"] == dict((f, digest(f)) for f in self.files[1:])
+
+class TestCompiledPlan():
+    def setup_method(self, method):
+        self.options = parseOptions(["--use-compiled-plan"])
+        self.planFile = os.path.join(self.options.output_directory, "test_compiled_plan.pkl")
+        self.key = compiledPlanKey(self.options, "0")
+
+    def test_save_and_load(self):
+        p = Pipeline(self.options)
+        p.addStage(CmdStage(["cmd_a", InputFile("a.mnc"), OutputFile("b.mnc")]))
+        p.addStage(CmdStage(["cmd_b", InputFile("b.mnc"), OutputFile("c.mnc")]))
+        p.initialize()
+        p.savePlan(self.planFile, self.key)
+        q = Pipeline(self.options)
+        assert q.loadPlan(self.planFile, self.key)
+        assert [str(s) for s in q.stages] == [str(s) for s in p.stages]
+        assert q.G.edges() == [(0, 1)]
+        assert q.runnable == set([0])
+
+    def test_key_depends_on_options(self):
+        options = parseOptions(["--use-compiled-plan", "--input-space=lsq6",
+                                "--output-dir=" + self.options.output_directory])
+        assert compiledPlanKey(options, "0") != self.key
+        options = parseOptions(["--use-compiled-plan", "--num-executors=7",
+                                "--output-dir=" + self.options.output_directory])
+        assert compiledPlanKey(options, "0") == self.key
+        # (saved as the memory requirement of stages without their own)
+        options = parseOptions(["--use-compiled-plan", "--default-job-mem=3",
+                                "--output-dir=" + self.options.output_directory])
+        assert compiledPlanKey(options, "0") != self.key
+
+    def test_key_depends_on_files_named_by_options(self):
+        masks = tempfile.mkdtemp()
+        with open(os.path.join(masks, "mask.mnc"), 'w') as f:
+            f.write("a")
+        options = parseOptions(["--use-compiled-plan", "--mask-dir=" + masks,
+                                "--output-dir=" + self.options.output_directory])
+        key = compiledPlanKey(options, "0")
+        with open(os.path.join(masks, "mask.mnc"), 'w') as f:
+            f.write("ab")
+        assert compiledPlanKey(options, "0") != key
+
+    def test_unsavable_plan(self):
+        p = Pipeline(self.options)
+        p.initialize()
+        # (not raising)
+        p.savePlan(os.path.join(self.options.output_directory, "missing", "plan.pkl"), self.key)
+        assert not os.path.exists(os.path.join(self.options.output_directory, "missing"))
+
+    def test_stale_plan_ignored(self):
+        p = Pipeline(self.options)
+        p.initialize()
+        p.savePlan(self.planFile, self.key)
+        assert not Pipeline(self.options).loadPlan(self.planFile, "another key")
+
+class TestHandoff():
+    def setup_method(self, method):
+        self.options = parseOptions(["--handoff"])
+        self.dir = self.options.output_directory
+
+    def makePipeline(self):
+        p = Pipeline(self.options)
+        p.setBackupFileLocation(self.dir)
+        p.addStage(CmdStage(["mincANTS", InputFile("a.mnc"), OutputFile("b.mnc")]))
+        p.addStage(CmdStage(["mincblur", InputFile("b.mnc"), OutputFile("c.mnc")]))
+        p.initialize()
+        p.shutdown_ev = Event()
+        p.finished_stages_fh = StringIO()
+        p.registerClient("executor", 8)
+        return p
+
+    def handOff(self):
+        old = self.makePipeline()
+        old.getCommand("executor", 8, 1)
+        old.setStageStarted(0, "executor")
+        old.beginHandoff()
+        assert old.getCommand("executor", 8, 1) == ("handoff", None)
+        new = self.makePipeline()
+        new.loadHandoffSnapshot()
+        return new
+
+    def test_adoption(self):
+        p = self.handOff()
+        assert p.awaiting_adoption == { 0 : "executor" }
+        assert p.runnable == set()
+        adopted = p.reattachClient("executor", 8, [0], [("setStagesTerminated", [(0, 0, None)])])
+        assert adopted == [0]
+        assert p.stages[0].isFinished()
+        assert p.runnable == set([1])
+
+    def test_reattached_limits(self):
+        p = self.handOff()
+        p.reattachClient("executor", 8, [0], [], None, 4)
+        assert p.clients["executor"].maxprocs == 4
+
+    def test_no_reattachment(self):
+        p = self.handOff()
+        p.adoption_deadline = 0
+        p.manageExecutors()
+        assert p.awaiting_adoption == {}
+        assert p.runnable == set([0])
+
+    def test_executor_buffers_results(self):
+        executor = pipelineExecutor(self.options)
+        executor.handing_off = True
+        executor.notifyStagesTerminated([(0, 0, 12.0)])
+        assert executor.pending_notifications == [("setStagesTerminated", [(0, 0, 12.0)])]
+
+    def test_executor_buffers_speculative_results(self):
+        executor = pipelineExecutor(self.options)
+        executor.handing_off = True
+        executor.notifySpeculativeStageTerminated(0, 0, 12.0)
+        assert executor.pending_notifications == [("setSpeculativeStageTerminated", [0], 0, 12.0)]
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+from pydpiper.result_cache import ResultCache
+from os.path import join, exists
+import tempfile
+import os
+
+def writeFile(filename, contents):
+    with open(filename, 'w') as fh:
+        fh.write(contents)
+
+class TestResultCache():
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp()
+        self.cache = ResultCache(join(self.dir, "cache"), max_size=1)
+        self.input = join(self.dir, "in.mnc")
+        writeFile(self.input, "input")
+        self.outputs = [join(self.dir, "run1", "out.mnc")]
+        os.mkdir(join(self.dir, "run1"))
+        os.mkdir(join(self.dir, "run2"))
+
+    def args(self, outputs):
+        return ["mincblur", "-fwhm", "0.5", self.input, outputs[0]]
+
+    def test_miss_then_hit(self):
+        key = self.cache.key(self.args(self.outputs), [self.input], self.outputs)
+        assert not self.cache.materialize(key, self.outputs)
+        writeFile(self.outputs[0], "blurred")
+        self.cache.store(key, self.outputs)
+        # same command writing to a different directory:
+        outputs = [join(self.dir, "run2", "out.mnc")]
+        key2 = self.cache.key(self.args(outputs), [self.input], outputs)
+        assert key2 == key
+        assert self.cache.materialize(key2, outputs)
+        assert open(outputs[0]).read() == "blurred"
+
+    def test_key_depends_on_input_contents(self):
+        key = self.cache.key(self.args(self.outputs), [self.input], self.outputs)
+        writeFile(self.input, "different input")
+        os.utime(self.input, (0, 0))
+        assert self.cache.key(self.args(self.outputs), [self.input], self.outputs) != key
+
+    def test_companion_files(self):
+        xfm = join(self.dir, "run1", "nlin.xfm")
+        writeFile(xfm, "grid file nlin_grid_0.mnc")
+        writeFile(join(self.dir, "run1", "nlin_grid_0.mnc"), "grid")
+        key = self.cache.key(["minctracc", self.input, xfm], [self.input], [xfm])
+        self.cache.store(key, [xfm])
+        assert self.cache.materialize(key, [join(self.dir, "run2", "nlin.xfm")])
+        assert exists(join(self.dir, "run2", "nlin_grid_0.mnc"))
+
+    def test_eviction(self):
+        # room for two entries (each an output plus a manifest):
+        self.cache.max_size = 25 / 2.0**30
+        keys = []
+        for k in range(3):
+            writeFile(self.outputs[0], "0123456")
+            key = self.cache.key(self.args(self.outputs) + [str(k)], [self.input], self.outputs)
+            self.cache.store(key, self.outputs)
+            os.utime(self.cache.entry(key), (k, k))
+            os.remove(self.outputs[0])
+            keys.append(key)
+        assert not exists(self.cache.entry(keys[0]))
+        assert exists(self.cache.entry(keys[2]))
+
+    def test_eviction_not_on_every_store(self):
+        scans = []
+        evict = self.cache.evict
+        self.cache.evict = lambda: (scans.append(1), evict())
+        for k in range(3):
+            writeFile(self.outputs[0], "0123456")
+            self.cache.store(self.cache.key(self.args(self.outputs) + [str(k)], [self.input], self.outputs),
+                             self.outputs)
+        # (the cache being well within its size after the first)
+        assert len(scans) == 1
+
+    def test_key_depends_on_embedded_inputs(self):
+        # (as in mincANTS's similarity metric arguments)
+        args = ["mincANTS", "3", "-m", "CC[%s,%s,1,4]" % (self.input, self.input), "-o", self.outputs[0]]
+        key = self.cache.key(args, [self.input], self.outputs)
+        writeFile(self.input, "different input")
+        os.utime(self.input, (0, 0))
+        assert self.cache.key(args, [self.input], self.outputs) != key
+
+    def test_entry_unaffected_by_overwrite(self):
+        key = self.cache.key(self.args(self.outputs), [self.input], self.outputs)
+        writeFile(self.outputs[0], "blurred")
+        self.cache.store(key, self.outputs)
+        # (e.g., rerunning the stage without the cache)
+        writeFile(self.outputs[0], "garbage")
+        outputs = [join(self.dir, "run2", "out.mnc")]
+        assert self.cache.materialize(key, outputs)
+        writeFile(outputs[0], "garbage")
+        assert self.cache.materialize(key, self.outputs)
+        assert open(self.outputs[0]).read() == "blurred"
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from conftest import parseOptions, makePipeline, generateFile
+import tempfile
+import os
+
+class TestSpeculation():
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.dir, "out.xfm")
+        stage = CmdStage(["minctracc", InputFile(generateFile(0)), OutputFile(self.output)])
+        stage.idempotent = True
+        self.p = makePipeline(parseOptions(["--speculate=3"]), [stage])
+        self.p.registerClient("idle", 10)
+        for _ in range(3):
+            self.p.runtime_estimates.record("minctracc", 100)
+        self.p.getCommand("uri", 10, 1)
+        self.p.setStageStarted(0, "uri")
+
+    def test_no_duplicate_before_straggling(self):
+        assert self.p.getCommand("idle", 10, 1) == ("wait", None)
+
+    def test_duplicate_promoted(self):
+        self.p.stages[0].start_time -= 1000
+        # (not on the executor already running the stage)
+        assert self.p.getCommand("uri", 10, 1) == ("wait", None)
+        assert self.p.getCommand("idle", 10, 1) == ("run_speculative", 0)
+        command, _ = self.p.getSpeculativeCommand(0)
+        duplicate_output = command.split()[-1]
+        assert duplicate_output != self.output
+        assert os.path.basename(duplicate_output) == "out.xfm"
+        with open(duplicate_output, 'w') as f:
+            f.write("xfm")
+        self.p.setSpeculativeStageTerminated(0, 0, 50.0, "idle")
+        # the original's executor is told to kill it with its next heartbeat ...
+        assert self.p.updateClientTimestamp("uri", 1) == [0]
+        assert self.p.updateClientTimestamp("uri", 2) == []
+        # ... and the duplicate's outputs replace its own only once it has stopped
+        assert not self.p.stages[0].isFinished()
+        assert not os.path.exists(self.output)
+        self.p.setStageFailed(0, "uri")
+        assert self.p.stages[0].isFinished() and not self.p.failedStages
+        assert open(self.output).read() == "xfm"
+        assert os.listdir(self.dir) == ["out.xfm"]
+
+    def test_duplicate_promoted_when_original_lost(self):
+        self.p.stages[0].start_time -= 1000
+        self.p.getCommand("idle", 10, 1)
+        command, _ = self.p.getSpeculativeCommand(0)
+        with open(command.split()[-1], 'w') as f:
+            f.write("xfm")
+        self.p.setSpeculativeStageTerminated(0, 0, 50.0, "idle")
+        self.p.unregisterClient("uri")
+        assert self.p.stages[0].isFinished()
+        assert open(self.output).read() == "xfm"
+        assert 0 not in self.p.runnable
+
+    def test_original_finishes_first(self):
+        self.p.stages[0].start_time -= 1000
+        self.p.getCommand("idle", 10, 1)
+        self.p.setStageFinished(0, "uri")
+        assert self.p.updateClientTimestamp("idle", 1) == [0]
+        self.p.setSpeculativeStageTerminated(0, -15, 1.0, "idle")
+        assert os.listdir(self.dir) == []
+
+    def test_original_finishes_before_kill(self):
+        self.p.stages[0].start_time -= 1000
+        self.p.getCommand("idle", 10, 1)
+        command, _ = self.p.getSpeculativeCommand(0)
+        with open(command.split()[-1], 'w') as f:
+            f.write("xfm")
+        self.p.setSpeculativeStageTerminated(0, 0, 50.0, "idle")
+        with open(self.output, 'w') as f:
+            f.write("original")
+        self.p.setStageFinished(0, "uri")
+        assert self.p.stages[0].isFinished()
+        assert open(self.output).read() == "original"
+        assert os.listdir(self.dir) == ["out.xfm"]
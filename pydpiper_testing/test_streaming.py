@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from pydpiper.pipeline_executor import waitForGang
+from conftest import parseOptions, makePipeline, generateFile, FakeClient
+import subprocess
+import tempfile
+import time
+import os
+
+class TestStreaming():
+    def setup_method(self, method):
+        producer = CmdStage(["producer", InputFile(generateFile(0)), OutputFile(generateFile(1))])
+        producer.setStreamable(outputs=[generateFile(1)])
+        consumer = CmdStage(["consumer", InputFile(generateFile(1)), OutputFile(generateFile(2))])
+        consumer.setStreamable(inputs=[generateFile(1)])
+        self.stages = [producer, consumer]
+
+    def test_gang_dispatch(self):
+        p = makePipeline(parseOptions(["--stream-intermediates"]), self.stages)
+        assert p.stream_pairs == { 0 : (1, generateFile(1)) }
+        assert p.getCommand("uri", 10, 2) == ("run_gang", [0, 1])
+
+    def test_no_gang_without_room(self):
+        p = makePipeline(parseOptions(["--stream-intermediates"]), self.stages)
+        assert p.getCommand("uri", 10, 1) == ("run_stage", 0)
+
+    def test_no_gang_by_default(self):
+        p = makePipeline(parseOptions(), self.stages)
+        assert p.getCommand("uri", 10, 2) == ("run_stage", 0)
+
+    def test_gang_failure_unstreams(self):
+        p = makePipeline(parseOptions(["--stream-intermediates"]), self.stages)
+        flag, indices = p.getCommand("uri", 10, 2)
+        for i in indices:
+            p.setStageStarted(i, "uri")
+        p.setGangTerminated(indices, [0, 1], "uri")
+        assert p.stream_pairs == {}
+        assert p.runnable == set([0])
+        assert p.stages[1].status is None
+
+    def test_gang_success(self):
+        p = makePipeline(parseOptions(["--stream-intermediates"]), self.stages)
+        flag, indices = p.getCommand("uri", 10, 2)
+        for i in indices:
+            p.setStageStarted(i, "uri")
+        p.setGangTerminated(indices, [0, 0], "uri")
+        assert p.allStagesCompleted()
+        assert p.runnable == set()
+
+class TestWaitForGang():
+    def setup_method(self, method):
+        self.dir = tempfile.mkdtemp()
+        self.fifo = os.path.join(self.dir, "stream")
+        os.mkfifo(self.fifo)
+
+    def start(self, client, cmd):
+        of = tempfile.TemporaryFile()
+        process = subprocess.Popen(cmd, shell=True, stdout=of, stderr=of, preexec_fn=os.setsid)
+        client.addPIDtoRunningList(process.pid)
+        return (process, of)
+
+    def test_failed_consumer_kills_blocked_producer(self):
+        # the producer blocks opening the pipe, which its consumer never reads
+        client = FakeClient()
+        processes = [self.start(client, "echo data > " + self.fifo),
+                     self.start(client, "false")]
+        started = time.time()
+        returncodes = waitForGang(client, processes, self.fifo)
+        assert time.time() - started < 5
+        assert returncodes[0] != 0 and returncodes[1] == 1
+        assert client.pids == []
+
+    def test_gang_success(self):
+        client = FakeClient()
+        processes = [self.start(client, "echo data > " + self.fifo),
+                     self.start(client, "cat " + self.fifo)]
+        assert waitForGang(client, processes, self.fifo) == [0, 0]
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from conftest import parseOptions, makePipeline, generateFile
+import pytest
+import os
+
+class TestTargets():
+    def setup_method(self, method):
+        # two independent chains 0 -> 1 -> 2 and 3 -> 4
+        self.stages = ([CmdStage(["mincblur", InputFile(generateFile(i)), OutputFile(generateFile(i + 1))])
+                        for i in range(2)]
+                       + [CmdStage(["mincaverage", InputFile(generateFile(2)), OutputFile("nlin-1.mnc")])]
+                       + [CmdStage(["mincblur", InputFile(generateFile(i)), OutputFile(generateFile(i + 1))])
+                          for i in range(10, 12)])
+
+    def test_file_target(self):
+        p = makePipeline(parseOptions(["--targets=" + generateFile(11)]), self.stages)
+        assert p.excluded_stages == set([0, 1, 2, 4])
+        assert p.getCommand("uri", 10, 1) == ("run_stage", 3)
+        p.setStageStarted(3, "uri")
+        p.setStageFinished(3, "uri")
+        assert p.allStagesCompleted()
+        assert p.runnable == set()
+
+    def test_glob_target(self):
+        p = makePipeline(parseOptions(["--targets=nlin-*.mnc"]), self.stages)
+        assert p.excluded_stages == set([3, 4])
+        assert p.runnable == set([0])
+
+    def test_relative_glob_target(self):
+        self.stages[2].outputFiles = [os.path.abspath("nlin/nlin-1.mnc")]
+        p = makePipeline(parseOptions(["--targets=nlin/nlin-*.mnc"]), self.stages)
+        assert p.excluded_stages == set([3, 4])
+
+    def test_unknown_target(self):
+        with pytest.raises(ValueError):
+            makePipeline(parseOptions(["--targets=nonexistent.mnc"]), self.stages)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from pydpiper.pipeline_executor import runProcess, TIMED_OUT
+from conftest import parseOptions, FakeClient
+from multiprocessing import Event
+from StringIO import StringIO
+import tempfile
+import time
+import os
+
+class TestRunProcess():
+    def setup_method(self, method):
+        self.log = tempfile.TemporaryFile()
+        self.client = FakeClient()
+
+    def test_within_limit(self):
+        assert runProcess(self.client, 0, ["true"], self.log, timeout=10) == 0
+        assert self.client.pids == []
+
+    def test_hung_process_group_killed(self):
+        marker = os.path.join(tempfile.mkdtemp(), "marker")
+        start = time.time()
+        # the child of the stage's process must be killed too:
+        ret = runProcess(self.client, 0, ["sh", "-c", "(sleep 1; touch %s) & sleep 30" % marker],
+                         self.log, timeout=0.2)
+        assert ret == TIMED_OUT
+        assert time.time() - start < 1
+        time.sleep(1.5)
+        assert not os.path.exists(marker)
+
+class TestStageTimeouts():
+    def setup_method(self, method):
+        self.p = Pipeline(parseOptions(["--stage-timeout-factor=3"]))
+        self.p.addStage(CmdStage(["mincANTS", InputFile("in.mnc"), OutputFile("out.xfm")]))
+        self.p.initialize()
+        self.p.finished_stages_fh = StringIO()
+        self.p.shutdown_ev = Event()
+        self.p.registerClient("hung", 10)
+        self.p.registerClient("other", 10)
+
+    def test_limit(self):
+        assert self.p.getStageTimeout(0) == 3 * 4 * 3600
+        self.p.stages[0].timeout = 60
+        assert self.p.getStageTimeout(0) == 60
+        self.p.stages[0].incrementNumberOfRetries()
+        assert self.p.getStageTimeout(0) == 120
+
+    def test_retried_elsewhere_after_backoff(self):
+        assert self.p.getCommand("hung", 10, 1) == ("run_stage", 0)
+        self.p.setStageStarted(0, "hung")
+        self.p.setStagesTerminated([(0, TIMED_OUT, None)], "hung")
+        assert self.p.stages[0].status is None and 0 not in self.p.runnable
+        assert self.p.continueLoop()
+        self.p.retry_at[0] = (time.time(), 0)
+        assert self.p.getCommand("hung", 10, 1) == ("wait", None)
+        assert self.p.getCommand("other", 10, 1) == ("run_stage", 0)
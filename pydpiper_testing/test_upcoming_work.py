@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from conftest import parseOptions, makePipeline, generateFile
+
+class TestUpcomingWork():
+    def setup_method(self, method):
+        # a barrier stage whose output is used by two others
+        self.stages = ([CmdStage(["mincaverage", InputFile(generateFile(0)), OutputFile(generateFile(1))])]
+                       + [CmdStage(["mincblur", InputFile(generateFile(1)), OutputFile(generateFile(i))])
+                          for i in [2, 3]])
+
+    def test_upcoming_work(self):
+        p = makePipeline(parseOptions(), self.stages)
+        p.registerClient("idle_1", 10)
+        p.registerClient("idle_2", 10)
+        p.registerClient("idle_3", 10)
+        p.getCommand("uri", 10, 1)
+        p.setStageStarted(0, "uri")
+        # mincaverage should finish in about 2 minutes, then two stages become runnable:
+        assert 0 < p.getUpcomingWork("idle_1", 600) <= 120
+        assert p.getUpcomingWork("idle_2", 600) is not None
+        assert p.getUpcomingWork("idle_3", 600) is None
+        assert p.getUpcomingWork("idle_1", 60) is None
+        # a busy client isn't idle:
+        assert p.getUpcomingWork("uri", 600) is None
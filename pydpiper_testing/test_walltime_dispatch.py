@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+
+from pydpiper.pipeline import *
+from conftest import parseOptions, makePipeline, generateFile
+
+class TestWalltimeAwareDispatch():
+    def setup_method(self, method):
+        self.stages = [CmdStage(["mincANTS", InputFile(generateFile(0)), OutputFile(generateFile(1))]),
+                       CmdStage(["mincblur", InputFile(generateFile(2)), OutputFile(generateFile(3))])]
+
+    def test_backfill(self):
+        p = makePipeline(parseOptions(), self.stages)
+        # enough time for mincblur but not mincANTS:
+        assert p.getCommand("uri", 10, 1, clientTimeLeft=600) == ("run_stage", 1)
+        assert p.runnable == set([0])
+
+    def test_drain(self):
+        p = makePipeline(parseOptions(), self.stages[:1])
+        assert p.getCommand("uri", 10, 1, clientTimeLeft=600) == ("shutdown_normally", None)
+        assert p.runnable == set([0])
+
+    def test_learned_runtime(self):
+        p = makePipeline(parseOptions(), self.stages[:1])
+        p.runtime_estimates.record("mincANTS", 60)
+        assert p.getCommand("uri", 10, 1, clientTimeLeft=600) == ("run_stage", 0)
+
+    def test_unlimited_time(self):
+        p = makePipeline(parseOptions(), self.stages[:1])
+        assert p.getCommand("uri", 10, 1) == ("run_stage", 0)
@@ -6,21 +6,48 @@ import socket
 log = sys.argv[1]
 f = open(log)
 
+def executorHost(executor):
+	# the host in an executor's URI; other executors ("local", "direct-submission") as they are
+	m = re.match(r".*@(.*):\d+$", executor)
+	return m.group(1) if m else executor
+
+def hostname(host):
+	# the name of a host given by address
+	try:
+		socket.inet_aton(host)
+	except socket.error:
+		return host
+	try:
+		return socket.gethostbyaddr(host)[0]
+	except socket.error:
+		return host
 
 commands = []
 started  = {}
 finished = []
+if log.endswith(".jsonl"):
+	# an event journal (--event-journal) rather than the server's log
+	from pydpiper.events import readEvents
+	f = []
+	for e in readEvents(log):
+		if e["event"] == "start":
+			started["stage %d" % e["stage"]] = executorHost(e["executor"])
+		elif e["event"] == "finish":
+			finished.append("stage %d" % e["stage"])
+		elif e["event"] in ("fail", "retry", "lost"):
+			started.pop("stage %d" % e["stage"], None)
 for line in f:
 	m = re.match(r"""\d+\s+(.*)$""", line)
 	if m: 
 		commands.append( m.group(1) )
 		continue		
-	m = re.match(r"""Starting Stage \d+: (.*) \(PYRO://(.*):.*\)$""", line)
+	# (a stage's ID may be qualified by the pipeline it's from, e.g., "5 (name:3)")
+	m = re.search(r"""Starting Stage \d+(?: \([^)]*\))?: (.*)\(([^()]*)\)$""", line)
 	if m:
-		started[ m.group(1) ] = m.group(2) 
+		started[ m.group(1) ] = executorHost(m.group(2))
 		continue
 
-	m = re.match(r"""Finished Stage \d+: (.*)$""", line)
+	m = re.search(r"""Finished Stage \d+(?: \([^)]*\))?: (.*)$""", line)
 	if m:
 		finished.append( m.group(1) )
 		continue
@@ -29,14 +56,19 @@ active = [(started[i], i) for i in set(started.keys()) - set(finished)]
 active.sort(key=lambda x: x[0])
 hosts = {}
 print len(active), "active tasks."
-print len(set(commands) - set(finished)), " task remaining."
+if commands:
+	print len(set(commands) - set(finished)), " task remaining."
+else:
+	print len(finished), "tasks finished."
 lasthostname = None
 LINELENGTH = 170
 for ip, cmd in active: 
-	hostname = hosts.get(ip, socket.gethostbyaddr(ip)[0])
-	if not hostname == lasthostname:
+	if ip not in hosts:
+		hosts[ip] = hostname(ip)
+	host = hosts[ip]
+	if not host == lasthostname:
 		print
-		print hostname
+		print host
 		print "-"*(LINELENGTH+5)
 	print "%s" % (cmd[:LINELENGTH]+" ... ")
-	lasthostname = hostname
+	lasthostname = host